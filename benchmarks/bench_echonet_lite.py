@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+# coding: UTF-8
+#
+# bench_echonet_lite.py
+#
+# ECHONET Lite 電文コーデック ベンチマーク & ファズテスト
+#   ベンチマーク: parse_frame(), decode_frame(), make_frame(), change_tid_frame(), make_get_frame_dict(),
+#                 parse_datetime() の電文/s と1電文あたりのメモリ割り当て（残るメモリブロック数, byte）
+#   ファズテスト: ランダムな正常電文の往復（make_frame -> parse_frame / decode_frame）と，
+#                 壊れた電文（PDCの途中で切れている, OPC個のプロパティが無い, EHD不正, ランダムな変異）が
+#                 例外を出さずに不正と判定されること，
+#                 EDTデコーダーが短い・ランダムなEDTでValueError以外の例外を出さないことを確認する
+#   電文: シミュレータ(y3sim.SmartMeterSim)が返すGetRes, Get_SNA, INF, 複数プロパティのGetRes
+#
+# Usage: ./benchmarks/bench_echonet_lite.py [-n 繰り返し回数] [--fuzz 試行回数] [--seed 乱数シード]
+#        ファズテストで不具合が見つかった場合は終了コード1
+#
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_frame_decoder import make_corpus
+from echonet_lite import EchonetLiteFrameError, EchonetLiteSmartEnergyMeter
+
+
+def bench(func, args_list, number):
+    """args_listの全引数でfuncをnumber回呼び，1回あたりの時間から[電文/s, 1電文あたりの時間[us]]を返す"""
+    start = time.perf_counter()
+    for i in range(number):
+        for args in args_list:
+            func(*args)
+    elapsed = (time.perf_counter() - start) / (number * len(args_list))
+    return [1 / elapsed, elapsed * 1e6]
+
+
+def allocations(func, args_list, number = 200):
+    """1回あたりのメモリ割り当て（結果を保持したときに残るメモリブロック数, byte）"""
+    results = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(number):
+        for args in args_list:
+            results.append(func(*args))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    calls = number * len(args_list)
+    return [sum(stat.count_diff for stat in stats) / calls, sum(stat.size_diff for stat in stats) / calls]
+
+
+def make_cases(sem, corpus):
+    """ベンチマーク対象 {名前: [func, [引数, ...]]}"""
+    frames = [[frame] for frame in corpus['(all)']]
+    ptys = [[sem.EPC_DICT['instant_power'], b''], [sem.EPC_DICT['instant_current'], b''],
+            [sem.EPC_DICT['amount_energy_normal'], b'']]
+    dts = [[b'\x07\xe0\x0a\x01\x0c\x00\x00'], [b'\x07\xe0\x0c\x1f\x17\x1e\x00']]
+    return {
+        'parse_frame':        [sem.parse_frame, frames],
+        'decode_frame':       [sem.decode_frame, frames],
+        'make_frame':         [sem.make_frame, [[1, sem.ESV_CODE['get'], ptys[:1]], [2, sem.ESV_CODE['get'], ptys]]],
+        'change_tid_frame':   [sem.change_tid_frame, [[3, frame[0]] for frame in frames]],
+        'make_get_frame_dict': [sem.make_get_frame_dict, [[]]],
+        'parse_datetime':     [sem.parse_datetime, dts]}
+
+
+def run_bench(number):
+    sem = EchonetLiteSmartEnergyMeter()
+    corpus = make_corpus()
+    sys.stdout.write('{:20s} {:>12s} {:>10s} {:>10s} {:>10s}\n'.format('function', 'frames/s', 'us', 'blocks', 'bytes'))
+    for name, (func, args_list) in make_cases(sem, corpus).items():
+        n = max(1, number // 100) if name == 'make_get_frame_dict' else number     # 全EPCの電文を作成する
+        rate, us = bench(func, args_list, n)
+        blocks, size = allocations(func, args_list)
+        sys.stdout.write('{:20s} {:12.0f} {:10.3f} {:10.1f} {:10.1f}\n'.format(name, rate, us, blocks, size))
+
+    sys.stdout.write('\n{:20s} {:>12s} {:>10s}\n'.format('decode_frame', 'frames/s', 'us'))
+    for name, frames in corpus.items():
+        rate, us = bench(sem.decode_frame, [[frame] for frame in frames], number)
+        sys.stdout.write('{:20s} {:12.0f} {:10.3f}\n'.format(name, rate, us))
+
+
+def random_ptys(rnd):
+    """ランダムなプロパティ列 [[epc, edt], ...]"""
+    return [[bytes([rnd.randrange(0x80, 0x100)]), bytes(rnd.randrange(256) for j in range(rnd.randrange(16)))]
+            for i in range(rnd.randrange(1, 8))]
+
+
+def malformed(rnd, frame):
+    """壊れた電文 [種類, 電文(bytes)]"""
+    kind = rnd.choice(['truncated_pdc', 'opc_overrun', 'bad_ehd', 'too_short', 'trailing', 'mutation'])
+    if kind == 'truncated_pdc':     # 最後のプロパティの途中で切れている
+        return kind, frame[:-1]
+    if kind == 'opc_overrun':       # OPCがプロパティの数より多い
+        return kind, frame[:11] + bytes([frame[11] + rnd.randrange(1, 256 - frame[11])]) + frame[12:]
+    if kind == 'bad_ehd':
+        return kind, bytes([frame[0] ^ rnd.randrange(1, 256)]) + frame[1:]
+    if kind == 'too_short':
+        return kind, frame[:rnd.randrange(12)]
+    if kind == 'trailing':
+        return kind, frame + bytes(rnd.randrange(256) for i in range(rnd.randrange(1, 4)))
+    data = bytearray(frame)       # ランダムに1～3byteを書き換える（正常な電文になることもある）
+    for i in range(rnd.randrange(1, 4)):
+        data[rnd.randrange(len(data))] = rnd.randrange(256)
+    return kind, bytes(data)
+
+
+def run_fuzz(count, seed):
+    """ファズテスト return: 見つかった不具合の数"""
+    rnd = random.Random(seed)
+    sem = EchonetLiteSmartEnergyMeter()
+    failures = []
+    corpus = make_corpus()['(all)']
+    epcs = sorted(sem.decoders)
+
+    for epc in epcs:    # 全てのデコーダーに短いEDT（0～3byte）
+        for size in range(4):
+            edt = bytes(rnd.randrange(256) for j in range(size))
+            try:
+                sem.decode(epc, edt)
+            except ValueError:
+                pass
+            except Exception as err:
+                failures.append(['decode 0x{:02X} raised {!r}'.format(epc, err), edt])
+
+    for i in range(count):
+        # 往復: make_frame -> parse_frame / decode_frame, change_tid_frame
+        tid = rnd.randrange(65536)
+        esv = rnd.choice([sem.ESV_CODE['get'], sem.ESV_CODE['get_res'], sem.ESV_CODE['inf']])
+        ptys = random_ptys(rnd)
+        frame = sem.make_frame(tid, esv, ptys)
+        parsed = sem.parse_frame(frame)
+        if not parsed or parsed['tid'] != tid or parsed['esv'] != esv or \
+                [[pty['epc'], pty['edt']] for pty in parsed['ptys']] != ptys:
+            failures.append(['parse_frame round trip', frame])
+        decoded = sem.decode_frame(frame)
+        if decoded.tid != tid or decoded.esv != esv[0] or \
+                [[bytes([pty.epc]), bytes(pty.edt)] for pty in decoded.ptys] != ptys:
+            failures.append(['decode_frame round trip', frame])
+        new_tid = rnd.randrange(65536)
+        if sem.decode_frame(sem.change_tid_frame(new_tid, frame)).tid != new_tid:
+            failures.append(['change_tid_frame', frame])
+
+        # 壊れた電文: parse_frameはFalse, decode_frameはEchonetLiteFrameError, 両者の判定が一致すること
+        kind, data = malformed(rnd, rnd.choice([frame] + corpus))
+        try:
+            parse_ok = sem.parse_frame(data) is not False
+        except Exception as err:
+            failures.append(['parse_frame {} raised {!r}'.format(kind, err), data])
+            continue
+        try:
+            sem.decode_frame(data)
+            decode_ok = True
+        except EchonetLiteFrameError:
+            decode_ok = False
+        except Exception as err:
+            failures.append(['decode_frame {} raised {!r}'.format(kind, err), data])
+            continue
+        if kind != 'mutation' and (parse_ok or decode_ok):
+            failures.append(['{} accepted'.format(kind), data])
+        elif parse_ok != decode_ok and data[10] not in sem.SETGET_ESV:   # parse_frameはSetGet系に非対応
+            failures.append(['{} parse_frame={} decode_frame={}'.format(kind, parse_ok, decode_ok), data])
+
+        # EDTデコーダー: 値, または不正なEDT（短い，日時が不正）はValueError
+        epc = rnd.choice(epcs)
+        edt = bytes(rnd.randrange(256) for j in range(rnd.choice([rnd.randrange(8), rnd.randrange(200)])))
+        try:
+            sem.decode(epc, edt)
+        except ValueError:
+            pass
+        except Exception as err:
+            failures.append(['decode 0x{:02X} raised {!r}'.format(epc, err), edt])
+
+        # 日付&時間: datetime, または不正な値はValueError
+        dt_bytes = bytes(rnd.randrange(256) for j in range(rnd.randrange(8)))
+        try:
+            sem.parse_datetime(dt_bytes)
+        except ValueError:
+            pass
+        except Exception as err:
+            failures.append(['parse_datetime raised {!r}'.format(err), dt_bytes])
+
+    for name, data in failures[:20]:
+        sys.stdout.write('[Fuzz]: {}: {}\n'.format(name, data.hex()))
+    sys.stdout.write('[Fuzz]: {} cases, {} failures (seed={})\n'.format(count, len(failures), seed))
+    return len(failures)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('-n', '--number', default=20000, type=int, help='number of repetitions')
+    p.add_argument('--fuzz', default=10000, type=int, help='number of fuzz cases (0: skip)')
+    p.add_argument('--seed', default=None, type=int, help='random seed for fuzzing')
+    args = p.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    failures = run_fuzz(args.fuzz, seed) if args.fuzz else 0
+    if args.number:
+        run_bench(args.number)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# coding: UTF-8
+#
+# bench_frame_decoder.py
+#
+# ECHONET Lite 電文デコーダー マイクロベンチマーク
+#   EchonetLite.parse_frame() (dict) と EchonetLite.decode_frame() (memoryview, __slots__) を比較する
+#   電文: シミュレータ(y3sim.SmartMeterSim)が返すGetRes, Get_SNA, INF
+#
+# Usage: ./benchmarks/bench_frame_decoder.py [-n 繰り返し回数]
+#
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from echonet_lite import EchonetLiteSmartEnergyMeter
+from y3sim import SmartMeterSim
+
+
+def make_corpus():
+    """GetRes/Get_SNA/INF電文 {種類: [電文(bytes), ...]}"""
+    sem = EchonetLiteSmartEnergyMeter()
+    sim = SmartMeterSim(seed=1)
+    now = datetime.datetime(2016, 10, 1, 12, 34, 56)
+    corpus = {}
+
+    corpus['GetRes(E7)'] = [sim.handle(sem.GET_FRAME_DICT['get_instant_power'], now)]
+    corpus['GetRes(E2)'] = [sim.handle(sem.GET_FRAME_DICT['get_hist_amount_energy1_norm'], now)]
+    corpus['GetRes(x8)'] = [sim.handle(sem.make_get_frame(['operation_status', 'fault_status', 'epc_coefficient',
+                                                           'digits', 'unit_amount_energy', 'amount_energy_normal',
+                                                           'instant_power', 'instant_current']), now)]
+    corpus['Get_SNA'] = [sim.handle(sem.make_get_frame(['instant_power', 'idn']), now)]
+    corpus['INF(EA)'] = [sim.make_inf(1, now)]
+    corpus['(all)'] = [frame for frames in list(corpus.values()) for frame in frames]
+    return corpus
+
+
+def bench(decode, frames, number):
+    """frames全体をnumber回デコードし，1電文あたりの時間[us]を返す"""
+    start = time.perf_counter()
+    for i in range(number):
+        for frame in frames:
+            decode(frame)
+    return (time.perf_counter() - start) / (number * len(frames)) * 1e6
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('-n', '--number', default=50000, type=int, help='number of repetitions')
+    args = p.parse_args()
+
+    sem = EchonetLiteSmartEnergyMeter()
+    sys.stdout.write('{:12s} {:>6s} {:>12s} {:>12s}\n'.format('frame', 'bytes', 'parse us', 'decode us'))
+    for name, frames in make_corpus().items():
+        size = sum(len(frame) for frame in frames)
+        sys.stdout.write('{:12s} {:6d} {:12.3f} {:12.3f}\n'.format(name, size,
+                         bench(sem.parse_frame, frames, args.number), bench(sem.decode_frame, frames, args.number)))
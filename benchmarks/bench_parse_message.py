@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# coding: UTF-8
+#
+# bench_parse_message.py
+#
+# Y3Module.parse_message() マイクロベンチマーク
+#   記録したBP35A1の出力を1行ずつパースし，1行あたりの処理時間を表示する
+#   記録ファイル: BP35A1の出力（テキスト）, またはY3Module.capture_open()の記録(Y3Capture)
+#   Y3Captureの場合は受信データの行分割(Y3LineFramer)の時間も表示する
+#
+# Usage: ./benchmarks/bench_parse_message.py [記録ファイル] [-n 繰り返し回数]
+#
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from y3module import Y3Capture, Y3LineFramer
+
+
+DEFAULT_SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'y3_output.txt')
+
+
+def is_capture(filename):
+    with open(filename) as f:
+        return f.readline() == Y3Capture.HEADER
+
+
+def load_lines(filename):
+    """記録ファイル読み込み（空行は除く）
+        return: [[行(bytes), None], ...]
+    """
+    with open(filename) as f:
+        return [[line.strip().encode(), None] for line in f if line.strip()]
+
+
+def load_capture(filename):
+    """Y3Captureの記録ファイル読み込み
+        return: [受信データ(bytes), ...], [[行(bytes), バイナリ形式ERXUDPのデータ(bytes) / None], ...]
+    """
+    chunks = []
+    framer = Y3LineFramer()
+    binary = False
+    for ts, direction, data in Y3Capture.load(filename):
+        if direction == Y3Capture.TX:
+            if data.startswith(b'WOPT '):    # ERXUDPのデータ形式
+                binary = data.startswith(b'WOPT 00')
+        else:
+            chunks.append([data, binary])
+            framer.feed(data, ts, binary)
+    return chunks, [[line, payload] for ts, line, payload in framer.lines]
+
+
+def bench(lines, number):
+    """lines全体をnumber回パースし，1行あたりの時間[us]を返す"""
+    to_message = Y3LineFramer.to_message
+    start = time.perf_counter()
+    for i in range(number):
+        for line, payload in lines:
+            to_message(line, payload)
+    return (time.perf_counter() - start) / (number * len(lines)) * 1e6
+
+
+def bench_by_command(lines, number):
+    """COMMAND別の1行あたりの時間[us]"""
+    groups = {}
+    for line, payload in lines:
+        cmd = Y3LineFramer.to_message(line, payload).COMMAND.split()[0]
+        groups.setdefault(cmd, []).append([line, payload])
+    return {cmd: [len(group), bench(group, number)] for cmd, group in sorted(groups.items())}
+
+
+def bench_framer(chunks, number):
+    """受信データ全体をnumber回行分割し，[1行あたりの時間[us], MB/s]を返す"""
+    size = sum(len(data) for data, binary in chunks)
+    lines = 0
+    start = time.perf_counter()
+    for i in range(number):
+        framer = Y3LineFramer()
+        for data, binary in chunks:
+            framer.feed(data, 0.0, binary)
+            while framer:
+                framer.pop()
+                lines += 1
+    elapsed = time.perf_counter() - start
+    return [elapsed / lines * 1e6, size * number / elapsed / 1e6]
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('sample', nargs='?', default=DEFAULT_SAMPLE, help='recorded module output or capture file')
+    p.add_argument('-n', '--number', default=20000, type=int, help='number of repetitions')
+    args = p.parse_args()
+
+    chunks = None
+    if is_capture(args.sample):
+        chunks, lines = load_capture(args.sample)
+    else:
+        lines = load_lines(args.sample)
+    sys.stdout.write('{} lines x {}\n'.format(len(lines), args.number))
+    sys.stdout.write('{:12s} {:>6s} {:>10s}\n'.format('COMMAND', 'lines', 'us/line'))
+    for cmd, (count, us) in bench_by_command(lines, args.number).items():
+        sys.stdout.write('{:12s} {:6d} {:10.3f}\n'.format(cmd, count, us))
+    sys.stdout.write('{:12s} {:6d} {:10.3f}\n'.format('(all)', len(lines), bench(lines, args.number)))
+    if chunks:
+        us, mbps = bench_framer(chunks, args.number)
+        sys.stdout.write('{:12s} {:6d} {:10.3f} ({:.1f} MB/s)\n'.format('(framing)', len(lines), us, mbps))
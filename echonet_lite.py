@@ -4,11 +4,75 @@
 #
 # ECHONET Lite クラス EchonetLite
 # ECHONET Lite 低圧スマート電力量計クラス EchonetLiteSmartEnergyMeter
+# ECHONET Lite 要求・応答管理クラス EchonetLiteRequestManager
+# ECHONET Lite 積算電力量計測値履歴2 一括取得クラス EchonetLiteHistoryDownloader
+# ECHONET Lite 機器情報キャッシュクラス EchonetLiteMeterCache
+# ECHONET Lite 電文・プロパティ（デコード結果）クラス EchonetLiteFrame, EchonetLiteProperty
 #
 # Copyright(C) 2016 pi@blue-black.ink
 #
 
+import binascii
+import concurrent.futures
 import datetime
+import json
+import os
+import struct
+import threading
+import time
+
+
+class EchonetLiteFrameError(ValueError):
+    """ECHONET Lite 電文のデコードエラー
+        code: エラーコード, offset: エラーを検出した電文中の位置
+    """
+    
+    TOO_SHORT = 'too_short'         # ヘッダ(EHD1～OPC: 12byte)に満たない
+    BAD_EHD = 'bad_ehd'             # EHDが0x1081でない
+    TRUNCATED = 'truncated'         # プロパティ(EPC, PDC, EDT)の途中で電文が終わっている
+    TRAILING_DATA = 'trailing_data' # OPC個のプロパティの後にデータが残っている
+
+    def __init__(self, code, offset = 0):
+        super().__init__('{} at {}'.format(code, offset))
+        self.code = code
+        self.offset = offset
+
+
+class EchonetLiteProperty:
+    """ECHONET Lite プロパティ（デコード結果）
+        epc: int, pdc: int, edt: memoryview（受信データのコピーではない）
+    """
+    __slots__ = ('epc', 'pdc', 'edt')
+
+    def __init__(self, epc, pdc, edt):
+        self.epc = epc
+        self.pdc = pdc
+        self.edt = edt
+
+    def __repr__(self):
+        return 'EchonetLiteProperty(epc=0x{:02X}, edt={})'.format(self.epc, bytes(self.edt).hex())
+
+
+class EchonetLiteFrame:
+    """ECHONET Lite 電文（デコード結果）
+        tid, esv, opc: int, seoj, deoj: memoryview, ptys: [EchonetLiteProperty, ...]
+        get_ptys: SetGet系の電文のGet側のプロパティ列（ptysはSet側）, それ以外の電文はNone
+    """
+    __slots__ = ('tid', 'seoj', 'deoj', 'esv', 'opc', 'ptys', 'get_ptys')
+
+    def __init__(self, tid, seoj, deoj, esv, opc, ptys, get_ptys = None):
+        self.tid = tid
+        self.seoj = seoj
+        self.deoj = deoj
+        self.esv = esv
+        self.opc = opc
+        self.ptys = ptys
+        self.get_ptys = get_ptys
+
+    def __repr__(self):
+        return 'EchonetLiteFrame(tid={}, seoj={}, deoj={}, esv=0x{:02X}, ptys={!r}{})'.format(
+            self.tid, bytes(self.seoj).hex(), bytes(self.deoj).hex(), self.esv, self.ptys,
+            '' if self.get_ptys is None else ', get_ptys={!r}'.format(self.get_ptys))
 
 
 class EchonetLite:
@@ -33,6 +97,8 @@ class EchonetLite:
         'inf_sna':       b'\x53',
         'setget_sna':    b'\x5e'}
     
+    SETGET_ESV = (0x6e, 0x7e, 0x5e)     # SetGet, SetGet_Res, SetGet_SNA: OPCSet個とOPCGet個のプロパティ列
+    
     # クラスグループコード
     CLS_GRP_CODE = {
         'sensor':           b'\x00',    # センサ関連機器クラスグループ
@@ -69,23 +135,24 @@ class EchonetLite:
         'set_pty_map':          b'\x9e',
         'get_pty_map':          b'\x9f'}
     
-    # ECHONET Lite 電文構成（フレームフォーマット）
-    frame = {
-        'ehd':  bytes(2),   # ECHONET Lite電文ヘッダ1,2
-        'tid':  bytes(2),   # トランザクションID
-        'seoj': bytes(3),   # 送信元ECHONET Liteオブジェクト指定
-        'deoj': bytes(3),   # 相手先ECHONET Liteオブジェクト指定
-        'esv':  bytes(1),   # ECHONET Liteサービス
-        'opc':  bytes(1),   # 処理プロパティー数
-        'ptys': []}         # プロパティ列
-        
+    TID_OFFSET = 2      # 電文中のTIDの位置
+    EHD = 0x1081        # ECHONET Lite電文ヘッダ1,2
+    HEADER = struct.Struct('>HH6xBB')   # EHD, TID, (SEOJ, DEOJ), ESV, OPC
+
     def __init__(self):
-        self.frame['ehd'] = b'\x10\x81'
-        self.frame['tid'] = b'\x00\x00'
-        self.frame['seoj'] = b'\x00\x00\x00'
-        self.frame['deoj'] = b'\x00\x00\x00'
-        self.frame['esv'] = b'\x00'
-        self.frame['opc'] = b'\x00'
+        self.EPC_DICT = dict(self.EPC_DICT)     # インスタンス毎のEPC辞書（サブクラスで追加する）
+        
+        # ECHONET Lite 電文構成（フレームフォーマット）, インスタンス毎に持つ
+        self.frame = {
+            'ehd':  b'\x10\x81',    # ECHONET Lite電文ヘッダ1,2
+            'tid':  b'\x00\x00',    # トランザクションID
+            'seoj': b'\x00\x00\x00', # 送信元ECHONET Liteオブジェクト指定
+            'deoj': b'\x00\x00\x00', # 相手先ECHONET Liteオブジェクト指定
+            'esv':  b'\x00',        # ECHONET Liteサービス
+            'opc':  b'\x00',        # 処理プロパティー数
+            'ptys': []}             # プロパティ列
+        
+        self.get_templates = {}     # 複数プロパティのGet電文テンプレート {(EPC名, ...): bytearray}
 
     def set_tid(self, num):
         """TID設定"""
@@ -172,6 +239,38 @@ class EchonetLite:
             res += self.get_serialized_property(i)
         return res
 
+    @staticmethod
+    def check_edt(edt, size, exact = False):
+        """EDTの長さを確認する（デコーダー用）
+        exact: True: 固定長（size byteより長いEDTも不正）
+        raise: EchonetLiteFrameError（EDTがsize byteに満たない）"""
+        
+        if len(edt) < size or (exact and len(edt) != size):
+            raise EchonetLiteFrameError(EchonetLiteFrameError.TRUNCATED, len(edt))
+
+    @classmethod
+    def decode_property_map(cls, edt):
+        """プロパティマップ (9D, 9E, 9F) をデコードする
+        edt: 先頭1byteがプロパティ数, 16個未満はEPCの一覧, 16個以上は16byteのビットマップ
+             ビットマップ: n byte目のbit mがEPC 0x80 + 0x10 * m + n
+        return: EPC(int)のリスト（昇順）
+        raise: ValueError（不正なEDT）"""
+        
+        cls.check_edt(edt, 1)
+        count = edt[0]
+        if count < 16:
+            if len(edt) != count + 1:
+                raise ValueError(bytes(edt))
+            return sorted(edt[1:])
+        if len(edt) != 17:
+            raise ValueError(bytes(edt))
+        epcs = []
+        for bit in range(8):
+            for i in range(16):
+                if edt[1 + i] & (1 << bit):
+                    epcs.append(0x80 + 0x10 * bit + i)
+        return epcs
+
     @staticmethod
     def is_frame(frame):
         """ECHONET Lite電文かどうか判断"""
@@ -189,35 +288,144 @@ class EchonetLite:
             self.set_property(pty[0], pty[1])
         return self.get_serialized_frame()
 
+    def make_template(self, esv, ptys):
+        """電文テンプレートを作成する（TIDはstamp_tid()で書き込む）
+        ptys: [[epc1, edt1], [epc2, edt2], ....]
+        return: bytearray"""
+        
+        return bytearray(self.make_frame(0, esv, ptys))
+
+    @classmethod
+    def stamp_tid(cls, template, tid):
+        """電文テンプレートにTIDを書き込む（新たなオブジェクトを作らない）"""
+        
+        template[cls.TID_OFFSET] = tid >> 8
+        template[cls.TID_OFFSET + 1] = tid & 0xff
+        return template
+
+    def make_get_frame(self, epcs):
+        """複数プロパティのGet電文 (OPC>1) のテンプレートを取得する（一度作成したものは再利用する）
+        epcs: EPC名のリスト ['instant_power', 'instant_current', ...]
+        return: bytearray"""
+        
+        key = tuple(epcs)
+        template = self.get_templates.get(key)
+        if template is None:
+            if not epcs or len(epcs) > 255:
+                raise ValueError(epcs)
+            for name in epcs:
+                if name not in self.EPC_DICT:
+                    raise ValueError(name)
+            template = self.make_template(self.ESV_CODE['get'], [[self.EPC_DICT[name], b''] for name in epcs])
+            self.get_templates[key] = template
+        return template
+
+    def make_set_frame(self, ptys, esv = 'setc'):
+        """複数プロパティのSet電文を組み立てる（TIDは送信時に設定する）
+        ptys: [[EPC名, EDT], ...]
+        esv: 'setc'(応答要), 'seti'(応答不要)
+        return: bytes"""
+        
+        if esv not in ('setc', 'seti') or not ptys or len(ptys) > 255:
+            raise ValueError(esv)
+        return self.make_frame(0, self.ESV_CODE[esv], [[self.EPC_DICT[name], bytes(edt)] for name, edt in ptys])
+
+    def make_setget_frame(self, set_ptys, get_epcs):
+        """SetGet電文を組み立てる（Setの後にGetが処理される, TIDは送信時に設定する）
+        set_ptys: [[EPC名, EDT], ...]
+        get_epcs: EPC名のリスト
+        return: bytes"""
+        
+        if not set_ptys or not get_epcs or len(set_ptys) > 255 or len(get_epcs) > 255:
+            raise ValueError(get_epcs)
+        res = bytearray(self.make_frame(0, self.ESV_CODE['setget'],
+                                        [[self.EPC_DICT[name], bytes(edt)] for name, edt in set_ptys]))
+        res.append(len(get_epcs))
+        for name in get_epcs:
+            res += self.EPC_DICT[name] + b'\x00'
+        return bytes(res)
+
+    def get_set_result(self, frame, epcs):
+        """'Set_Res', 'SetC_SNA', 'SetI_SNA'電文（SetGet系の電文はSet側）のプロパティ毎の結果
+        frame: デコードした電文(EchonetLiteFrame)
+        epcs: 要求したEPC名のリスト
+        return: {EPC名: True(受理, PDC=0) / False(不可, 要求したEDTが返される)}"""
+        
+        result = dict.fromkeys(epcs, False)
+        if frame.esv not in (self.ESV_CODE['set_res'][0], self.ESV_CODE['setc_sna'][0],
+                             self.ESV_CODE['seti_sna'][0], self.ESV_CODE['setget_res'][0],
+                             self.ESV_CODE['setget_sna'][0]):
+            return result
+        accepted = set(pty.epc for pty in frame.ptys if not pty.pdc)
+        for key in epcs:
+            result[key] = self.EPC_DICT[key][0] in accepted
+        return result
+
+    def get_property_dict(self, frame, epcs):
+        """'GetRes', 'Get_SNA'電文（SetGet系の電文はGet側）のプロパティ値をEPC名で取り出す
+        frame: デコードした電文(EchonetLiteFrame)
+        epcs: 要求したEPC名のリスト
+        return: {EPC名: EDT}, 応答できなかったプロパティ(PDC=0, 'Get_SNA')はNone"""
+        
+        result = dict.fromkeys(epcs)
+        if frame.esv in (self.ESV_CODE['get_res'][0], self.ESV_CODE['get_sna'][0]):
+            ptys = frame.ptys
+        elif frame.esv in (self.ESV_CODE['setget_res'][0], self.ESV_CODE['setget_sna'][0]):
+            ptys = frame.get_ptys
+        else:
+            return result
+        edts = {}
+        for pty in ptys:
+            if pty.pdc:
+                edts[pty.epc] = pty.edt
+        for key in epcs:
+            result[key] = edts.get(self.EPC_DICT[key][0])
+        return result
+
+    def make_infc_res(self, frame):
+        """プロパティ値通知(応答要) 'INFC'に対する応答 'INFC_Res'電文を組み立てる
+        frame: デコードした'INFC'電文(EchonetLiteFrame)
+        return: bytes, TID・プロパティ(EPC)は'INFC'と同じ, PDC=0"""
+        
+        res = bytearray(self.frame['ehd'])
+        res += frame.tid.to_bytes(2, 'big')
+        res += frame.deoj
+        res += frame.seoj
+        res += self.ESV_CODE['infc_reg']
+        res.append(len(frame.ptys))
+        for pty in frame.ptys:
+            res += bytes((pty.epc, 0))
+        return bytes(res)
+
     def change_tid_frame(self, tid, frame):
-        """ECHONET Lite 電文のTIDを変更"""
+        """ECHONET Lite 電文のTIDを変更（新しい電文を返す）"""
 
-        self.set_tid(tid)
-        new_frame = frame[0:2] + self.frame['tid'] + frame[4:len(frame)]
-        return new_frame
+        return frame[0:2] + tid.to_bytes(2, 'big') + frame[4:len(frame)]
 
     def make_get_frame_dict(self):
-        """ECV辞書'EPC_DICT'を元に，Get電文を一括作成する。"""
+        """ECV辞書'EPC_DICT'を元に，Get電文のテンプレート(bytearray)を一括作成する。"""
         
         frame_dict = {}
         for key in self.EPC_DICT.keys():
-            frame = self.make_frame(0, self.ESV_CODE['get'], [[self.EPC_DICT[key], b'']])
+            frame = self.make_template(self.ESV_CODE['get'], [[self.EPC_DICT[key], b'']])
             frame_dict.update({'get_'+key: frame})
         return frame_dict
 
     def make_set_frame_dict(self):
-        """ECV辞書'EPC_DICT'を元に，Set電文を一括作成する。"""
+        """ECV辞書'EPC_DICT'を元に，Set電文のテンプレート(bytearray)を一括作成する。"""
         
         frame_dict = {}
         for key in self.EPC_DICT.keys():
-            frame = self.make_frame(0, self.ESV_CODE['setc'], [[self.EPC_DICT[key], b'']])
+            frame = self.make_template(self.ESV_CODE['setc'], [[self.EPC_DICT[key], b'']])
             frame_dict.update({'set_'+key: frame})
         return frame_dict
 
     def parse_frame(self, res):
-        """ECHONET Lite 電文パーサー"""
+        """ECHONET Lite 電文パーサー
+        res: 16進文字列(ASCII形式のERXUDP), またはbytes, memoryview(バイナリ形式のERXUDP)
+             memoryviewの場合，seoj, deoj, esv, edtはコピーせずにmemoryviewのまま返す"""
         
-        bt_res = bytes.fromhex(res)
+        bt_res = bytes.fromhex(res) if isinstance(res, str) else res
         if len(bt_res) < 12: # EHD1～OPC:12byte
             return False
         if not self.is_frame(bt_res):
@@ -247,6 +455,52 @@ class EchonetLite:
 
         return frame
 
+    @classmethod
+    def decode_frame(cls, res):
+        """ECHONET Lite 電文デコーダー（受信データをコピーしない）
+        res: 16進文字列(ASCII形式のERXUDP), またはbytes, bytearray, memoryview(バイナリ形式のERXUDP)
+        return: EchonetLiteFrame, EDT等は受信データのmemoryview
+        raise: EchonetLiteFrameError"""
+        
+        buf = memoryview(bytes.fromhex(res) if isinstance(res, str) else res)
+        size = len(buf)
+        if size < 12:   # EHD1～OPC:12byte
+            raise EchonetLiteFrameError(EchonetLiteFrameError.TOO_SHORT, size)
+        ehd, tid, esv, opc = cls.HEADER.unpack_from(buf)
+        if ehd != cls.EHD:
+            raise EchonetLiteFrameError(EchonetLiteFrameError.BAD_EHD, 0)
+
+        ptys, idx = cls.decode_properties_from(buf, 12, opc)
+        get_ptys = None
+        if esv in cls.SETGET_ESV:   # OPCGet, Get側のプロパティ
+            if idx >= size:
+                raise EchonetLiteFrameError(EchonetLiteFrameError.TRUNCATED, idx)
+            get_ptys, idx = cls.decode_properties_from(buf, idx + 1, buf[idx])
+        
+        if idx != size:
+            raise EchonetLiteFrameError(EchonetLiteFrameError.TRAILING_DATA, idx)
+
+        return EchonetLiteFrame(tid, buf[4:7], buf[7:10], esv, opc, ptys, get_ptys)
+
+    @staticmethod
+    def decode_properties_from(buf, idx, count):
+        """bufのidxからcount個のプロパティをデコードする
+        return: [EchonetLiteProperty, ...], 次の位置
+        raise: EchonetLiteFrameError"""
+        
+        size = len(buf)
+        ptys = []
+        for i in range(count):  # ECHONET Liteプロパティ
+            if idx + 2 > size:
+                raise EchonetLiteFrameError(EchonetLiteFrameError.TRUNCATED, idx)
+            pdc = buf[idx + 1]
+            end = idx + 2 + pdc
+            if end > size:
+                raise EchonetLiteFrameError(EchonetLiteFrameError.TRUNCATED, idx)
+            ptys.append(EchonetLiteProperty(buf[idx], pdc, buf[idx + 2:end]))
+            idx = end
+        return ptys, idx
+
 
 class EchonetLiteSmartEnergyMeter(EchonetLite):
     """ECHONET Lite スマート電力量メータクラス"""
@@ -271,24 +525,222 @@ class EchonetLiteSmartEnergyMeter(EchonetLite):
         'hist_amount_energy2':          b'\xec',
         'day_hist_amount_energy2':      b'\xed'}
 
+    # 積算電力量単位 (E1) [kWh]
+    UNIT_AMOUNT_ENERGY = {
+        0x00: 1.0,
+        0x01: 0.1,
+        0x02: 0.01,
+        0x03: 0.001,
+        0x04: 0.0001,
+        0x0a: 10.0,
+        0x0b: 100.0,
+        0x0c: 1000.0,
+        0x0d: 10000.0}
+
+    NO_DATA = 0xfffffffe        # 積算電力量の未計測値
+    NO_CURRENT = 0x7ffe         # 瞬時電流の未計測値（単相2線式のT相）
+    HIST1 = struct.Struct('>H48I')  # 積算電力量計測値履歴1 (E2, E4): 収集日, 48コマの積算電力量
+    HIST2_SLOT = struct.Struct('>II')   # 積算電力量計測値履歴2 (EC) の1コマ: 正方向, 逆方向
+
     def __init__(self):
         super().__init__()
         
         self.frame['seoj'] = self.CLS_GRP_CODE['control'] + self.CLS_CONTROL_CODE['controller'] + b'\x01'
         self.frame['deoj'] = self.CLS_GRP_CODE['housing'] + self.CLS_LVSM_CODE + b'\x01'
         self.frame['esv'] = self.ESV_CODE['get']
-        self.frame['opc'] = '\x01'
 
-        self.EPC_DICT.update(self.LVSM_EPC_DICT)        # スーパークラスと自クラスのEPCを連結
+        self.EPC_DICT.update(self.LVSM_EPC_DICT)        # スーパークラスと自クラスのEPCを連結（インスタンスのEPC辞書）
         self.GET_FRAME_DICT = self.make_get_frame_dict()        # Get電文辞書を一括作成
 
         self.set_property(self.EPC_DICT['operation_status'])    # 仮のプロパティを設定
 
+        self.coefficient = 1        # 係数 (D3), 取得するまでは1
+        self.unit = 1.0             # 積算電力量単位 (E1) [kWh], 取得するまでは1kWh
+
+        # EDTデコーダー {EPC(int): decoder(edt)}
+        self.decoders = {
+            0x80: self.decode_operation_status,
+            0x81: self.decode_hex,
+            0x82: self.decode_version,
+            0x88: self.decode_fault_status,
+            0x8a: self.decode_hex,
+            0x8d: self.decode_hex,
+            0x97: self.decode_time,
+            0x98: self.decode_date,
+            0x9d: self.decode_property_map,
+            0x9e: self.decode_property_map,
+            0x9f: self.decode_property_map,
+            0xd3: self.decode_coefficient,
+            0xd7: self.decode_int,
+            0xe0: self.decode_energy,
+            0xe1: self.decode_unit,
+            0xe2: self.decode_hist_energy1,
+            0xe3: self.decode_energy,
+            0xe4: self.decode_hist_energy1,
+            0xe5: self.decode_int,
+            0xe7: self.decode_power,
+            0xe8: self.decode_current,
+            0xea: self.decode_recent_energy,
+            0xeb: self.decode_recent_energy,
+            0xec: self.decode_hist_energy2,
+            0xed: self.decode_day_hist_energy2}
+
+    def decoder(self, epc):
+        """EDTデコーダーを取得（ループの外で一度取得して使う）
+        epc: EPC名, またはEPC(bytes, int)
+        return: decoder(edt) -> 値, 登録が無いEPCは16進文字列(bytes)にする"""
+        
+        if isinstance(epc, str):
+            epc = self.EPC_DICT[epc]
+        if isinstance(epc, (bytes, bytearray)):
+            epc = epc[0]
+        return self.decoders.get(epc, self.decode_hex)
+
+    def decode(self, epc, edt):
+        """EDTをデコードする"""
+        
+        return self.decoder(epc)(edt)
+
+    def decode_properties(self, frame):
+        """電文のプロパティを全てデコードする
+        frame: EchonetLiteFrame
+        return: {EPC(int): 値}, PDC=0のプロパティはNone"""
+        
+        decoders = self.decoders
+        result = {}
+        for pty in frame.ptys:
+            result[pty.epc] = decoders.get(pty.epc, self.decode_hex)(pty.edt) if pty.pdc else None
+        return result
+
+    @staticmethod
+    def decode_hex(edt):
+        return binascii.b2a_hex(edt)
+
+    # 以下のデコーダーは不正なEDT（短い，日時が不正）でValueError(EchonetLiteFrameError)を送出する
+
+    @classmethod
+    def decode_int(cls, edt):
+        cls.check_edt(edt, 1)
+        return int.from_bytes(edt, 'big')
+
+    @classmethod
+    def decode_operation_status(cls, edt):
+        """動作状態 True: ON"""
+        cls.check_edt(edt, 1)
+        return edt == b'\x30'
+
+    @classmethod
+    def decode_fault_status(cls, edt):
+        """異常発生状態 True: 異常発生なし"""
+        cls.check_edt(edt, 1)
+        return edt == b'\x42'
+
+    @classmethod
+    def decode_version(cls, edt):
+        """規格Version情報 (例) 'F'"""
+        cls.check_edt(edt, 4)
+        return bytes(edt[2:3]).decode()
+
+    @classmethod
+    def decode_time(cls, edt):
+        cls.check_edt(edt, 2)
+        return datetime.time(edt[0], edt[1])
+
+    @classmethod
+    def decode_date(cls, edt):
+        cls.check_edt(edt, 4)
+        return datetime.date(int.from_bytes(edt[0:2], 'big'), edt[2], edt[3])
+
+    def decode_coefficient(self, edt):
+        """係数 (D3), 積算電力量の換算用に保持する"""
+        self.check_edt(edt, 4, True)
+        self.coefficient = int.from_bytes(edt, 'big')
+        return self.coefficient
+
+    def decode_unit(self, edt):
+        """積算電力量単位 (E1) [kWh], 積算電力量の換算用に保持する
+            未定義の値は0.0"""
+        self.check_edt(edt, 1)
+        self.unit = self.UNIT_AMOUNT_ENERGY.get(edt[0], 0.0)
+        return self.unit
+
+    def energy_kwh(self, value):
+        """積算電力量（整数値）を[kWh]に換算, 未計測値はNone"""
+        if value == self.NO_DATA:
+            return None
+        return value * self.coefficient * self.unit
+
+    def decode_energy(self, edt):
+        """積算電力量計測値 (E0, E3) [kWh]"""
+        self.check_edt(edt, 4, True)
+        return self.energy_kwh(int.from_bytes(edt, 'big'))
+
+    @classmethod
+    def decode_power(cls, edt):
+        """瞬時電力計測値 (E7) [W]"""
+        cls.check_edt(edt, 4, True)
+        return int.from_bytes(edt, 'big', signed=True)
+
+    @classmethod
+    def decode_current(cls, edt):
+        """瞬時電流計測値 (E8) [R相[A], T相[A]], 未計測の相はNone"""
+        cls.check_edt(edt, 4, True)
+        result = []
+        for i in (0, 2):
+            value = int.from_bytes(edt[i:i + 2], 'big', signed=True)
+            result.append(None if value == cls.NO_CURRENT else value * 0.1)
+        return result
+
+    def decode_recent_energy(self, edt):
+        """定時積算電力量計測値 (EA, EB) [計測日時, 積算電力量[kWh]]
+            raise: EchonetLiteFrameError: EDTが11byteに満たない, ValueError: 計測日時が不正"""
+        self.check_edt(edt, 11)
+        return [self.parse_datetime(edt[0:7]), self.energy_kwh(int.from_bytes(edt[7:11], 'big'))]
+
+    def decode_hist_energy1(self, edt):
+        """積算電力量計測値履歴1 (E2, E4) [収集日(何日前), [0:00～23:30の積算電力量[kWh] / None(未計測), ...]]
+            48コマをまとめてデコードする"""
+        self.check_edt(edt, self.HIST1.size)
+        day, *units = self.HIST1.unpack_from(edt)
+        scale = self.coefficient * self.unit
+        no_data = self.NO_DATA
+        return [day, [None if value == no_data else value * scale for value in units]]
+
+    def decode_hist_energy2(self, edt):
+        """積算電力量計測値履歴2 (EC) [[計測日時, 正方向[kWh], 逆方向[kWh]], ...]
+            収集日時から30分毎に遡る順, 未計測はNone
+            raise: EchonetLiteFrameError: EDTがコマ数に満たない, ValueError: 収集日時が不正"""
+        self.check_edt(edt, 7)
+        self.check_edt(edt, 7 + edt[6] * self.HIST2_SLOT.size)
+        dt = datetime.datetime(int.from_bytes(edt[0:2], 'big'), edt[2], edt[3], edt[4], edt[5])
+        count = edt[6]
+        units = self.HIST2_SLOT.iter_unpack(edt[7:7 + count * self.HIST2_SLOT.size])
+        return [[dt - datetime.timedelta(minutes = 30 * i), self.energy_kwh(normal), self.energy_kwh(reverse)]
+                for i, (normal, reverse) in enumerate(units)]
+
+    @staticmethod
+    def encode_day_hist_energy2(dt, count):
+        """積算履歴収集日2 (ED) のEDT
+            dt: 収集日時（30分毎の区切り）, count: 収集コマ数(1～12)"""
+        if not 1 <= count <= 12:
+            raise ValueError(count)
+        return dt.year.to_bytes(2, 'big') + bytes([dt.month, dt.day, dt.hour, dt.minute, count])
+
+    @classmethod
+    def decode_day_hist_energy2(cls, edt):
+        """積算履歴収集日2 (ED) [収集日時, 収集コマ数], 未設定はNone"""
+        cls.check_edt(edt, 7)
+        if edt[0:6] == b'\xff\xff\xff\xff\xff\xff':
+            return None
+        dt = datetime.datetime(int.from_bytes(edt[0:2], 'big'), edt[2], edt[3], edt[4], edt[5])
+        return [dt, edt[6]]
+
     @staticmethod
     def parse_datetime(dt_bytes):
         """30分毎の計測値などに付随する日付&時間パーサー
         dt_bytes: bytes型日付&時間 YYYYMMDDhhmmss (7 byte)
-        return: datetime.datetime型"""
+        return: datetime.datetime型
+        raise: ValueError（不正な日付&時間）"""
         
         year = int.from_bytes(dt_bytes[0:2], 'big')
         month = int.from_bytes(dt_bytes[2:3], 'big')
@@ -298,3 +750,289 @@ class EchonetLiteSmartEnergyMeter(EchonetLite):
         second = int.from_bytes(dt_bytes[6:7], 'big')
         
         return datetime.datetime(year, month, day, hour, minute, second)
+
+
+
+class EchonetLiteRequestManager:
+    """ECHONET Lite 要求・応答管理クラス
+        送信中の要求をTIDで管理し，応答をTIDで要求元に振り分ける。
+        複数の要求を同時に送信中にすることができる。
+    """
+
+    def __init__(self, el, send, timeout = 20):
+        """コンストラクタ
+            el: EchonetLiteインスタンス（電文のTID変更，パースに使用）
+            send: 電文送信関数 send(frame) -> True(成功) / False(失敗)
+            timeout: 応答待ち時間の初期値[s]
+        """
+        self.el = el
+        self.send = send
+        self.timeout = timeout
+
+        self.tid = 0                # TIDカウンタ
+        self.pending = {}           # 応答待ちの要求 {tid: [future, 期限, 応答要]}
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()   # 電文テンプレートのTID書き込み～送信
+
+        self.counter = {'sent': 0,      # 送信した要求数
+                        'received': 0,  # 要求元に振り分けた応答数
+                        'timeout': 0,   # タイムアウトした要求数
+                        'late': 0,      # 応答待ちでないTIDの応答数（タイムアウト後に届いた応答など）
+                        'error': 0}     # デコードできなかった電文数
+        self.errors = {}            # デコードエラーコード毎の電文数
+
+    def next_tid(self):
+        """TICカウントアップ"""
+        self.tid = self.tid + 1 if self.tid + 1 != 65536 else 0
+        return self.tid
+
+    def request(self, frame, timeout = None, reply = True):
+        """要求電文を送信する（応答は待たない）
+            frame: 要求電文(bytes), または電文テンプレート(bytearray, TIDをそのまま書き換えて送信する)
+            timeout: 応答待ち時間[s], None: 初期値
+            reply: False: 成功時に応答が無い要求（SetI, 不可応答のみ届く）, 応答が無くてもタイムアウトに数えない
+            return: 応答待ち用Future, result()は応答電文(EchonetLiteFrame), 送信失敗・タイムアウト時はFalse
+        """
+        future = concurrent.futures.Future()
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+
+        with self.lock:
+            self.expire()
+            tid = self.next_tid()
+            self.pending[tid] = [future, deadline, reply]  # 応答の取りこぼしを防ぐため送信前に登録
+        future.tid = tid
+        future.deadline = deadline
+
+        if isinstance(frame, bytearray):    # テンプレート: 送信完了まで他の要求に書き換えられないようにする
+            with self.send_lock:
+                sent = self.send(self.el.stamp_tid(frame, tid))
+        else:
+            sent = self.send(self.el.change_tid_frame(tid, frame))
+
+        if sent:
+            self.counter['sent'] += 1
+        else:   # 送信失敗
+            with self.lock:
+                self.pending.pop(tid, None)
+            future.set_result(False)
+        return future
+
+    def result(self, future):
+        """要求の応答を待つ
+            return: 応答電文(EchonetLiteFrame), タイムアウト時はFalse
+        """
+        try:
+            return future.result(max(0.0, future.deadline - time.time()))
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                entry = self.pending.pop(future.tid, None)
+                if entry and entry[2]:
+                    self.counter['timeout'] += 1
+            return future.result() if future.done() else False  # 直前に応答が届いた場合はそれを返す
+
+    def dispatch(self, data):
+        """受信した電文を要求元に振り分ける（UART受信スレッドから呼ぶ）
+            data: 受信電文
+            return: True: 処理した（要求元に振り分けた，または遅延応答として破棄した）
+                    False: ECHONET Lite電文ではない，または電文が壊れている
+        """
+        try:
+            frame = self.el.decode_frame(data)
+        except EchonetLiteFrameError as err:
+            with self.lock:
+                self.counter['error'] += 1
+                self.errors[err.code] = self.errors.get(err.code, 0) + 1
+            return False
+
+        with self.lock:
+            entry = self.pending.pop(frame.tid, None)
+            if entry:
+                self.counter['received'] += 1
+            else:
+                self.counter['late'] += 1
+        if entry:
+            entry[0].set_result(frame)
+        return True
+
+    def expire(self):
+        """期限切れの要求を応答待ちから外す（self.lockを取得して呼ぶこと）"""
+        now = time.time()
+        for tid in [tid for tid, entry in self.pending.items() if entry[1] < now]:
+            future, deadline, reply = self.pending.pop(tid)
+            future.set_result(False)
+            if reply:
+                self.counter['timeout'] += 1
+
+    def stats(self):
+        """統計値"""
+        with self.lock:
+            result = dict(self.counter)
+            result['pending'] = len(self.pending)
+            result['errors'] = dict(self.errors)
+        return result
+
+
+class EchonetLiteHistoryDownloader:
+    """ECHONET Lite 積算電力量計測値履歴2 (EC) 一括取得クラス
+        積算履歴収集日2 (ED) に収集日時とコマ数を設定してECを取得することを繰り返し，
+        30分毎の計測値を新しい方から順に返す。
+        cursor: 次に取得するコマの日時, 中断後はrecords(cursor, end)で再開できる
+    """
+
+    SLOT = datetime.timedelta(minutes = 30)
+
+    def __init__(self, requester, count = 12, retry = 3):
+        """コンストラクタ
+            requester: EchonetLiteRequestManager (elはEchonetLiteSmartEnergyMeter)
+            count: 1回の取得コマ数(1～12)
+            retry: 失敗時の再試行回数
+        """
+        if not 1 <= count <= 12:
+            raise ValueError(count)
+        self.requester = requester
+        self.meter = requester.el
+        self.count = count
+        self.retry = retry
+        
+        self.cursor = None          # 次に取得するコマの日時
+        self.frames = 0             # 取得したEC電文数
+        self.bad_edts = 0           # デコードできなかったEC（再試行する）
+        self.error = False          # 失敗して中断した
+        self.setget = True          # ED設定とEC取得を1つのSetGet電文で行う（非対応の機器ではFalseにする）
+
+    def set_day(self, dt, count):
+        """積算履歴収集日2 (ED) を設定
+            return: True: 成功
+        """
+        edt = self.meter.encode_day_hist_energy2(dt, count)
+        res = self.requester.result(self.requester.request(
+            self.meter.make_set_frame([['day_hist_amount_energy2', edt]])))
+        return bool(res) and self.meter.get_set_result(res, ['day_hist_amount_energy2'])['day_hist_amount_energy2']
+
+    def get_slots(self):
+        """積算電力量計測値履歴2 (EC) を取得
+            return: [[計測日時, 正方向[kWh], 逆方向[kWh]], ...] / False
+        """
+        res = self.requester.result(self.requester.request(self.meter.GET_FRAME_DICT['get_hist_amount_energy2']))
+        if not res:
+            return False
+        edt = self.meter.get_property_dict(res, ['hist_amount_energy2'])['hist_amount_energy2']
+        return False if edt is None else self.decode_slots(edt)
+
+    def set_day_get_slots(self, dt, count):
+        """ED設定とEC取得を1つのSetGet電文で行う
+            return: [[計測日時, 正方向[kWh], 逆方向[kWh]], ...] / False
+                    None: SetGet非対応の可能性（SetもGetも処理されなかった, 応答が無い）
+        """
+        edt = self.meter.encode_day_hist_energy2(dt, count)
+        res = self.requester.result(self.requester.request(
+            self.meter.make_setget_frame([['day_hist_amount_energy2', edt]], ['hist_amount_energy2'])))
+        if not res:     # SetGetを無視するメーターがある
+            return None
+        if res.get_ptys is None:
+            return None
+        accepted = self.meter.get_set_result(res, ['day_hist_amount_energy2'])['day_hist_amount_energy2']
+        edt = self.meter.get_property_dict(res, ['hist_amount_energy2'])['hist_amount_energy2']
+        if not accepted and edt is None:
+            return None
+        return self.decode_slots(edt) if accepted and edt is not None else False
+
+    def decode_slots(self, edt):
+        """ECのEDTをデコード
+            return: [[計測日時, 正方向[kWh], 逆方向[kWh]], ...] / False: EDTが不正
+        """
+        try:
+            return self.meter.decode_hist_energy2(edt)
+        except ValueError:
+            self.bad_edts += 1
+            return False
+
+    def fetch(self, dt, count):
+        """dtから遡ってcount個のコマを取得（失敗時はretry回まで再試行）"""
+        for i in range(self.retry + 1):
+            if self.setget:
+                slots = self.set_day_get_slots(dt, count)
+                if slots is None:   # SetGet非対応の可能性, SetC, Getの2往復で取得し直す
+                    slots = self.get_slots() if self.set_day(dt, count) else False
+                    if slots and slots[0][0] == dt:     # 以降はSetC, Getの2往復で取得する
+                        self.setget = False
+            else:
+                slots = self.get_slots() if self.set_day(dt, count) else False
+            if slots and slots[0][0] == dt:     # 他のクライアントがEDを変更していない
+                self.frames += 1
+                return slots
+        return False
+
+    def records(self, start, end):
+        """startからendまで30分毎の計測値を新しい方から順に返すジェネレーター
+            start: 最も新しいコマの日時（30分毎の区切り）
+            end: 最も古いコマの日時
+            yield: (計測日時, 正方向[kWh], 逆方向[kWh])
+        """
+        self.cursor = start
+        self.error = False
+        while self.cursor >= end:
+            count = min(self.count, int((self.cursor - end) / self.SLOT) + 1)
+            slots = self.fetch(self.cursor, count)
+            if not slots:
+                self.error = True
+                return
+            for dt, normal, reverse in slots:
+                yield (dt, normal, reverse)
+            self.cursor = slots[-1][0] - self.SLOT  # 要求より少ないコマ数の応答は続きから取得する
+
+
+class EchonetLiteMeterCache:
+    """ECHONET Lite 機器情報キャッシュクラス
+        機器のアドレス毎に，変化しないプロパティのEDTをJSONファイルに保存する。
+        {アドレス: {EPC名: EDT(16進文字列), ...}, ...}
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.meters = {}
+
+    def load(self):
+        """キャッシュファイル読み込み（ファイルが無い，壊れている場合は空にする）"""
+        try:
+            with open(self.filename) as f:
+                meters = json.load(f)
+        except (OSError, ValueError):
+            meters = {}
+        self.meters = meters if isinstance(meters, dict) else {}
+
+    def save(self):
+        """キャッシュファイル書き込み（一時ファイルに書いてから置き換える）
+            return: True: 成功, False: 失敗
+        """
+        tmp_filename = self.filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.meters, f, indent = 1, sort_keys = True)
+            os.replace(tmp_filename, self.filename)
+            return True
+        except OSError:
+            return False
+
+    def get(self, addr):
+        """機器のプロパティ
+            return: {EPC名: EDT(bytes)}, キャッシュが無い場合は空
+        """
+        try:
+            return {key: bytes.fromhex(value) for key, value in self.meters.get(addr, {}).items()}
+        except (AttributeError, ValueError):
+            return {}
+
+    def discard(self, addr, key):
+        """機器のプロパティを削除する（壊れたキャッシュ）"""
+        entry = self.meters.get(addr)
+        if isinstance(entry, dict):
+            entry.pop(key, None)
+
+    def update(self, addr, edts):
+        """機器のプロパティを更新
+            edts: {EPC名: EDT}
+        """
+        entry = self.meters.setdefault(addr, {})
+        for key, edt in edts.items():
+            entry[key] = bytes(edt).hex()
@@ -2,20 +2,23 @@
 # coding: UTF-8
 
 import argparse
-import binascii
 import datetime
 import glob
 import json
 import threading
 import time
 import os
-import pickle
+import signal
 import socket
 import sys
 
-import RPi.GPIO as gpio
-from y3module import Y3Module
+try:
+    import RPi.GPIO as gpio
+except ImportError:     # Raspberry Pi以外（シミュレータで動かす場合）
+    gpio = None
+from y3module import Y3Module, Y3MessageQueue
 from echonet_lite import *
+from sem_log import EnergyLog, PowerDaysPublisher, PowerLogWriter, PowerMinuteLog, PowerRollup, PowerSegmentStore
 import user_conf
 
 
@@ -27,13 +30,33 @@ LED_GPIO = 4        # LED用GPIO
 TMP_LOG_DIR = '/tmp/'               # 一次ログディレクトリ
 LOG_DIR = 'sem_app/public/logs/'    # ログ用ディレクトリ, 本スクリプトからの相対パス
 SOCK_FILE = TMP_LOG_DIR + 'sem.sock'    # UNIXソケット
-TMP_LOG_FILE = TMP_LOG_DIR + 'sem.csv'  # 一時ログファイル
 
 POW_DAYS_JSON_FILE = LOG_DIR + 'pow_days.json'  # JSON形式の電力ログファイル
-POW_DAY_LOG_HEAD = 'pow_day_'   # 日別ログファイル名の先頭
+POW_DAY_LOG_HEAD = 'pow_day_'   # 日別ログファイル名の先頭 (セグメントファイル: LOG_DIRの*.time, *.watt)
 POW_DAY_LOG_FMT = '%Y%m%d'      #        日時フォーマット
+POW_DAY_JSON_FMT = LOG_DIR + POW_DAY_LOG_HEAD + POW_DAY_LOG_FMT + '.json'   # JSON形式の日別電力ログファイル
 
 CURR_POW_FILE = TMP_LOG_DIR + 'curr_pow.txt'
+POW_LOG_MAINTENANCE = 10    # 電力ログファイル更新間隔[分]
+POW_LOG_DAYS = 10           # 電力ログ(JSON)の日数
+POW_RAW_DAYS = getattr(user_conf, 'SEM_RAW_DAYS', POW_LOG_DAYS)     # 全計測値(セグメント)の保存日数
+POW_ROLLUP_RETENTION = {    # 集計値(最小, 最大, 平均)の保存日数 (ファイル: LOG_DIRのpow_<段>_*.rollup)
+    '1min': getattr(user_conf, 'SEM_ROLLUP_1MIN_DAYS', 90),
+    '30min': getattr(user_conf, 'SEM_ROLLUP_30MIN_DAYS', 730),
+    '1day': getattr(user_conf, 'SEM_ROLLUP_1DAY_DAYS', 3650)}
+POW_ROLLUP_STATE_FILE = LOG_DIR + 'pow_rollup.json'     # 集計済みの位置
+POW_ROLLUP_JSON = {         # JSON形式の長期間の電力ログ {段: [ファイル, 日数]}
+    '30min': [LOG_DIR + 'pow_30min.json', 31],
+    '1day': [LOG_DIR + 'pow_1day.json', POW_ROLLUP_RETENTION['1day']]}
+
+ENERGY_LOG_FILE = LOG_DIR + 'energy.csv'    # 30分毎の積算電力量ログ
+ENERGY_LOG_DAYS = 45    # 積算電力量ログの保存日数（スマートメーターの積算履歴の保存日数）
+HISTORY_STATE_FILE = LOG_DIR + 'energy_history.json'    # 積算電力量計測値履歴2の一括取得の中断位置
+
+METER_CACHE_FILE = 'sem_meter_cache.json'   # スマートメーター機器情報キャッシュ, 本スクリプトからの相対パス
+CACHED_EPCS = ('get_pty_map', 'set_pty_map', 'chg_pty_map',     # キャッシュするプロパティ（変化しないもの）
+               'manufacturer_code', 'production_no',
+               'epc_coefficient', 'digits', 'unit_amount_energy')
 
 # 低圧スマート電力量計 情報保存用リスト
 sem_info = {}
@@ -41,6 +64,8 @@ sem_info = {}
 
 def gpio_init():
     """GPIO初期化"""
+    if gpio is None:
+        return
     gpio.setwarnings(False)
     gpio.setmode(gpio.BCM)
 
@@ -72,6 +97,8 @@ class LedThread(threading.Thread):
 
     @staticmethod
     def ledon(ctl):
+        if gpio is None:
+            return
         if ctl:
             gpio.output(LED_GPIO, gpio.HIGH)
         else:
@@ -85,8 +112,15 @@ class LedThread(threading.Thread):
         self.join()
 
 
+def hex_str(data):
+    """ERXUDPのデータを表示用の16進文字列にする"""
+    return data if isinstance(data, str) else data.hex().upper()
+
+
 def y3reset():
     """Wi-Sunモジュールのリセット"""
+    if gpio is None:
+        return
     gpio.output(Y3RESET_GPIO, gpio.LOW)    # high -> low -> high
     time.sleep(0.5)
     gpio.output(Y3RESET_GPIO, gpio.HIGH)
@@ -99,304 +133,454 @@ class Y3ModuleSub(Y3Module):
     
     def __init__(self):
         super().__init__()
-        self.EHD = '1081'
-        self.ECV_INF = '73'   # ECHONET ECVコード　（INF)
+        self.EHD = b'\x10\x81'
+        self.ECV_INF = (b'\x73', b'\x74')  # ECHONET ECVコード　（INF, INFC)
     
-    # UART受信スレッドrun()をECHONET Lite電文用に拡張
-    #   UART受信用スレッド
-    def run(self):
-        while not self.term_flag:
-            msg = self.read()
-            if msg:
-                msg_list = self.parse_message(msg)
-
-                # debug: UDP(PANA)の受信
-                if msg_list['COMMAND'] == 'ERXUDP' and msg_list['LPORT'] == self.Y3_UDP_PANA_PORT:
-                    sys.stdout.write('[PANA]: {}\n'.format(msg_list['DATA']))
-
-                # スマートメーターが自発的に発するプロパティ通知
-                if msg_list['COMMAND'] == 'ERXUDP' and msg_list['DATA'][0:4] == self.EHD \
-                            and msg_list['DATA'][20:22] == self.ECV_INF:
-                    sem_inf_list.append(msg_list)
-
-                elif self.search['search_words']:     # サーチ中である
-                    # サーチワードを受信した。
-                    search_words = self.search['search_words'][0]
-                    if isinstance(search_words, list):
-                        for word in search_words:
-                            if msg_list['COMMAND'].startswith(word):
-                                self.search['found_word_list'].append(msg_list)
-                                self.search['search_words'].pop(0)
-                                break
-                    elif msg_list['COMMAND'].startswith(search_words):
-                        self.search['found_word_list'].append(msg_list)
-                        self.search['search_words'].pop(0)
-                    
-                    elif self.search['ignore_intermidiate']:
-                        pass    # 途中の受信データを破棄 
-                
-                    else:    # サーチワードではなかった
-                        self.enqueue_message(msg_list)
-                
-                else:   # サーチ中ではない
-                    self.enqueue_message(msg_list)
-                
-            elif self.search['timeout']:  # read()がタイムアウト，write()でタイムアウトが設定されている
-                if time.time() - self.search['start_time'] > self.search['timeout']:
-                    self.search['found_word_list'] = []
-                    self.search['search_words'] = []
-                    self.search['timeout'] = 0
+    def is_inf(self, data):
+        """スマートメーターが自発的に発するプロパティ通知(INF, INFC)かどうか
+            data: ERXUDPのデータ (16進文字列 / bytes)
+        """
+        if isinstance(data, str):   # ASCII形式
+            return data[0:4] == self.EHD.hex() and bytes.fromhex(data[20:22]) in self.ECV_INF
+        return data[0:2] == self.EHD and data[10:11] in self.ECV_INF
+
+    # 受信メッセージの振り分けをECHONET Lite電文用に拡張
+    #   UART受信スレッドから呼ばれる
+    def process_message(self, msg_list):
+        if msg_list.COMMAND == 'ERXUDP':    # 最も頻度が高いので先に処理する
+            # debug: UDP(PANA)の受信
+            if msg_list.LPORT == self.Y3_UDP_PANA_PORT:
+                sys.stdout.write('[PANA]: {}\n'.format(hex_str(msg_list.DATA)))
+
+            # スマートメーターが自発的に発するプロパティ通知
+            if self.is_inf(msg_list.DATA):
+                sem_inf_list.put(msg_list)
+                return
+
+            # 要求に対する応答はTIDで要求元に振り分ける
+            if msg_list.LPORT == self.Y3_UDP_ECHONET_PORT and requester and requester.dispatch(msg_list.DATA):
+                self.y3_stats.add_solicited(msg_list)
+                return
+
+        if not self.search_message(msg_list):     # write()の受信待ちデータではない
+            self.enqueue_message(msg_list)
+
+
+def sem_send(frame):
+    """ECHONET Lite電文をスマートメーターに送信"""
+    return y3.udp_send(1, ip6, True, y3.Y3_UDP_ECHONET_PORT, frame)
+
+
+def sem_request(frame, timeout = None):
+    """要求電文を送信し，応答を待つ
+        frame: 要求電文(bytes) / 電文テンプレート(bytearray)
+        timeout: 応答待ち時間[s], None: requesterの初期値
+        return: 応答電文(EchonetLiteFrame) / False(送信失敗，タイムアウト)
+    """
+    parsed_data = requester.result(requester.request(frame, timeout))
+    if not parsed_data:
+        sys.stdout.write('[Error]: Time out.\n')
+    return parsed_data
 
 
 def sem_get(epc):
-    """プロパティ値要求 'Get' """
-    global tid_counter
-    
-    frame = sem.GET_FRAME_DICT['get_' + epc]
-    tid_counter = tid_counter + 1 if tid_counter + 1 != 65536 else 0  # TICカウントアップ
-    frame = sem.change_tid_frame(tid_counter, frame)
-    res = y3.udp_send(1, ip6, True, y3.Y3_UDP_ECHONET_PORT, frame)
+    """プロパティ値要求 'Get'
+        return: 応答待ち用Future
+    """
+    return requester.request(sem.GET_FRAME_DICT['get_' + epc])
 
 
 def sem_get_getres(epc):
     """プロパティ値要求 'Get', 'GetRes'受信
         epc: EHONET Liteプロパティ
+        return: 'GetRes'電文(EchonetLiteFrame) / False
     """
-    sem_get(epc)    # 'Get'送信
-    start = time.time()
-    
-    while True:
-        if y3.get_queue_size():     # データ受信
-            msg_list = y3.dequeue_message() # 受信データ取り出し
-            if msg_list['COMMAND'] == 'ERXUDP':
-                parsed_data = sem.parse_frame(msg_list['DATA'])
-                if parsed_data:
-                    if parsed_data['tid'] != tid_counter:
-                        errmsg = '[Error]: ECHONET Lite TID mismatch\n'
-                        sys.stdout.write(errmsg)
-                        return False
-                    else:
-                        return msg_list['DATA']
-                else:
-                    sys.stdout.write('[Error]: ECHONET Lite frame error.\n')
-                    return False
-            else:
-                sys.stdout.write('[Error]: Unknown data received.\n')
-                return False
-
-        else:   # データ未受信
-            if time.time() - start > 20:    # タイムアウト 20s
-                sys.stdout.write('[Error]: Time out.\n')
-                return False
-            time.sleep(0.01)
-
-
-def sem_seti(epc, edt):
-    """プロパティ値書き込み要求（応答要） 'SetI'
-        ---------------------------------
-        　(注)未検証　(注)未検証　(注)未検証
-        ---------------------------------
-        epc: Echonet Liteプロパティ(bytes)
-        edt: Echonet Liteプロパティ値データ(bytes)
-        return: True(成功) / False(失敗)"""
-    
-    global tid_counter
-    
-    tid_counter = tid_counter + 1 if tid_counter + 1 != 65536 else 0  # TICカウントアップ
-    ptys = [[epc, edt]]
-    frame = sem.make_frame(tid_counter, sem.ESV_CODE['setc'], ptys)
-    res = y3.udp_send(1, ip6, True, y3.Y3_UDP_ECHONET_PORT, frame)
+    return sem_request(sem.GET_FRAME_DICT['get_' + epc])    # 'Get'送信, 'GetRes'待ち（最大20s）
+
+
+def sem_get_pipelined(epcs, window = 4):
+    """複数のプロパティ値要求 'Get'を応答を待たずに送信し（最大window個），'GetRes'を受信
+        epcs: EHONET Liteプロパティのリスト
+        return: {epc: 'GetRes'電文(EchonetLiteFrame) / False}
+    """
+    result = {}
+    waiting = list(epcs)
+    inflight = []
     
-    start = time.time()
+    while waiting or inflight:
+        while waiting and len(inflight) < window:
+            epc = waiting.pop(0)
+            inflight.append([epc, sem_get(epc)])
+        epc, future = inflight.pop(0)
+        result[epc] = requester.result(future)
 
-    while True:
-        if y3.get_queue_size():     # データ受信
-            msg_list = y3.dequeue_message() # 受信データ取り出し
-            if msg_list['COMMAND'] == 'ERXUDP':
-                parsed_data = sem.parse_frame(msg_list['DATA'])
-                if parsed_data:
-                    if parsed_data['tid'] != tid_counter:
-                        errmsg = '[Error]: ECHONET Lite TID mismatch\n'
-                        sys.stdout.write(errmsg)
-                        return False
-                    else:
-                        return msg_list['DATA']
-                else:
-                    sys.stdout.write('[Error]: ECHONET Lite frame error.\n')
-                    return False
-            else:
-                sys.stdout.write('[Error]: Unknown data received.\n')
-                return False
+    return result
 
-        else:   # データ未受信
-            if time.time() - start > 20:    # タイムアウト 20s
-                sys.stdout.write('[Error]: Time out.\n')
-                return False
-            time.sleep(0.01)
 
+def sem_get_multi(epcs):
+    """複数のプロパティ値要求を1つの'Get'電文(OPC>1)で送信
+        epcs: EHONET Liteプロパティのリスト
+        return: 応答待ち用Future
+    """
+    return requester.request(sem.make_get_frame(epcs))
 
-def pow_logfile_init(dt):
-    """電力ログファイル初期設定"""
-    f = open(TMP_LOG_FILE , 'w')    # 一時ログ初期化
-    f.close()
 
-    if not (os.path.isdir(LOG_DIR) and os.access(LOG_DIR, os.W_OK)):    # ログ用ディレクトリ確認
+def sem_get_multi_getres(epcs):
+    """複数のプロパティ値要求 'Get'(OPC>1), 'GetRes' / 'Get_SNA'受信
+        epcs: EHONET Liteプロパティのリスト
+        return: {epc: EDT / None(応答できなかったプロパティ)} / False(タイムアウト)
+    """
+    parsed_data = sem_request(sem.make_get_frame(epcs))
+    if not parsed_data:
         return False
-        
-    csv_day_files = []  # 10日分のログファイルリスト(CSV)
-    pkl_day_files = []  #                       (pickle)
+    return sem.get_property_dict(parsed_data, epcs)
+
+
+def sem_get_batched(epcs, batch = 8, window = 2):
+    """複数のプロパティをbatch個ずつ1つの'Get'電文で要求し，応答を待たずに送信（最大window個）
+        epcs: EHONET Liteプロパティのリスト
+        return: {epc: EDT / None(タイムアウト，応答できなかったプロパティ)}
+    """
+    result = dict.fromkeys(epcs)
+    waiting = [epcs[i:i + batch] for i in range(0, len(epcs), batch)]
+    inflight = []
     
-    for i in range(10):     # 10日分の電力ログ作成
-        t = dt - datetime.timedelta(days = i)   # 対象日のdatetime
-        
-        # ログファイル名
-        dt_str = t.strftime(POW_DAY_LOG_FMT)
-        csv_filename = LOG_DIR + POW_DAY_LOG_HEAD + dt_str + '.csv'
-        pkl_filename = TMP_LOG_DIR + POW_DAY_LOG_HEAD + dt_str + '.pickle'
+    while waiting or inflight:
+        while waiting and len(inflight) < window:
+            group = waiting.pop(0)
+            inflight.append([group, sem_get_multi(group)])
+        group, future = inflight.pop(0)
+        parsed_data = requester.result(future)
+        if parsed_data:
+            result.update(sem.get_property_dict(parsed_data, group))
+
+    return result
+
+
+def sem_setc(ptys):
+    """プロパティ値書き込み要求（応答要） 'SetC', 'Set_Res' / 'SetC_SNA'受信
+        ptys: [[EHONET Liteプロパティ, EDT(bytes)], ...]
+        return: {epc: True(受理) / False(不可)} / False(タイムアウト)
+    """
+    parsed_data = sem_request(sem.make_set_frame(ptys, 'setc'))
+    if not parsed_data:
+        return False
+    return sem.get_set_result(parsed_data, [epc for epc, edt in ptys])
+
+
+def sem_seti(ptys, timeout = 2):
+    """プロパティ値書き込み要求（応答不要） 'SetI'
+        受理された場合は応答が無いため，timeout[s]の間に'SetI_SNA'が届かなければ受理とみなす
+        ptys: [[EHONET Liteプロパティ, EDT(bytes)], ...]
+        return: {epc: True(受理) / False(不可)} / False(送信失敗)
+    """
+    future = requester.request(sem.make_set_frame(ptys, 'seti'), timeout, reply = False)
+    if future.done() and not future.result():
+        sys.stdout.write('[Error]: Can not send SetI.\n')
+        return False
+    parsed_data = requester.result(future)
+    if not parsed_data:
+        return {epc: True for epc, edt in ptys}
+    return sem.get_set_result(parsed_data, [epc for epc, edt in ptys])
+
+
+def sem_setget(set_ptys, get_epcs):
+    """プロパティ値書き込み・読み出し要求 'SetGet', 'SetGet_Res' / 'SetGet_SNA'受信
+        メーターはSetを処理した後にGetを処理する（1往復で設定値に応じた値を取得できる）
+        set_ptys: [[EHONET Liteプロパティ, EDT(bytes)], ...]
+        get_epcs: EHONET Liteプロパティのリスト
+        return: [{epc: True(受理) / False(不可)}, {epc: EDT / None(応答できなかったプロパティ)}] / False(タイムアウト)
+    """
+    parsed_data = sem_request(sem.make_setget_frame(set_ptys, get_epcs))
+    if not parsed_data:
+        return False
+    return [sem.get_set_result(parsed_data, [epc for epc, edt in set_ptys]),
+            sem.get_property_dict(parsed_data, get_epcs)]
+
+
+def sem_backfill(now):
+    """積算電力量ログの欠けている日を補完する
+        E5(積算履歴収集日1)で日を選択し，E2, E4(積算電力量計測値履歴1 正方向, 逆方向)を取得する
+        SetGetで1往復で行い，SetGetに対応していないメーターではSetC, Getの2往復で行う
+        now: 現在日時
+        return: 追加・変更したコマ数
+    """
+    global setget_supported
+    
+    count = 0
+    days = energy_log.missing_days(now)
+    get_epcs = ['hist_amount_energy1_norm', 'hist_amount_energy1_rev']
+    for day in days:
+        set_ptys = [['day_hist_amount_energy1', bytes([day])]]
+        edts = None
+        fallback = False    # SetGetがタイムアウトした（SetGetを無視するメーターの可能性）
+        if setget_supported:
+            res = sem_setget(set_ptys, get_epcs)
+            if not res:
+                fallback = True
+            else:
+                accepted, edts = res
+                if not accepted['day_hist_amount_energy1'] and edts['hist_amount_energy1_norm'] is None:
+                    setget_supported = False    # SetGet非対応
+                    edts = None
+                elif not accepted['day_hist_amount_energy1']:
+                    sys.stdout.write('[Error]: Can not set day_hist_amount_energy1.\n')
+                    break
         
-        csv_day_files.append(csv_filename)
-        pkl_day_files.append(pkl_filename)
+        if not setget_supported or fallback:
+            res = sem_setc(set_ptys)
+            if not res or not res['day_hist_amount_energy1']:
+                sys.stdout.write('[Error]: Can not set day_hist_amount_energy1.\n')
+                break
+            edts = sem_get_multi_getres(get_epcs)
+            if fallback and edts and edts['hist_amount_energy1_norm'] is not None:
+                setget_supported = False    # SetC, Getには応答する: SetGet非対応
         
-        if not os.path.exists(csv_filename):    # 電力ログ(CSV)が無かったら作成する
-            try:
-                fcsv = open(csv_filename, 'w')
-                fcsv.close()
-            except:
-                return False
+        if not edts or edts['hist_amount_energy1_norm'] is None:
+            sys.stdout.write('[Error]: Can not get hist_amount_energy1_norm.\n')
+            break
         
-        if not os.path.exists(pkl_filename):    # 電力ログ(pickle)が無かったら作成する
-            result = csv2pickle(csv_filename, pkl_filename, t)
-            if not result:
-                return False       
-
-    files = glob.glob(LOG_DIR + POW_DAY_LOG_HEAD + '*.csv')         # 電力ログ(CSV)検索
-    for f in files:
-        if f in csv_day_files:
+        try:
+            res_day, normals = sem.decode('hist_amount_energy1_norm', edts['hist_amount_energy1_norm'])
+            reverses = None
+            if edts['hist_amount_energy1_rev'] is not None:
+                reverses = sem.decode('hist_amount_energy1_rev', edts['hist_amount_energy1_rev'])[1]
+        except ValueError as err:   # EDTが短い
+            sys.stdout.write('[Error]: Bad hist_amount_energy1 of day {} ({}).\n'.format(day, err))
             continue
-        else:
-            os.remove(f)    # 古い電力ログ(CSV)を削除
-
-    files = glob.glob(TMP_LOG_DIR + POW_DAY_LOG_HEAD + '*.pickle')  # 電力ログ(pickle)検索
-    for f in files:
-        if f in pkl_day_files:
+        if res_day != day:      # 他のクライアントがE5を変更した
+            sys.stdout.write('[Error]: Unexpected day_hist_amount_energy1 {}.\n'.format(res_day))
             continue
-        else:
-            os.remove(f)    # 古い電力ログ(pickle)を削除
-
-    # CSVファイルをJSONファイルに変換
-    pickle2json(sorted(pkl_day_files), POW_DAYS_JSON_FILE)
+        
+        day_ts = energy_log.day_origin(now - datetime.timedelta(days = day))
+        count += energy_log.merge_day(day_ts, normals, reverses, energy_log.last_slot(now))
     
+    energy_log.prune(now)
+    if not energy_log.save():
+        sys.stdout.write('[Error]: can not write to file.\n')
+    if days:
+        sys.stdout.write('[Backfill]: {} days, {} slots\n'.format(len(days), count))
+    return count
+
+
+def sem_download_history(days, now):
+    """積算電力量計測値履歴2 (EC) をdays日分一括取得し，積算電力量ログに追加する
+        中断した場合は次回の呼び出しで中断位置から再開する（中断位置がスマートメーターの保存期間内の場合）
+        return: True: 完了, False: 中断
+    """
+    start = datetime.datetime.fromtimestamp(energy_log.last_slot(now))
+    end = datetime.datetime.fromtimestamp(energy_log.day_origin(now - datetime.timedelta(days = days - 1)))
+    oldest = datetime.datetime.fromtimestamp(     # スマートメーターが保存している最も古い日
+        energy_log.day_origin(now - datetime.timedelta(days = ENERGY_LOG_DAYS - 1)))
+    if os.path.exists(HISTORY_STATE_FILE):      # 中断位置
+        try:
+            with open(HISTORY_STATE_FILE) as f:
+                state = json.load(f)
+            cursor = datetime.datetime.fromtimestamp(state['cursor'])
+            state_end = datetime.datetime.fromtimestamp(state['end'])
+        except (OSError, ValueError, KeyError, TypeError):
+            cursor = state_end = None
+        if cursor and cursor >= max(state_end, oldest):
+            start = cursor      # 中断前の開始日時より新しいコマはsem_backfill()で補完する
+            end = max(state_end, oldest)
+            sys.stdout.write('[History]: resume from {}\n'.format(cursor))
+        else:   # 保存期間を過ぎた，壊れている
+            os.remove(HISTORY_STATE_FILE)
+    history_start = start
+    
+    def save_state():
+        energy_log.save()
+        try:
+            with open(HISTORY_STATE_FILE, 'w') as f:
+                json.dump({'start': history_start.timestamp(), 'cursor': downloader.cursor.timestamp(),
+                           'end': end.timestamp()}, f)
+        except OSError:
+            sys.stdout.write('[Error]: can not write to file.\n')
+    
+    sys.stdout.write('[History]: {} - {}\n'.format(end, start))
+    downloader = EchonetLiteHistoryDownloader(requester)
+    frames = 0
+    try:
+        for dt, normal, reverse in downloader.records(start, end):
+            energy_log.merge(dt.timestamp(), normal, reverse)
+            if downloader.frames != frames:     # 1電文毎に中断位置を保存
+                frames = downloader.frames
+                if frames % 10 == 0:
+                    save_state()
+    except KeyboardInterrupt:
+        save_state()
+        raise
+    
+    if downloader.bad_edts:
+        sys.stdout.write('[Error]: {} bad hist_amount_energy2 EDTs.\n'.format(downloader.bad_edts))
+    if downloader.error:
+        sys.stdout.write('[Error]: Can not get hist_amount_energy2.\n')
+        save_state()
+        return False
+    
+    energy_log.save()
+    if os.path.exists(HISTORY_STATE_FILE):
+        os.remove(HISTORY_STATE_FILE)
+    sys.stdout.write('[History]: {} frames\n'.format(downloader.frames))
     return True
 
 
-def pow_logfile_maintainance(last_dt, new_dt):
-    """電力ログファイル更新"""    
-    if last_dt.minute != new_dt.minute and new_dt.minute % 10 == 0: # 10分毎
-        dt_str = last_dt.strftime(POW_DAY_LOG_FMT)
+def sem_handle_inf(data):
+    """プロパティ値通知(INF, INFC)の処理
+        定時積算電力量計測値(EA, EB)を積算電力量ログに追加する（Getは不要）
+        'INFC'には'INFC_Res'で応答する
+        return: 追加・変更したコマ数
+    """
+    try:
+        frame = sem.decode_frame(data)
+    except EchonetLiteFrameError as err:
+        sys.stdout.write('[Error]: ECHONET Lite frame error ({})\n'.format(err.code))
+        return 0
+    
+    if frame.esv == sem.ESV_CODE['infc'][0]:
+        if not sem_send(sem.make_infc_res(frame)):
+            sys.stdout.write('[Error]: Can not send INFC_Res.\n')
+    
+    count = 0
+    if frame.seoj == sem.frame['deoj']:     # スマートメーターからの通知
+        for pty in frame.ptys:
+            if pty.pdc and pty.epc in (0xea, 0xeb):     # 定時積算電力量計測値 正方向, 逆方向
+                if pty.pdc != 11:
+                    sys.stdout.write('[Error]: Bad INF property (EPC 0x{:02X}, PDC {}).\n'.format(pty.epc, pty.pdc))
+                    continue
+                try:
+                    dt, energy = sem.decode(pty.epc, pty.edt)
+                    if pty.epc == 0xea:
+                        count += energy_log.merge(dt.timestamp(), normal = energy)
+                    else:
+                        count += energy_log.merge(dt.timestamp(), reverse = energy)
+                except ValueError as err:   # 計測日時が不正
+                    sys.stdout.write('[Error]: Bad INF property (EPC 0x{:02X}, {}).\n'.format(pty.epc, err))
+    
+    if count and not energy_log.save():
+        sys.stdout.write('[Error]: can not write to file.\n')
+    return count
+
+
+def print_stats():
+    """Wi-SUNモジュールの統計を表示（SEM_INTERVAL, SEM_DURATIONの調整用）"""
+    stats = y3.stats()
+    sys.stdout.write('[Stats]: {:.0f}s, UART in {} bytes, out {} bytes\n'.format(
+        stats['elapsed'], stats['bytes_in'], stats['bytes_out']))
+    for name, cmd in sorted(stats['commands'].items()):
+        if cmd['count']:
+            sys.stdout.write('[Stats]: {:10s} n={} mean={:.3f}s min={:.3f}s max={:.3f}s timeout={} fail={} error={}\n'.format(
+                name, cmd['count'], cmd['mean'], cmd['min'], cmd['max'], cmd['timeout'], cmd['fail'], cmd['error']))
+        else:
+            sys.stdout.write('[Stats]: {:10s} n=0 timeout={} fail={} error={}\n'.format(
+                name, cmd['timeout'], cmd['fail'], cmd['error']))
+    if stats['unsolicited']:
+        sys.stdout.write('[Stats]: unsolicited {}\n'.format(stats['unsolicited']))
+    if requester:
+        sys.stdout.write('[Stats]: ECHONET Lite {}\n'.format(requester.stats()))
+    if replay:
+        sys.stdout.write('[Stats]: replay {} commands, {} mismatched\n'.format(replay.tx_count, replay.tx_mismatch))
+    sys.stdout.write('[Stats]: log writer {}\n'.format(log_writer.stats()))
 
-        today_csv_file = LOG_DIR + POW_DAY_LOG_HEAD + dt_str + '.csv'
-        today_pkl_file = TMP_LOG_DIR + POW_DAY_LOG_HEAD + dt_str + '.pickle'
-        
-        file_cat(today_csv_file, TMP_LOG_FILE)
-        os.remove(TMP_LOG_FILE)         # 一時ログファイルを削除
-        
-        csv2pickle(today_csv_file, today_pkl_file, last_dt)  # pickle更新
 
-        if last_dt.day != new_dt.day:   # 日付変更
-            pow_logfile_init(new_dt)    # 電力ログ初期化
+def pow_logfile_init(dt):
+    """電力ログファイル初期設定"""
+    if not (os.path.isdir(LOG_DIR) and os.access(LOG_DIR, os.W_OK)):    # ログ用ディレクトリ確認
+        return False
 
-        else:
-            pkl_day_files = glob.glob(TMP_LOG_DIR + POW_DAY_LOG_HEAD + '*.pickle')   # 電力ログ(pickle)検索
-            pickle2json(sorted(pkl_day_files), POW_DAYS_JSON_FILE)     # CSVファイルをJSONファイルに変換
+    files = glob.glob(LOG_DIR + POW_DAY_LOG_HEAD + '*.csv')         # 以前の形式の電力ログ(CSV)検索
+    for f in files:
+        try:
+            day = EnergyLog.day_origin(datetime.datetime.strptime(
+                os.path.basename(f)[len(POW_DAY_LOG_HEAD):-len('.csv')], POW_DAY_LOG_FMT))
+        except ValueError:
+            continue
+        if not pow_store.exists(day) and not pow_store.import_csv(f):   # セグメントファイルに変換
+            return False
+        os.remove(f)
 
+    for f in glob.glob(TMP_LOG_DIR + POW_DAY_LOG_HEAD + '*.pickle'):    # 以前の形式の電力ログ(pickle)を削除
+        os.remove(f)
 
-def file_cat(file_a, file_b):
-    """ファイルを連結する"""
-    try:
-        fp_a = open(file_a, 'ab')
-        fp_b = open(file_b, 'rb')
-        fp_a.write(fp_b.read())
-        fp_a.close()
-        fp_b.close()
-        return True
-    except:
+    if not pow_rollup_update(dt):   # 削除する前に集計する
         return False
 
-
-def csv2pickle(csvfile, pklfile, dt):
-    """csvファイルをpickleファイルに変換"""
+    oldest = EnergyLog.day_origin(dt - datetime.timedelta(days = POW_RAW_DAYS - 1))
+    for day in pow_store.days():
+        if day < oldest:
+            pow_store.remove(day)   # 古い電力ログ(セグメント)を削除
     try:
-        fcsv = open(csvfile, 'r')
-        fpkl = open(pklfile, 'wb')
-        data = fcsv.readlines()
-    except:
+        pow_rollup.prune(dt.timestamp())    # 古い集計値を削除
+    except OSError:
         return False
 
-    if data == []:      # 新規作成のよりcsvファイルが空の場合
-        # 引数dt(datetime型)から、0時0分のタイムスタンプを作成
-        ts_origin = datetime.datetime.combine(dt, datetime.time(0, 0)).timestamp()
-    else:
-        ts = int(data[0].strip().split(',')[0])     # ログからタイムスタンプを取得
-        dt = datetime.datetime.fromtimestamp(ts)    # 0時0分のタイムスタンプを作成
-        ts_origin = datetime.datetime(dt.year, dt.month, dt.day).timestamp()
+    json_day_files = [(dt - datetime.timedelta(days = i)).strftime(POW_DAY_JSON_FMT) for i in range(POW_LOG_DAYS)]
+    files = glob.glob(LOG_DIR + POW_DAY_LOG_HEAD + '*.json')        # 電力ログ(JSON)検索
+    for f in files:
+        if f not in json_day_files:
+            os.remove(f)    # 古い日別電力ログ(JSON)を削除
 
-    data_work = [[None, []] for row in range(60 * 24)]  # 作業用空箱
-    
-    for minute in range(60 * 24):
-        data_work[minute][0] = ts_origin + 60 * minute  # 1分刻みのタイムスタンプを設定
-
-    for row in data:
-        row_list = row.strip().split(',')   # [タイムスタンプ(s), 電力]
-        if row_list[1] != 'None':
-            minute = int((int(row_list[0]) - ts_origin) / 60)   # 00:00からの経過時間[分]
-            if minute > 0 and minute < 60 * 24: 
-                data_work[minute][1].append(int(row_list[1]))   # 電力を追加
-
-    data_summary = [[None, None] for row in range(60 * 24)] # 集計用空箱
-    for minute, data in enumerate(data_work):
-        data_summary[minute][0] = data[0]
-        if len(data[1]):
-            data_summary[minute][1] = round(sum(data[1]) / len(data[1]))    # 電力平均値
-    
-    pickle.dump(data_summary, fpkl)
-    
-    fcsv.close()
-    fpkl.close()
+    pow_minutes.reset(dt)   # 今日の1分毎の平均値は計測値を受け取る毎に更新する
+    if not pow_minutes.load_segment(pow_store):
+        return False
 
+    # JSONファイルに変換
+    pow_days_publish(dt)
+    
     return True
 
 
-def pickle2json(pklfiles, jsonfile):
-    """pickleファイルをJSONファイルに変換する"""
-    data = []
-    for fpkl in pklfiles:
-        try:
-            f = open(fpkl, 'rb')
-            d = pickle.load(f)
-            data = data + d
-        except:
-            return False
-
-    json_data = []        
-    for row in data:
-        row = [int(row[0])*1000, None if row[1] is None else int(row[1])]
-        json_data.append(row)
-            
-    s = json.dumps(json_data)
-    
+def pow_rollup_update(dt):
+    """dtまでの計測値を1分, 30分, 1日毎に集計し，更新された段のJSONファイルを書き込む"""
     try:
-        f = open(jsonfile, 'w')
-        f.write(s)
-        f.close()
-        return True
-    except:
+        result = pow_rollup.update(dt.timestamp())
+    except OSError as err:
+        sys.stdout.write('[Error]: rollup failed: {}\n'.format(err))
         return False
+    for name, (filename, days) in POW_ROLLUP_JSON.items():
+        if result[name] or not os.path.exists(filename):
+            if not pow_rollup.publish(name, filename, days, dt.timestamp()):
+                sys.stdout.write('[Error]: can not write to file.\n')
+    return True
+
+
+def pow_days_publish(dt):
+    """JSON形式の電力ログを更新（過去の日は変換結果を再利用し，今日の分だけ変換する）"""
+    days = [EnergyLog.day_origin(dt - datetime.timedelta(days = i)) for i in range(POW_LOG_DAYS - 1, 0, -1)]
+    if not pow_publisher.publish(days, pow_minutes.summary()):
+        sys.stdout.write('[Error]: can not write to file.\n')
+
+
+def pow_logfile_due(last_dt, new_dt):
+    """電力ログファイル更新のタイミング（POW_LOG_MAINTENANCE分毎）"""
+    return last_dt.minute != new_dt.minute and new_dt.minute % POW_LOG_MAINTENANCE == 0
+
+
+def pow_logfile_maintainance(last_dt, new_dt):
+    """電力ログファイル更新（log_writerのスレッドで実行する）
+        計測値はlog_writerがセグメントファイルに書き込み済み（日付が変わると次のファイルに切り替わる）
+    """
+    if last_dt.day != new_dt.day:   # 日付変更
+        pow_logfile_init(new_dt)    # 電力ログ初期化
+
+    else:
+        pow_rollup_update(new_dt)   # 集計
+        pow_days_publish(new_dt)    # JSONファイルに変換
 
 
 # コマンドライン引数
 def arg_parse():
     p = argparse.ArgumentParser()
     p.add_argument('-d', '--delay', help='This script starts after a delay of [n] seconds.', default=0, type=int)
+    p.add_argument('--sim', help='Use the BP35A1 simulator instead of the UART (y3sim.py).', action='store_true')
+    p.add_argument('--sim-latency', help='Simulator: response latency [s].', default=0.05, type=float)
+    p.add_argument('--sim-loss', help='Simulator: response loss rate (0.0-1.0).', default=0.0, type=float)
+    p.add_argument('--sim-inf', help='Simulator: INF notification interval [s], 0: disable.', default=1800, type=float)
+    p.add_argument('--sim-infc', help='Simulator: notify with INFC (response required) instead of INF.', action='store_true')
+    p.add_argument('--history', help='Download [n] days of 30-minute energy history (resumable).', default=0, type=int)
+    p.add_argument('--capture', help='Record the UART traffic to [file].', default=None)
+    p.add_argument('--replay', help='Replay the UART traffic recorded with --capture instead of the UART.', default=None)
+    p.add_argument('--fast', help='Replay: ignore the recorded timing and the measurement interval.', action='store_true')
     args = p.parse_args()
     return args
 
@@ -412,18 +596,40 @@ if __name__ == '__main__':
 
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
         
-    sem_inf_list = []       # スマートメータのプロパティ通知用
-    tid_counter = 0         # TIDカウンタ
+    sem_inf_list = Y3MessageQueue(64)   # スマートメータのプロパティ通知用
+    energy_log = EnergyLog(ENERGY_LOG_FILE, ENERGY_LOG_DAYS)   # 30分毎の積算電力量ログ
+    meter_cache = EchonetLiteMeterCache(METER_CACHE_FILE)   # スマートメーター機器情報キャッシュ
+    requester = None        # ECHONET Lite 要求・応答管理
+    setget_supported = True     # スマートメーターがSetGetに対応している（SetGet_SNAで非対応と判断する）
     
     pana_ts = 0.0           # PANA認証時のタイムスタンプを記録
     saved_dt = datetime.datetime.now()      # 現在日時を保存
+    pow_store = PowerSegmentStore(LOG_DIR, POW_DAY_LOG_HEAD, POW_DAY_LOG_FMT)   # 瞬時電力の日別セグメントファイル
+    pow_minutes = PowerMinuteLog(saved_dt)  # 今日の1分毎の瞬時電力平均値
+    pow_rollup = PowerRollup(pow_store, LOG_DIR, POW_ROLLUP_RETENTION, POW_ROLLUP_STATE_FILE)     # 集計値
+    pow_publisher = PowerDaysPublisher(POW_DAYS_JSON_FILE, pow_rollup.tier['1min'], POW_DAY_JSON_FMT)  # JSON形式の電力ログ
     
     sys.stdout.write('Log files setup...\n')
     result = pow_logfile_init(saved_dt)     # ログファイル初期化
     
-    if not result:
+    if not result or not energy_log.load():
         sys.stdout.write('[Error]: Log file error\n')
         sys.exit(-1)
+    meter_cache.load()
+
+    log_writer = PowerLogWriter(pow_store, CURR_POW_FILE,    # 瞬時電力ログ書き込みスレッド
+                                flush_count=getattr(user_conf, 'SEM_LOG_FLUSH_COUNT', 20),
+                                flush_interval=getattr(user_conf, 'SEM_LOG_FLUSH_INTERVAL', 10.0),
+                                minutes=pow_minutes)
+    log_writer.start()
+
+    def sigterm_handler(signum, frame):     # killで停止したときも書き込み待ちの計測値を書き込んで終了する
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    if gpio is None and not (args.sim or args.replay):
+        sys.stdout.write('[Error]: RPi.GPIO is not available. Use --sim to run with the simulator.\n')
+        sys.exit(-1)
 
     gpio_init()
 
@@ -432,13 +638,25 @@ if __name__ == '__main__':
     led.oneshot()
 
     y3 = Y3ModuleSub()
-    y3.uart_open(dev='/dev/ttyAMA0', baud=115200, timeout=1)
+    replay = None
+    if args.replay:     # 記録したUART送受信データの再生
+        import y3sim
+        replay = y3sim.Y3ReplaySerial(args.replay, timeout=y3.UART_POLL_INTERVAL, fast=args.fast)
+        y3.uart_hdl = replay
+    elif args.sim:      # シミュレータ
+        import y3sim
+        y3.uart_hdl = y3sim.Y3SimSerial(timeout=y3.UART_POLL_INTERVAL, latency=args.sim_latency, loss=args.sim_loss,
+                                        inf_interval=args.sim_inf, infc=args.sim_infc)
+    else:
+        y3.uart_open(dev='/dev/ttyAMA0', baud=115200)
+    if args.capture:
+        y3.capture_open(args.capture)
     y3.start()
     sys.stdout.write('Wi-SUN reset...\n')
     
     y3reset()
     y3.set_echoback_off()
-    y3.set_opt(True)
+    y3.set_opt(False)   # ERXUDPをバイナリ形式で受信
     y3.set_password(user_conf.SEM_PASSWORD)
     y3.set_routeb_id(user_conf.SEM_ROUTEB_ID)
 
@@ -494,7 +712,8 @@ if __name__ == '__main__':
                     if sem_inf_list:
                         pana_ts = time.time()   # タイムスタンプを保存
                         sys.stdout.write('Successfully done.\n')               
-                        time.sleep(3)
+                        if not args.fast:
+                            time.sleep(3)
                         pana_done = True
                         break
                     elif time.time() - st > 15:     # PANA認証失敗によるタイムアウト
@@ -510,6 +729,7 @@ if __name__ == '__main__':
             
     if sem_exist:
         sem = EchonetLiteSmartEnergyMeter()
+        requester = EchonetLiteRequestManager(sem, sem_send)
                 
         get_list = ['operation_status', 'location', 'version', 'fault_status',
                     'manufacturer_code', 'production_no',
@@ -518,109 +738,72 @@ if __name__ == '__main__':
                     'epc_coefficient', 'digits', 'unit_amount_energy', 'amount_energy_normal',
                     'recent_amount_energy_norm', 'hist_amount_energy1_norm']
                     
-        for epc in get_list:    # 各種データ取得
-            edt = False
+        # 変化しないプロパティは機器情報キャッシュから取得する
+        cached = meter_cache.get(ch['Addr'])
+        for epc in list(cached):    # 壊れたキャッシュは捨てて取得し直す
+            try:
+                sem.decode(epc, cached[epc])
+            except (KeyError, ValueError):
+                sys.stdout.write('[Error]: Bad cached {}, get it again.\n'.format(epc))
+                del cached[epc]
+                meter_cache.discard(ch['Addr'], epc)
+        get_map = sem.decode_property_map(cached['get_pty_map']) if 'get_pty_map' in cached else None
+        request_list = [epc for epc in get_list
+                        if epc not in cached and (get_map is None or sem.EPC_DICT[epc][0] in get_map)]
+        
+        edts = sem_get_batched(request_list) if request_list else {}  # 各種データ取得, 複数のプロパティを1つのGetで要求
+        edts.update(cached)
+        if get_map is None and edts.get('get_pty_map'):
+            try:
+                get_map = sem.decode_property_map(edts['get_pty_map'])  # Getプロパティマップに無いプロパティは再試行しない
+            except ValueError:
+                pass    # 全てのプロパティを取得する（エラーは下で表示する）
+        
+        for epc in get_list:
+            if get_map is not None and sem.EPC_DICT[epc][0] not in get_map:
+                sys.stdout.write('[Get]: {}, not supported\n'.format(epc))
+                continue
+            
+            edt = edts.get(epc)
             for i in range(10):
-                data = sem_get_getres(epc)
-                if data:
-                    parsed_data = sem.parse_frame(data)
-                    if parsed_data:
-                        edt = parsed_data['ptys'][0]['edt']
-                        break
-                    else:
-                        continue    # Get失敗　再試行
-                else:   # Get失敗 再試行
-                    continue
+                if edt:
+                    break
+                parsed_data = sem_get_getres(epc)   # Get失敗 再試行
+                if parsed_data:
+                    edt = parsed_data.ptys[0].edt
+                    break
             
             if edt:
-                if epc == 'operation_status':
-                    result = True if edt == b'\x30' else False
-
-                elif epc == 'location':
-                    result = binascii.b2a_hex(edt)
-                    
-                elif epc == 'version':
-                    result = edt[2:3].decode()
-                    
-                elif epc == 'manufacturer_code':
-                    result = binascii.b2a_hex(edt)
-
-                elif epc == 'production_no':
-                    result = binascii.b2a_hex(edt)
-                   
-                elif epc == 'current_time':
-                    hour = int.from_bytes(edt[0:1], 'big')
-                    min = int.from_bytes(edt[1:2], 'big')
-                    result = datetime.time(hour, min)
-
-                elif epc == 'current_date':
-                    year = int.from_bytes(edt[0:2], 'big')
-                    month = int.from_bytes(edt[2:3], 'big')
-                    day = int.from_bytes(edt[3:4], 'big')
-                    result = datetime.date(year, month, day)
-
-                elif epc == 'fault_status':
-                    result = True if edt == b'\x42' else False
-
-                elif epc == 'get_pty_map':
-                    result = binascii.b2a_hex(edt)
-
-                elif epc == 'set_pty_map':
-                    result = binascii.b2a_hex(edt)
-
-                elif epc == 'chg_pty_map':
-                    result = binascii.b2a_hex(edt)
-
-                elif epc == 'epc_coefficient':
-                    result = int.from_bytes(edt, 'big')
-
-                elif epc == 'digits':
-                    result = int.from_bytes(edt, 'big')
-
-                elif epc == 'unit_amount_energy':
-                    if edt == b'\x00':
-                        result = 1.0
-                    elif edt == b'\x01':
-                        result = 0.1
-                    elif edt == b'\x02':
-                        result = 0.01
-                    elif edt == b'\x03':
-                        result = 0.001
-                    elif edt == b'\x04':
-                        result = 0.0001
-                    elif edt == b'\x0A':
-                        result = 10.0
-                    elif edt == b'\x0B':
-                        result = 100.0
-                    elif edt == b'\x0C':
-                        result = 1000.0
-                    elif edt == b'\x0D':
-                        result = 10000.0
-                    else:
-                        result = 0.0
-                    
-                elif epc == 'amount_energy_normal':
-                    result = int.from_bytes(edt, 'big')
-                    result *= sem_info['epc_coefficient'] * sem_info['unit_amount_energy']
-                    
-                elif epc == 'recent_amount_energy_norm':
-                    dt = sem.parse_datetime(edt[0:7])
-                    energy = int.from_bytes(edt[7:11], 'big')
-                    energy *= sem_info['epc_coefficient'] * sem_info['unit_amount_energy']
-                    result = [dt, energy]
-                
-                elif epc == 'hist_amount_energy1_norm':
-                    result = binascii.b2a_hex(edt)
-                    
+                try:
+                    result = sem.decode(epc, edt)   # 係数(D3), 単位(E1)はsemが保持し，積算電力量の換算に使う
+                except ValueError as err:   # EDTが短い，日時が不正
+                    sys.stdout.write('[Error]: Bad {} ({}).\n'.format(epc, err))
+                    continue
                 sem_info[epc] = result
-                sys.stdout.write('[Get]: {}, {}\n'.format(epc, result))
+                sys.stdout.write('[Get]: {}, {}{}\n'.format(epc, result, ' (cached)' if epc in cached else ''))
+                if epc in CACHED_EPCS:
+                    meter_cache.update(ch['Addr'], {epc: edt})
 
             else:  # Get失敗x10
                 sys.stdout.write('[Error]: Can not get {}.\n'.format(epc))
                 sem_exist = False
                 break
         
+        if sem_exist and not meter_cache.save():
+            sys.stdout.write('[Error]: can not write to file.\n')
+        
+    interrupted = False     # Ctrl+c, killで停止
     if sem_exist:
+        try:
+            if args.history:    # 積算電力量ログの一括取得
+                sem_download_history(min(args.history, ENERGY_LOG_DAYS), datetime.datetime.now())
+            sem_backfill(datetime.datetime.now())   # 停止中に欠けた積算電力量ログを補完
+        except KeyboardInterrupt:   # 一括取得の中断位置は保存済み
+            interrupted = True
+
+    if sem_exist and not interrupted:
+        decode_power = sem.decoder('instant_power')
+        backfill = False        # 積算電力量ログの補完が必要（通信断の後）
         start = time.time() - 1000  # 初期値を1000s前に設定
         while True:
             try:
@@ -636,7 +819,8 @@ if __name__ == '__main__':
                                 pana_ts = time.time()   # タイムスタンプを保存
                                 pana_done = True
                                 sys.stdout.write('Successfully done.\n')               
-                                time.sleep(3)
+                                if not args.fast:
+                                    time.sleep(3)
                                 break
                             elif time.time() - st > 15:     # PANA認証失敗によるタイムアウト
                                 sys.stdout.write('Fail to connect.\n')
@@ -646,88 +830,73 @@ if __name__ == '__main__':
                     
                     if not pana_done:
                         break       # PANA認証失敗でbreakする
+                    backfill = True
 
-                while True:
-                    if (time.time() - start) >= user_conf.SEM_INTERVAL:
-                        start = time.time()
-                        break
-                    else:
-                        time.sleep(0.1)
+                if replay and replay.done.is_set():   # 再生終了
+                    break
+
+                wait = user_conf.SEM_INTERVAL - (time.time() - start)
+                if wait > 0 and not args.fast:
+                    time.sleep(wait)
+                start = time.time()
                                      
-                sem_get('instant_power')    # Get
+                future = sem_get('instant_power')   # Get
+                parsed_data = requester.result(future)  # GetRes待ち, 受信したら直ちに戻る（GetRes最大待ち時間: 20s）
+
+                rcd_time = time.time()      # rcd_time[s]
+                new_dt = datetime.datetime.fromtimestamp(rcd_time)
                 
-                while True:     # GetRes待ちループ        
-                    rcd_time = time.time()      # rcd_time[s]
-                    new_dt = datetime.datetime.fromtimestamp(rcd_time)
+                # ログファイルメンテナンス
+                if pow_logfile_due(saved_dt, new_dt):
+                    log_writer.call(pow_logfile_maintainance, saved_dt, new_dt)
+                saved_dt = new_dt
+
+                while sem_inf_list:     # プロパティ値通知
+                    inf = sem_inf_list.get()
+                    sys.stdout.write('[Inf]: {}\n'.format(hex_str(inf.DATA)))
+                    sem_handle_inf(inf.DATA)
+
+                while y3.get_queue_size():  # 要求への応答以外の受信データ
+                    msg_list = y3.dequeue_message()
+                    if msg_list.COMMAND == 'ERXUDP':     # 電文が壊れている
+                        errmsg = '[Error]: ECHONET Lite frame error\n'
+                    else:   # 電文が壊れている???
+                        errmsg = '[Error]: Unknown data received.\n'
+                    sys.stdout.write(errmsg)
+
+                if parsed_data and backfill:   # 通信断から復帰
+                    backfill = False
+                    sem_backfill(new_dt)
+
+                if parsed_data:
+                    led.oneshot()
+                    try:
+                        watt_int = decode_power(parsed_data.ptys[0].edt)
+                    except ValueError as err:   # EDTが短い
+                        sys.stdout.write('[Error]: Bad instant_power ({}).\n'.format(err))
+                        log_writer.put(rcd_time, None)
+                        continue
+                    sys.stdout.write('[{:5d}] {:4d} W\n'.format(future.tid, watt_int))
+                    sys.stdout.flush()
                     
-                    # ログファイルメンテナンス
-                    pow_logfile_maintainance(saved_dt, new_dt)
-                    saved_dt = new_dt
-
-                    if y3.get_queue_size():
-                        msg_list = y3.dequeue_message()
-                        if msg_list['COMMAND'] == 'ERXUDP':
-                            led.oneshot()
-                            parsed_data = sem.parse_frame(msg_list['DATA'])
-                            
-                            if parsed_data:
-                                if parsed_data['tid'] != tid_counter:
-                                    errmsg = '[Error]: ECHONET Lite TID mismatch\n'
-                                    sys.stdout.write(errmsg)
-                                    
-                                else:
-                                    watt_int = int.from_bytes(parsed_data['ptys'][0]['edt'], 'big', signed=True)
-                                    sys.stdout.write('[{:5d}] {:4d} W\n'.format(tid_counter, watt_int))
-                                    sys.stdout.flush()
-                                    
-                                    with open(CURR_POW_FILE, 'w') as fs:
-                                        fs.write(str(watt_int))
-                            
-                                    try:    # 一時ログファイルに書き込み
-                                        f = open(TMP_LOG_FILE, 'a')        # rcd_time[ms] (JavaScript用)
-                                        f.write('{},{}\n'.format(round(rcd_time), watt_int))
-                                        f.close()
-                                    except:
-                                        sys.stdout.write('[Error]: can not write to file.\n')
-                            
-                                    if sock:  # UNIXドメインソケットで送信
-                                        sock_data = json.dumps({'time': rcd_time, 'power': watt_int}).encode('utf-8')
-                                        try:
-                                            sock.send(sock_data)
-                                        except:
-                                            sys.stdout.write('[Error]: Broken socket.\n')
-                                    break
-                            
-                            else:   # 電文が壊れている
-                                errmsg = '[Error]: ECHONET Lite frame error\n'
-                                sys.stdout.write(errmsg)
-                            
-                        else:   # 電文が壊れている???
-                            errmsg = '[Error]: Unknown data received.\n'
-                            sys.stdout.write(errmsg)
-
-                    else:   # GetRes待ち
-                        while sem_inf_list:
-                            inf = sem_inf_list.pop(0)
-                            sys.stdout.write('[Inf]: {}\n'.format(inf['DATA']))
-                        
-                        if time.time() - start > 20:    # GetRes最大待ち時間: 20s
-                            sys.stdout.write('[Error]: Time out.\n')
-                            
-                            try:    # 一時ログファイルに書き込み
-                                f = open(TMP_LOG_FILE, 'a')
-                                f.write('{},None\n'.format(round(rcd_time)))
-                                f.close()
-                            except:
-                                sys.stdout.write('[Error]: can not write to file.\n')
-                            break
-                            
-                        time.sleep(0.1)
+                    log_writer.put(rcd_time, watt_int)     # 一時ログファイル, 現在の瞬時電力ファイル
+            
+                    if sock:  # UNIXドメインソケットで送信
+                        sock_data = json.dumps({'time': rcd_time, 'power': watt_int}).encode('utf-8')
+                        try:
+                            sock.send(sock_data)
+                        except:
+                            sys.stdout.write('[Error]: Broken socket.\n')
+
+                else:   # タイムアウト
+                    sys.stdout.write('[Error]: Time out.\n')
+                    backfill = True
+                    log_writer.put(rcd_time, None)
 
             except KeyboardInterrupt:
                 break
 
-    else:
+    elif not sem_exist:
         sys.stdout.write('[Error]: Can not connect with a smart energy meter.\n')
 
     # 終了処理
@@ -737,15 +906,16 @@ if __name__ == '__main__':
         except:
             sys.stdout.write('[Error]: Broken socket.\n')
 
+    log_writer.close()
+    print_stats()
+
     sys.stdout.write('\nWi-SUN reset...\n')
     y3reset()
     y3.terminate()
     y3.uart_close()
     led.terminate()
-    gpio.cleanup()
-    
-    if os.path.exists(TMP_LOG_FILE):
-        os.remove(TMP_LOG_FILE)
+    if gpio:
+        gpio.cleanup()
 
     sys.stdout.write('Bye.\n')
     sys.exit(0)
@@ -0,0 +1,955 @@
+# coding: UTF-8
+#
+# sem_log.py
+#
+# 30分毎の積算電力量ログ EnergyLog
+# 瞬時電力の日別セグメントファイル PowerSegmentStore
+# 瞬時電力ログ書き込みスレッド PowerLogWriter
+# 1分毎の瞬時電力平均値 PowerMinuteLog
+# 瞬時電力履歴(JSON)の配信 PowerDaysPublisher
+# 瞬時電力の多段集計(1分, 30分, 1日毎の最小, 最大, 平均) PowerRollupTier, PowerRollup
+#
+# Copyright(C) 2016 pi@blue-black.ink
+#
+
+import array
+import bisect
+import datetime
+import glob
+import json
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+
+class EnergyLog:
+    """30分毎の積算電力量ログ
+        {30分毎の区切りのタイムスタンプ[s]: [正方向積算電力量[kWh], 逆方向積算電力量[kWh]]}
+        スマートメーターが未計測の値はNone（取得済みとして扱う）
+        ファイル形式(CSV): タイムスタンプ[s],正方向[kWh],逆方向[kWh]  (None: 空欄)
+    """
+
+    SLOT = 30 * 60      # 計測間隔[s]
+    SLOTS_PER_DAY = 48
+
+    def __init__(self, filename, days = 45):
+        """コンストラクタ
+            filename: ログファイル
+            days: 保存日数
+        """
+        if days < 1:
+            raise ValueError(days)
+        self.filename = filename
+        self.days = days
+        self.series = {}
+        self.modified = False
+
+    def load(self):
+        """ログファイル読み込み
+            return: True: 成功（ファイルが無い場合を含む）, False: 失敗
+        """
+        self.series = {}
+        self.modified = False
+        if not os.path.exists(self.filename):
+            return True
+        try:
+            with open(self.filename) as f:
+                for row in f:
+                    cols = row.strip().split(',')
+                    if len(cols) != 3:
+                        continue
+                    self.series[int(cols[0])] = [float(v) if v else None for v in cols[1:3]]
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def save(self):
+        """ログファイル書き込み（変更がある場合のみ, 一時ファイルに書いてから置き換える）
+            return: True: 成功, False: 失敗
+        """
+        if not self.modified:
+            return True
+        tmp_filename = self.filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                for ts in sorted(self.series):
+                    normal, reverse = self.series[ts]
+                    f.write('{},{},{}\n'.format(ts, '' if normal is None else round(normal, 4),
+                                                '' if reverse is None else round(reverse, 4)))
+            os.replace(tmp_filename, self.filename)
+        except OSError:
+            return False
+        self.modified = False
+        return True
+
+    @classmethod
+    def day_origin(cls, dt):
+        """dtの日の0時0分のタイムスタンプ[s]"""
+        return int(datetime.datetime.combine(dt.date(), datetime.time()).timestamp())
+
+    @classmethod
+    def slot_origin(cls, dt):
+        """dt直前の30分の区切りのタイムスタンプ[s]"""
+        return int(dt.replace(minute = dt.minute // 30 * 30, second = 0, microsecond = 0).timestamp())
+
+    def merge(self, ts, normal = None, reverse = None):
+        """計測値を追加する（既存の値はNoneで上書きしない）
+            ts: 30分毎の区切りのタイムスタンプ[s]
+            return: True: 追加・変更した
+        """
+        ts = int(ts)
+        old = self.series.get(ts)
+        if old is None:
+            self.series[ts] = [normal, reverse]
+        else:
+            new = [old[0] if normal is None else normal, old[1] if reverse is None else reverse]
+            if new == old:
+                return False
+            self.series[ts] = new
+        self.modified = True
+        return True
+
+    def merge_day(self, day_ts, normals, reverses = None, until = None):
+        """1日分(48コマ)の計測値を追加する
+            day_ts: 0時0分のタイムスタンプ[s]
+            normals, reverses: 0:00～23:30の積算電力量[kWh]のリスト（未計測はNone）
+            until: このタイムスタンプ[s]より後のコマは追加しない（まだ計測されていないコマ）
+            return: 追加・変更したコマ数
+        """
+        count = 0
+        for i, normal in enumerate(normals):
+            ts = day_ts + self.SLOT * i
+            if until is not None and ts > until:
+                break
+            count += self.merge(ts, normal, reverses[i] if reverses else None)
+        return count
+
+    @classmethod
+    def last_slot(cls, now):
+        """スマートメーターが確実に計測済みの最新のコマのタイムスタンプ[s]"""
+        return cls.slot_origin(now) - cls.SLOT
+
+    def missing_days(self, now):
+        """計測値が欠けている日（保存日数以内）
+            now: 現在日時
+            return: [何日前, ...] (0: 今日), 新しい日から順
+        """
+        last_slot = self.last_slot(now)
+        result = []
+        for day in range(self.days):
+            day_ts = self.day_origin(now - datetime.timedelta(days = day))
+            for i in range(self.SLOTS_PER_DAY):
+                ts = day_ts + self.SLOT * i
+                if ts > last_slot:
+                    break
+                if ts not in self.series:
+                    result.append(day)
+                    break
+        return result
+
+    def prune(self, now):
+        """保存日数より古い計測値を削除
+            return: 削除したコマ数
+        """
+        oldest = self.day_origin(now - datetime.timedelta(days = self.days - 1))
+        old_keys = [ts for ts in self.series if ts < oldest]
+        for ts in old_keys:
+            del self.series[ts]
+        if old_keys:
+            self.modified = True
+        return len(old_keys)
+
+
+class PowerSegmentStore:
+    """瞬時電力の日別セグメントファイル（バイナリ, 列毎のファイルに追記のみ）
+        セグメント: directory + head + 日付(fmt) + '.time' / '.watt'
+        列: タイムスタンプ[s] (uint32), 瞬時電力[W] (int32, NO_DATA: タイムアウト), リトルエンディアン
+        ヘッダ(24byte): マジック'SEMP', バージョン, 列の型, 要素サイズ, 0時0分のタイムスタンプ[s],
+                        最初・最後の計測値のタイムスタンプ[s], 予約
+        読み出しはmmapからarrayに写すだけで，パースしない。日付が変わると次のセグメントに切り替える。
+    """
+
+    MAGIC = b'SEMP'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBcHIIII')
+    COLUMNS = (('.time', 'I'), ('.watt', 'i'))  # (拡張子, arrayの型)
+    NO_DATA = -0x80000000       # タイムアウト
+
+    def __init__(self, directory, head = 'pow_day_', fmt = '%Y%m%d'):
+        """コンストラクタ
+            directory: セグメントファイルのディレクトリ
+            head, fmt: ファイル名の先頭, 日付のstrftime()形式
+        """
+        self.directory = directory
+        self.head = head
+        self.fmt = fmt
+
+        self.day = None             # 書き込み中のセグメント（0時0分のタイムスタンプ[s]）
+        self.day_end = None         # 翌日0時0分のタイムスタンプ[s]
+        self.files = None           # 書き込み中のセグメントの列ファイル [.time, .watt]
+        self.range = None           # 書き込み中のセグメントの [最初, 最後]の計測値のタイムスタンプ[s]
+
+    def path(self, day, ext):
+        return os.path.join(self.directory, self.head + datetime.datetime.fromtimestamp(day).strftime(self.fmt) + ext)
+
+    def days(self):
+        """セグメントがある日 [0時0分のタイムスタンプ[s], ...] (古い順)"""
+        result = []
+        for filename in glob.glob(os.path.join(self.directory, self.head + '*' + self.COLUMNS[0][0])):
+            name = os.path.basename(filename)[len(self.head):-len(self.COLUMNS[0][0])]
+            try:
+                result.append(EnergyLog.day_origin(datetime.datetime.strptime(name, self.fmt)))
+            except ValueError:
+                continue
+        return sorted(result)
+
+    def exists(self, day):
+        return all(os.path.exists(self.path(day, ext)) for ext, code in self.COLUMNS)
+
+    def mtime(self, day):
+        """セグメントの更新時刻, セグメントが無い場合はNone"""
+        try:
+            return max(os.stat(self.path(day, ext)).st_mtime for ext, code in self.COLUMNS)
+        except OSError:
+            return None
+
+    def remove(self, day):
+        for ext, code in self.COLUMNS:
+            if os.path.exists(self.path(day, ext)):
+                os.remove(self.path(day, ext))
+
+    def make_header(self, code, day, first, last):
+        return self.HEADER.pack(self.MAGIC, self.VERSION, code.encode(), array.array(code).itemsize, day, first, last, 0)
+
+    def read_header(self, f):
+        """return: [0時0分のタイムスタンプ[s], 最初, 最後の計測値のタイムスタンプ[s]] / None(ヘッダ不正)"""
+        f.seek(0)
+        data = f.read(self.HEADER.size)
+        if len(data) != self.HEADER.size:
+            return None
+        magic, version, code, size, day, first, last, reserved = self.HEADER.unpack(data)
+        if magic != self.MAGIC or version != self.VERSION:
+            return None
+        return [day, first, last]
+
+    def open_segment(self, day):
+        """dayのセグメントを追記用に開く（無ければ作成, 列の長さが異なる場合は短い方に揃える）"""
+        self.close()
+        files = []
+        try:
+            for ext, code in self.COLUMNS:
+                filename = self.path(day, ext)
+                if not os.path.exists(filename) or os.path.getsize(filename) < self.HEADER.size:  # 作成中に停止した場合
+                    with open(filename, 'wb') as f:
+                        f.write(self.make_header(code, day, 0, 0))
+                files.append(open(filename, 'r+b'))
+            header = self.read_header(files[0])
+            if header is None or header[0] != day:
+                raise OSError('bad segment header: ' + self.path(day, self.COLUMNS[0][0]))
+            count = min((os.fstat(f.fileno()).st_size - self.HEADER.size) // array.array(code).itemsize
+                        for f, (ext, code) in zip(files, self.COLUMNS))
+            for f, (ext, code) in zip(files, self.COLUMNS):     # 書き込み途中で止まった場合
+                f.truncate(self.HEADER.size + count * array.array(code).itemsize)
+        except OSError:
+            for f in files:
+                f.close()
+            raise
+        self.files = files
+        self.day = day
+        self.day_end = EnergyLog.day_origin(datetime.datetime.fromtimestamp(day) + datetime.timedelta(days = 1))
+        self.range = header[1:3] if count else [0, 0]
+
+    def append(self, samples):
+        """計測値を追記する（日付が変わったら次のセグメントに切り替える）
+            samples: [[タイムスタンプ[s], 瞬時電力[W] / None(タイムアウト)], ...]
+            raise: OSError
+        """
+        times = array.array(self.COLUMNS[0][1])
+        watts = array.array(self.COLUMNS[1][1])
+        for ts, power in samples:
+            ts = round(ts)
+            if self.day is None or not self.day <= ts < self.day_end:
+                self.write_columns(times, watts)
+                times = array.array(self.COLUMNS[0][1])
+                watts = array.array(self.COLUMNS[1][1])
+                self.open_segment(EnergyLog.day_origin(datetime.datetime.fromtimestamp(ts)))
+            times.append(ts)
+            watts.append(self.NO_DATA if power is None else power)
+        self.write_columns(times, watts)
+
+    def write_columns(self, times, watts):
+        if not times:
+            return
+        if not self.range[0]:
+            self.range[0] = times[0]
+        self.range[1] = times[-1]
+        for f, (ext, code), column in zip(self.files, self.COLUMNS, (times, watts)):
+            if sys.byteorder != 'little':
+                column.byteswap()
+            f.seek(0, os.SEEK_END)
+            f.write(column.tobytes())
+            f.seek(0)
+            f.write(self.make_header(code, self.day, self.range[0], self.range[1]))
+            f.flush()
+
+    def close(self):
+        """書き込み中のセグメントを閉じる"""
+        if self.files:
+            for f in self.files:
+                f.close()
+        self.files = None
+        self.day = None
+
+    def read(self, day):
+        """セグメントを読み出す
+            return: [タイムスタンプ[s]の列, 瞬時電力[W]の列] (array),
+                    セグメントが無い, ヘッダが不正な場合（作成中に停止した等）はNone
+            raise: OSError
+        """
+        if not self.exists(day):
+            return None
+        columns = []
+        for ext, code in self.COLUMNS:
+            column = array.array(code)
+            with open(self.path(day, ext), 'rb') as f:
+                header = self.read_header(f)
+                if header is None or header[0] != day:
+                    return None
+                try:
+                    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                        count = (len(mm) - self.HEADER.size) // column.itemsize
+                        with memoryview(mm) as view:
+                            column.frombytes(view[self.HEADER.size:self.HEADER.size + count * column.itemsize])
+                except ValueError:      # 読み出し中に切り詰められた
+                    return None
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+        count = min(len(column) for column in columns)
+        return [column[:count] if len(column) != count else column for column in columns]
+
+    def minute_summary(self, day):
+        """dayの1分毎の平均値 [[タイムスタンプ[s], 平均値[W] / None], ...], 読み込み失敗はNone"""
+        minutes = PowerMinuteLog(datetime.datetime.fromtimestamp(day))
+        if not minutes.load_segment(self):
+            return None
+        return minutes.summary()
+
+    def import_csv(self, filename):
+        """CSV形式の電力ログ（タイムスタンプ[s],瞬時電力[W] / None）を追記する
+            return: True: 成功, False: 失敗
+        """
+        samples = []
+        try:
+            with open(filename) as f:
+                for row in f:
+                    cols = row.strip().split(',')
+                    if len(cols) == 2:
+                        samples.append([int(cols[0]), None if cols[1] == 'None' else int(cols[1])])
+            self.append(samples)
+        except (OSError, ValueError):
+            return False
+        finally:
+            self.close()
+        return True
+
+
+class PowerLogWriter(threading.Thread):
+    """瞬時電力ログ書き込みスレッド
+        put()した計測値をまとめてセグメントファイル(PowerSegmentStore)に書き込む（ファイルは開いたままにする）。
+        flush_count個たまったとき，最初の計測値からflush_interval[s]経過したとき，flush(), close()で書き込む。
+        書き込みに失敗した計測値は次回に再試行し，エラー表示はERROR_REPORT_INTERVAL[s]毎にまとめて行う。
+        現在の瞬時電力ファイルはcurr_interval[s]毎に最新値で書き換える。
+    """
+
+    ERROR_REPORT_INTERVAL = 60      # エラー表示の間隔[s]
+
+    def __init__(self, store, curr_filename = None, flush_count = 20, flush_interval = 10.0,
+                 curr_interval = 1.0, max_buffer = 10000, minutes = None):
+        """コンストラクタ
+            store: 計測値を書き込むPowerSegmentStore
+            curr_filename: 現在の瞬時電力ファイル, None: 書かない
+            minutes: 計測値を受け取る毎に更新するPowerMinuteLog, None: 更新しない
+            flush_count: 書き込む計測値の数
+            flush_interval: 書き込むまでの最大時間[s]
+            curr_interval: 現在の瞬時電力ファイルの書き換え間隔[s]
+            max_buffer: 書き込み待ちの最大数（超えたら古いものから捨てる）
+        """
+        if flush_count < 1 or flush_interval < 0 or max_buffer < flush_count:
+            raise ValueError(flush_count)
+        super().__init__()
+        self.daemon = True
+        self.store = store
+        self.curr_filename = curr_filename
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.curr_interval = curr_interval
+        self.max_buffer = max_buffer
+        self.minutes = minutes
+
+        self.queue = queue.Queue()
+        self.buffer = []            # 書き込み待ちの計測値 [[タイムスタンプ[s], 瞬時電力[W] / None], ...]
+        self.deadline = None        # 書き込み期限（最初の計測値から flush_interval[s]）
+        self.curr_power = None      # 未書き込みの現在の瞬時電力
+        self.curr_time = 0.0        # 現在の瞬時電力ファイルを書き換えた時刻
+        self.failing = False        # 書き込みエラー中（flush_interval[s]毎に再試行する）
+
+        self.counter = {'samples': 0,   # 書き込んだ計測値の数
+                        'flushes': 0,   # セグメントファイルへの書き込み回数
+                        'errors': 0,    # 書き込みエラーの回数
+                        'dropped': 0}   # 書き込めずに捨てた計測値の数
+        self.error_count = 0        # 未表示の書き込みエラーの回数
+        self.error_time = 0.0       # 最後にエラーを表示した時刻
+
+    def put(self, ts, power):
+        """計測値を書き込み待ちにする（ファイルの入出力はしない）
+            ts: タイムスタンプ[s], power: 瞬時電力[W] / None(タイムアウト)
+        """
+        self.queue.put(('sample', ts, power))
+
+    def call(self, func, *args):
+        """書き込み待ちの計測値を書き込み，セグメントファイルを閉じてからfunc(*args)を実行する（ログファイルの保守用）"""
+        self.queue.put(('call', func, args))
+
+    def flush(self):
+        """書き込み待ちの計測値を直ちに書き込む"""
+        self.queue.put(('flush',))
+
+    def close(self):
+        """書き込み待ちの計測値を書き込んで終了する"""
+        self.queue.put(('close',))
+        self.join()
+
+    def run(self):
+        while True:
+            timeout = None if self.deadline is None else max(0.0, self.deadline - time.time())
+            try:
+                item = self.queue.get(timeout = timeout)
+            except queue.Empty:     # flush_interval経過
+                self.write_buffer()
+                continue
+
+            if item[0] == 'sample':
+                self.buffer.append(item[1:3])
+                if self.deadline is None:
+                    self.deadline = time.time() + self.flush_interval
+                if item[2] is not None:
+                    if self.minutes is not None:
+                        self.minutes.add(item[1], item[2])
+                    self.curr_power = item[2]
+                    if time.time() - self.curr_time >= self.curr_interval:
+                        self.write_curr()
+                if len(self.buffer) >= self.flush_count and not self.failing:
+                    self.write_buffer()
+            elif item[0] == 'call':
+                self.write_buffer()
+                self.close_file()
+                try:
+                    item[1](*item[2])
+                except Exception as err:
+                    sys.stdout.write('[Error]: log maintenance failed. ({!r})\n'.format(err))
+            else:   # 'flush', 'close'
+                self.write_buffer()
+                if item[0] == 'close':
+                    self.close_file()
+                    self.report_error(True)
+                    return
+
+    def write_buffer(self):
+        """書き込み待ちの計測値をセグメントファイルに書き込む"""
+        if self.curr_power is not None:
+            self.write_curr()
+        if not self.buffer:
+            self.deadline = None
+            return
+        try:
+            self.store.append(self.buffer)
+        except OSError:
+            self.error()
+            self.close_file()
+            if len(self.buffer) > self.max_buffer:
+                self.counter['dropped'] += len(self.buffer) - self.max_buffer
+                del self.buffer[:len(self.buffer) - self.max_buffer]
+            self.deadline = time.time() + self.flush_interval    # 次回に再試行
+            self.failing = True
+            return
+        self.counter['samples'] += len(self.buffer)
+        self.counter['flushes'] += 1
+        self.buffer = []
+        self.deadline = None
+        self.failing = False
+        self.report_error()
+
+    def write_curr(self):
+        """現在の瞬時電力ファイルを書き換える"""
+        power, self.curr_power = self.curr_power, None
+        self.curr_time = time.time()
+        if self.curr_filename is None:
+            return
+        try:
+            with open(self.curr_filename, 'w') as f:
+                f.write(str(power))
+        except OSError:
+            self.error()
+
+    def close_file(self):
+        try:
+            self.store.close()
+        except OSError:
+            self.error()
+
+    def error(self):
+        self.counter['errors'] += 1
+        self.error_count += 1
+        self.report_error()
+
+    def report_error(self, force = False):
+        """書き込みエラーをまとめて表示する"""
+        if not self.error_count:
+            return
+        if force or time.time() - self.error_time >= self.ERROR_REPORT_INTERVAL:
+            sys.stdout.write('[Error]: can not write to file. ({} times)\n'.format(self.error_count))
+            self.error_count = 0
+            self.error_time = time.time()
+
+    def stats(self):
+        """統計値"""
+        result = dict(self.counter)
+        result['pending'] = len(self.buffer)
+        return result
+
+
+class PowerMinuteLog:
+    """1日分の1分毎の瞬時電力平均値
+        計測値を受け取る毎に1分毎の合計と個数を更新する（セグメントファイルを読み直さずに平均値を求める）。
+    """
+
+    MINUTES = 60 * 24
+
+    def __init__(self, dt):
+        """コンストラクタ
+            dt: 対象日
+        """
+        self.reset(dt)
+
+    def reset(self, dt):
+        """対象日を変更し，全ての計測値を消去する"""
+        self.origin = EnergyLog.day_origin(dt)  # 0時0分のタイムスタンプ[s]
+        self.sums = array.array('q', bytes(8 * self.MINUTES))
+        self.counts = array.array('I', bytes(4 * self.MINUTES))
+
+    def add(self, ts, power):
+        """計測値を追加する
+            ts: タイムスタンプ[s], power: 瞬時電力[W]
+            return: True: 追加した, False: 対象日以外
+        """
+        minute = int((ts - self.origin) // 60)  # 00:00からの経過時間[分]
+        if not 0 <= minute < self.MINUTES:
+            return False
+        self.sums[minute] += power
+        self.counts[minute] += 1
+        return True
+
+    def load_segment(self, store):
+        """対象日のセグメントファイルの計測値を追加する
+            store: PowerSegmentStore
+            return: True: 成功（セグメントが無い場合を含む）, False: 失敗
+        """
+        try:
+            columns = store.read(self.origin)
+        except OSError:
+            return False
+        if columns:
+            no_data = store.NO_DATA
+            for ts, power in zip(*columns):
+                if power != no_data:
+                    self.add(ts, power)
+        return True
+
+    def summary(self):
+        """[[タイムスタンプ[s], 平均値[W] / None], ...]"""
+        return [[self.origin + 60 * minute, round(total / count) if count else None]
+                for minute, (total, count) in enumerate(zip(self.sums, self.counts))]
+
+
+class PowerDaysPublisher:
+    """1分毎の瞬時電力平均値をWEBサーバ用のJSONファイルにする
+        過去の日（確定した日）はJSONに変換した結果を保持し，今日の分だけ変換し直す。
+        全日分のファイルに加え，日別のファイルを書き込む（過去の日は変化したときのみ）。
+        ファイル形式(JSON): [[タイムスタンプ[ms], 平均値[W] / null], ...]
+        ファイルは一時ファイルに書いてから置き換える（WEBサーバが書き込み途中のファイルを読まない）。
+    """
+
+    def __init__(self, filename, store, day_format = None):
+        """コンストラクタ
+            filename: 全日分のファイル
+            store: 過去の日の1分毎の平均値を読み出すPowerSegmentStore / PowerRollupTier
+                   (mtime(day), minute_summary(day)を使う)
+            day_format: 日別ファイル名のstrftime()形式 (例) 'logs/pow_day_%Y%m%d.json', None: 書かない
+        """
+        self.filename = filename
+        self.store = store
+        self.day_format = day_format
+        self.segments = {}          # 過去の日 {0時0分のタイムスタンプ[s]: [セグメントの更新時刻, JSON]}
+        self.encoded = 0            # JSONに変換した日数
+
+    def encode(self, rows):
+        """[[タイムスタンプ[s], 平均値[W] / None], ...]をJSONにする"""
+        self.encoded += 1
+        return json.dumps([[int(row[0]) * 1000, None if row[1] is None else int(row[1])] for row in rows])
+
+    def closed_segment(self, day):
+        """過去の日のJSON（セグメントが更新されていなければ保持したものを使う, セグメントが無い日は全てnull）
+            return: [JSON, True: 変換し直した] / None: 読み込み失敗
+        """
+        mtime = self.store.mtime(day)
+        cached = self.segments.get(day)
+        if cached and cached[0] == mtime:
+            return cached[1], False
+        rows = self.store.minute_summary(day)
+        if rows is None:
+            return None
+        segment = self.encode(rows)
+        self.segments[day] = [mtime, segment]
+        return segment, True
+
+    def publish(self, days, today_rows):
+        """JSONファイルを書き込む
+            days: 過去の日 [0時0分のタイムスタンプ[s], ...] (古い順)
+            today_rows: 今日の[[タイムスタンプ[s], 平均値[W] / None], ...]
+            return: True: 成功, False: 失敗
+        """
+        segments = []
+        changed = []        # 日別ファイルを書き込む日 [[0時0分のタイムスタンプ[s], JSON], ...]
+        for day in days:
+            result = self.closed_segment(day)
+            if result is None:
+                return False
+            segments.append(result[0])
+            if result[1]:
+                changed.append([day, result[0]])
+        today = self.encode(today_rows)
+        segments.append(today)
+        changed.append([today_rows[0][0] if today_rows else None, today])
+
+        for key in [key for key in self.segments if key not in days]:
+            del self.segments[key]
+
+        ok = self.write(self.filename, '[' + ', '.join(segment[1:-1] for segment in segments if segment != '[]') + ']')
+        if self.day_format:
+            for ts, segment in changed:
+                if ts is not None:
+                    ok &= self.write(datetime.datetime.fromtimestamp(ts).strftime(self.day_format), segment)
+        return ok
+
+    @staticmethod
+    def write(filename, text):
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                f.write(text)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            return False
+        return True
+
+
+class PowerRollupTier:
+    """瞬時電力の集計値（1段分）: バケット毎の計測値の数, 最小, 最大, 合計（平均値 = 合計 / 数）
+        ファイル: directory + head + 段の名前 + '_' + 期間(fmt) + '.rollup' （期間毎, 固定長レコードを追記のみ）
+        ヘッダ(16byte): マジック'SEMR', バージョン, 予約, レコードサイズ, バケット[s], 期間の最初のタイムスタンプ[s]
+        レコード(24byte): バケットの最初のタイムスタンプ[s], 数, 最小[W], 最大[W], 合計[W], リトルエンディアン
+        バケットは0時0分から区切る（地方時）。計測値の無いバケットは書かない。
+    """
+
+    MAGIC = b'SEMR'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBBHII')
+    RECORD = struct.Struct('<IIiiq')
+    EXT = '.rollup'
+
+    def __init__(self, directory, name, bucket, fmt, days, head = 'pow_'):
+        """コンストラクタ
+            directory: ファイルのディレクトリ
+            name: 段の名前 (例) '1min'
+            bucket: バケットの長さ[s] (86400: 1日)
+            fmt: ファイルの期間（日付のstrftime()形式）(例) '%Y%m%d': 日別, '%Y%m': 月別
+            days: 保存日数
+            head: ファイル名の先頭
+        """
+        self.directory = directory
+        self.name = name
+        self.bucket = bucket
+        self.fmt = fmt
+        self.days = days
+        self.head = head + name + '_'
+
+        self.day = None             # bucket_start()で最後に使った日（0時0分のタイムスタンプ[s]）
+        self.day_end = None         # 翌日0時0分のタイムスタンプ[s]
+
+    def key(self, ts):
+        """tsを含むファイルの期間"""
+        return datetime.datetime.fromtimestamp(ts).strftime(self.fmt)
+
+    def path(self, key):
+        return os.path.join(self.directory, self.head + key + self.EXT)
+
+    def keys(self):
+        """ファイルがある期間 [期間, ...] (古い順)"""
+        result = []
+        for filename in glob.glob(os.path.join(self.directory, self.head + '*' + self.EXT)):
+            key = os.path.basename(filename)[len(self.head):-len(self.EXT)]
+            try:
+                datetime.datetime.strptime(key, self.fmt)
+            except ValueError:
+                continue
+            result.append(key)
+        return sorted(result)
+
+    def mtime(self, ts):
+        """tsを含むファイルの更新時刻, ファイルが無い場合はNone"""
+        try:
+            return os.stat(self.path(self.key(ts))).st_mtime
+        except OSError:
+            return None
+
+    def bucket_start(self, ts):
+        """tsを含むバケットの最初のタイムスタンプ[s]"""
+        if self.day is None or not self.day <= ts < self.day_end:
+            dt = datetime.datetime.fromtimestamp(ts)
+            self.day = EnergyLog.day_origin(dt)
+            self.day_end = EnergyLog.day_origin(dt + datetime.timedelta(days = 1))
+        if self.bucket >= 86400:
+            return self.day
+        return self.day + int(ts - self.day) // self.bucket * self.bucket
+
+    def read_file(self, key):
+        """ファイルを読み出す
+            return: [(バケット, 数, 最小, 最大, 合計), ...], ファイルが無い場合は[]
+            raise: OSError
+        """
+        filename = self.path(key)
+        if not os.path.exists(filename):
+            return []
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if len(data) < self.HEADER.size or self.HEADER.unpack_from(data)[:2] != (self.MAGIC, self.VERSION):
+            raise OSError('bad rollup header: ' + filename)
+        count = (len(data) - self.HEADER.size) // self.RECORD.size    # 書き込み途中のレコードは読まない
+        return list(self.RECORD.iter_unpack(data[self.HEADER.size:self.HEADER.size + count * self.RECORD.size]))
+
+    def read(self, start = None, end = None):
+        """start <= バケット < end のレコード [(バケット, 数, 最小, 最大, 合計), ...] (古い順)
+            raise: OSError
+        """
+        first = None if start is None else self.key(start)
+        last = None if end is None else self.key(end - 1)
+        records = []
+        for key in self.keys():
+            if (first is None or first <= key) and (last is None or key <= last):
+                records.extend(rec for rec in self.read_file(key)
+                               if (start is None or start <= rec[0]) and (end is None or rec[0] < end))
+        return records
+
+    def last_end(self):
+        """最後のレコードのバケットの終わり（次のバケットの最初）のタイムスタンプ[s], レコードが無い場合はNone
+            raise: OSError
+        """
+        for key in reversed(self.keys()):
+            records = self.read_file(key)
+            if records:
+                return self.bucket_start(records[-1][0] + self.bucket)
+        return None
+
+    def append(self, records):
+        """レコードを追記する（期間が変わったら次のファイルに書く）
+            records: [[バケット, 数, 最小, 最大, 合計], ...] (古い順)
+            raise: OSError
+        """
+        groups = {}
+        for rec in records:
+            groups.setdefault(self.key(rec[0]), []).append(rec)
+        for key, recs in groups.items():
+            filename = self.path(key)
+            if not os.path.exists(filename):
+                origin = int(datetime.datetime.strptime(key, self.fmt).timestamp())
+                with open(filename, 'wb') as f:
+                    f.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0, self.RECORD.size, self.bucket, origin))
+            with open(filename, 'r+b') as f:
+                size = os.fstat(f.fileno()).st_size
+                f.truncate(size - (size - self.HEADER.size) % self.RECORD.size)    # 書き込み途中で止まった場合
+                f.seek(0, os.SEEK_END)
+                f.write(b''.join(self.RECORD.pack(*rec) for rec in recs))
+
+    def prune(self, now):
+        """保存日数より古いファイルを削除する
+            now: 現在のタイムスタンプ[s]
+            return: 削除したファイルの数
+            raise: OSError
+        """
+        oldest = EnergyLog.day_origin(datetime.datetime.fromtimestamp(now) - datetime.timedelta(days = self.days - 1))
+        count = 0
+        for key in self.keys():
+            records = self.read_file(key)
+            last = records[-1][0] if records else int(datetime.datetime.strptime(key, self.fmt).timestamp())
+            if last < oldest:
+                os.remove(self.path(key))
+                count += 1
+        return count
+
+    def summary(self, start = None, end = None):
+        """[[タイムスタンプ[s], 平均値[W], 最小[W], 最大[W]], ...]
+            raise: OSError
+        """
+        return [[ts, round(total / count), low, high] for ts, count, low, high, total in self.read(start, end)]
+
+    def minute_summary(self, day):
+        """dayのバケット毎の平均値（計測値の無いバケットはNone）[[タイムスタンプ[s], 平均値[W] / None], ...]
+            読み込み失敗はNone
+        """
+        day_end = EnergyLog.day_origin(datetime.datetime.fromtimestamp(day) + datetime.timedelta(days = 1))
+        count = (day_end - day) // self.bucket
+        sums = [0] * count
+        counts = [0] * count
+        try:
+            for rec in self.read(day, day_end):
+                i = (rec[0] - day) // self.bucket
+                sums[i] += rec[4]
+                counts[i] += rec[1]
+        except OSError:
+            return None
+        return [[day + self.bucket * i, round(total / n) if n else None]
+                for i, (total, n) in enumerate(zip(sums, counts))]
+
+
+class PowerRollup:
+    """瞬時電力の多段集計 セグメントファイル(PowerSegmentStore) -> 1分 -> 30分 -> 1日
+        細かい段の確定したバケット（update()のnowより前）だけを次の段に集計する。
+        前回集計した終わりから続けるので，集計済みの期間を読み直さない（位置は状態ファイルに記録する）。
+        段毎に保存日数を設定し，古いファイルを削除する。
+    """
+
+    TIERS = (('1min', 60, '%Y%m%d'), ('30min', 30 * 60, '%Y%m'), ('1day', 86400, '%Y'))  # (名前, バケット[s], 期間)
+
+    def __init__(self, store, directory, retention, state_filename):
+        """コンストラクタ
+            store: 瞬時電力のPowerSegmentStore
+            directory: 集計値ファイルのディレクトリ
+            retention: 段毎の保存日数 {段の名前: 日数}
+            state_filename: 集計済みの位置を記録するファイル(JSON)
+        """
+        self.store = store
+        self.tiers = [PowerRollupTier(directory, name, bucket, fmt, retention[name]) for name, bucket, fmt in self.TIERS]
+        self.tier = {tier.name: tier for tier in self.tiers}
+        self.state_filename = state_filename
+        self.state = self.load_state()      # 段毎の集計済みの終わりのタイムスタンプ[s] {段の名前: タイムスタンプ[s]}
+
+    def load_state(self):
+        try:
+            with open(self.state_filename) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {name: ts for name, ts in state.items() if name in self.tier and isinstance(ts, int)} \
+            if isinstance(state, dict) else {}
+
+    def update(self, now):
+        """now（タイムスタンプ[s]）までに確定したバケットを集計する
+            return: 段毎に追加したバケットの数 {段の名前: 数}
+            raise: OSError
+        """
+        result = {}
+        finer = None
+        for tier in self.tiers:
+            end = tier.bucket_start(now)
+            start = max([ts for ts in (self.state.get(tier.name), tier.last_end()) if ts is not None],
+                        default = None)    # 状態ファイルより後のレコードがある場合（保存前に停止）はその続きから
+            if start is not None and start >= end:
+                result[tier.name] = 0
+            else:
+                if finer is None:
+                    records = self.rollup_segments(tier, start, end)
+                else:
+                    records = self.rollup_records(tier, finer.read(start, end))
+                tier.append(records)
+                self.state[tier.name] = end
+                result[tier.name] = len(records)
+            finer = tier
+        if not PowerDaysPublisher.write(self.state_filename, json.dumps(self.state)):
+            raise OSError('can not write: ' + self.state_filename)
+        return result
+
+    def rollup_segments(self, tier, start, end):
+        """セグメントファイルの start <= タイムスタンプ < end の計測値を集計する
+            return: [[バケット, 数, 最小, 最大, 合計], ...]
+        """
+        buckets = []
+        no_data = self.store.NO_DATA
+        for day in self.store.days():
+            if day >= end:
+                break
+            if start is not None and \
+                    EnergyLog.day_origin(datetime.datetime.fromtimestamp(day) + datetime.timedelta(days = 1)) <= start:
+                continue
+            columns = self.store.read(day)
+            if not columns:
+                continue
+            times, watts = columns
+            i = 0 if start is None else bisect.bisect_left(times, start)
+            j = bisect.bisect_left(times, end)
+            rec = None
+            for ts, power in zip(times[i:j], watts[i:j]):
+                if power == no_data:
+                    continue
+                ts = tier.bucket_start(ts)
+                if rec is None or rec[0] != ts:
+                    rec = [ts, 1, power, power, power]
+                    buckets.append(rec)
+                else:
+                    rec[1] += 1
+                    rec[2] = min(rec[2], power)
+                    rec[3] = max(rec[3], power)
+                    rec[4] += power
+        return buckets
+
+    def rollup_records(self, tier, records):
+        """細かい段のレコードを集計する
+            return: [[バケット, 数, 最小, 最大, 合計], ...]
+        """
+        buckets = []
+        rec = None
+        for ts, count, low, high, total in records:
+            ts = tier.bucket_start(ts)
+            if rec is None or rec[0] != ts:
+                rec = [ts, count, low, high, total]
+                buckets.append(rec)
+            else:
+                rec[1] += count
+                rec[2] = min(rec[2], low)
+                rec[3] = max(rec[3], high)
+                rec[4] += total
+        return buckets
+
+    def prune(self, now):
+        """段毎に保存日数より古いファイルを削除する
+            return: 削除したファイルの数
+            raise: OSError
+        """
+        return sum(tier.prune(now) for tier in self.tiers)
+
+    def publish(self, name, filename, days, now):
+        """段の集計値をWEBサーバ用のJSONファイルにする
+            ファイル形式(JSON): [[タイムスタンプ[ms], 平均値[W], 最小[W], 最大[W]], ...]
+            name: 段の名前, days: 日数, now: 現在のタイムスタンプ[s]
+            return: True: 成功, False: 失敗
+        """
+        start = EnergyLog.day_origin(datetime.datetime.fromtimestamp(now) - datetime.timedelta(days = days - 1))
+        try:
+            rows = self.tier[name].summary(start)
+        except OSError:
+            return False
+        return PowerDaysPublisher.write(filename, json.dumps([[ts * 1000, avg, low, high] for ts, avg, low, high in rows]))
@@ -11,3 +11,9 @@ SEM_ROUTEB_ID = '00000000000000000000000000000000'
 SEM_PASSWORD = 'XXXXXXXXXXXX'
 SEM_INTERVAL = 3	# 瞬時電力取得間隔[s]
 SEM_DURATION = 6	# アクティブスキャンduration (通常は変更の必要なし)
+SEM_LOG_FLUSH_COUNT = 20	# 瞬時電力ログをまとめて書き込む計測値の数
+SEM_LOG_FLUSH_INTERVAL = 10	# 瞬時電力ログを書き込むまでの最大時間[s]
+SEM_RAW_DAYS = 10	# 瞬時電力の全計測値の保存日数
+SEM_ROLLUP_1MIN_DAYS = 90	# 1分毎の集計値(最小, 最大, 平均)の保存日数
+SEM_ROLLUP_30MIN_DAYS = 730	# 30分毎の集計値の保存日数
+SEM_ROLLUP_1DAY_DAYS = 3650	# 1日毎の集計値の保存日数
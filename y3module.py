@@ -3,10 +3,14 @@
 # y3module.py
 #
 # Wi-SUNモジュールBP35A1(ROHM) 通信クラス Y3Module
+# Wi-SUNモジュールBP35A1(ROHM) 通信クラス (asyncio版) AsyncY3Module
 #
 # Copyright(C) 2016 pi@blue-black.ink
 #
 
+import asyncio
+import bisect
+import collections
 import datetime
 import serial
 import threading
@@ -14,30 +18,464 @@ import time
 import sys
 
 
+class Y3MessageQueue:
+    """受信メッセージ用キュー（サイズ上限付き）"""
+    
+    DROP_OLDEST = 'drop_oldest'     # 満杯時に最も古いメッセージを捨てる
+    DROP_NEWEST = 'drop_newest'     # 満杯時に新しいメッセージを捨てる
+    
+    def __init__(self, maxlen = 256, overflow = DROP_OLDEST):
+        """コンストラクタ
+            maxlen: 最大メッセージ数
+            overflow: 満杯時の動作 DROP_OLDEST / DROP_NEWEST
+        """
+        if maxlen < 1:
+            raise ValueError(maxlen)
+        if overflow not in (self.DROP_OLDEST, self.DROP_NEWEST):
+            raise ValueError(overflow)
+        
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        
+        self.high_water = 0     # 最大滞留数
+        self.dropped = 0        # 破棄したメッセージ数
+
+    def __len__(self):
+        with self.cond:
+            return len(self.queue)
+
+    def put(self, msg):
+        """メッセージを追加
+            return: True: 追加した, False: 満杯のため破棄した
+        """
+        with self.cond:
+            if len(self.queue) >= self.maxlen:
+                self.dropped += 1
+                if self.overflow == self.DROP_NEWEST:
+                    return False
+                self.queue.popleft()
+            
+            self.queue.append(msg)
+            if len(self.queue) > self.high_water:
+                self.high_water = len(self.queue)
+            self.cond.notify()
+            return True
+
+    def get(self, timeout = 0):
+        """メッセージを取り出す
+            timeout: 受信待ち時間[s], 0: 待たない, None: 受信するまで待つ
+            return: メッセージ, タイムアウト時はFalse
+        """
+        with self.cond:
+            if timeout != 0:
+                self.cond.wait_for(lambda: self.queue, timeout)
+            return self.queue.popleft() if self.queue else False
+
+    def stats(self):
+        """キューの状態"""
+        with self.cond:
+            return {'size': len(self.queue), 'maxlen': self.maxlen, 'overflow': self.overflow,
+                    'high_water': self.high_water, 'dropped': self.dropped}
+
+
+class Y3Stats:
+    """Y3Moduleの統計（コマンド毎の応答時間ヒストグラム，カウンタ）"""
+
+    # 応答時間ヒストグラムの区間上限[s]（最後の区間は上限無し）
+    LATENCY_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """統計をクリア"""
+        with self.lock:
+            self.start_time = time.monotonic()
+            self.commands = {}      # {コマンド: {'count', 'timeout', 'fail', 'error', 'total', 'min', 'max', 'hist'}}
+            self.received = collections.Counter()   # COMMAND毎の受信行数
+            self.solicited = collections.Counter()  # COMMAND毎の受信待ちデータ・要求への応答として受け取った行数
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def command(self, name):
+        """コマンド毎の統計（lockを取得して呼ぶこと）"""
+        cmd = self.commands.get(name)
+        if cmd is None:
+            cmd = {'count': 0, 'timeout': 0, 'fail': 0, 'error': 0,
+                   'total': 0.0, 'min': None, 'max': None,
+                   'hist': [0] * (len(self.LATENCY_BUCKETS) + 1)}
+            self.commands[name] = cmd
+        return cmd
+
+    def add_latency(self, name, latency):
+        """送信から最後の受信待ちデータまでの時間[s]を記録"""
+        with self.lock:
+            cmd = self.command(name)
+            cmd['count'] += 1
+            cmd['total'] += latency
+            if cmd['min'] is None or latency < cmd['min']:
+                cmd['min'] = latency
+            if cmd['max'] is None or latency > cmd['max']:
+                cmd['max'] = latency
+            cmd['hist'][bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+
+    def add_error(self, name, key):
+        """エラーを記録
+            key: 'timeout': 受信待ちタイムアウト, 'fail': FAIL応答, 'error': UART書き込みエラー
+        """
+        with self.lock:
+            self.command(name)[key] += 1
+
+    def add_tx(self, size):
+        with self.lock:
+            self.bytes_out += size
+
+    def add_rx(self, size):
+        with self.lock:
+            self.bytes_in += size
+
+    def add_line(self, msg_list):
+        with self.lock:
+            self.received[msg_list.COMMAND] += 1
+
+    def add_solicited(self, msg_list):
+        """受信待ちデータ，または要求への応答として受け取った行を記録（サブクラスの振り分けからも呼ぶ）"""
+        with self.lock:
+            self.solicited[msg_list.COMMAND] += 1
+
+    def snapshot(self):
+        """統計のスナップショット"""
+        with self.lock:
+            commands = {}
+            for name, cmd in self.commands.items():
+                res = dict(cmd)
+                res['hist'] = list(zip(self.LATENCY_BUCKETS + (None,), cmd['hist']))   # [(区間上限[s], 回数), ...]
+                res['mean'] = cmd['total'] / cmd['count'] if cmd['count'] else None
+                commands[name] = res
+            return {'elapsed': time.monotonic() - self.start_time,
+                    'bytes_in': self.bytes_in,
+                    'bytes_out': self.bytes_out,
+                    'commands': commands,
+                    'unsolicited': dict(self.received - self.solicited)}
+
+
+class Y3Capture:
+    """UART送受信データの記録ファイル
+        1行1レコード: '<時刻[s]> <T: 送信 / R: 受信> <データ>'
+        時刻: 記録開始からの経過時間(time.monotonic())
+        データ: バイト列をエスケープした文字列（ASCIIはそのまま，CR, LF, バイナリは\\r, \\n, \\xNN）
+    """
+
+    HEADER = '# y3capture 1\n'
+    TX = 'T'
+    RX = 'R'
+
+    def __init__(self, filename):
+        """記録ファイルを作成"""
+        self.lock = threading.Lock()
+        self.file = open(filename, 'w', buffering=1)    # 行バッファリング（異常終了時も記録を残す）
+        self.file.write(self.HEADER)
+        self.start_time = time.monotonic()
+
+    @staticmethod
+    def encode(data):
+        return bytes(data).decode('latin-1').encode('unicode_escape').decode('ascii')
+
+    @staticmethod
+    def decode(text):
+        return text.encode('ascii').decode('unicode_escape').encode('latin-1')
+
+    def record(self, direction, data, ts = None):
+        """送受信データを記録
+            direction: TX / RX
+            ts: 送受信時刻(time.monotonic()), None: 現在時刻
+        """
+        if ts is None:
+            ts = time.monotonic()
+        with self.lock:
+            if self.file:
+                self.file.write('{:.6f} {} {}\n'.format(ts - self.start_time, direction, self.encode(data)))
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    @classmethod
+    def load(cls, filename):
+        """記録ファイル読み込み
+            return: [[時刻[s], TX / RX, データ(bytes)], ...]
+        """
+        records = []
+        with open(filename) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line or line.startswith('#'):
+                    continue
+                ts, direction, text = line.split(' ', 2)
+                if direction not in (cls.TX, cls.RX):
+                    raise ValueError(line)
+                records.append([float(ts), direction, cls.decode(text)])
+        return records
+
+
+class Y3LineFramer:
+    """UART受信データの行分割
+        受信データをまとめてバッファに追加し，CRLFで行に分割する。
+        バイナリ形式のERXUDPはデータ長分のデータを1行とする（データ中のCRLFで分割しない）。
+        各行には受信時刻(time.monotonic())を付ける。
+    """
+
+    def __init__(self):
+        self.buf = bytearray()              # 行に分割する前の受信データ
+        self.lines = collections.deque()    # [受信時刻, 行(bytes), バイナリ形式ERXUDPのデータ(bytes) / None]
+
+    def __len__(self):
+        return len(self.lines)
+
+    @staticmethod
+    def split_erxudp_header(buf, start = 0):
+        """バイナリ形式のERXUDPのヘッダを分割する
+            buf: 受信データ, buf[start:]が'ERXUDP 'で始まること
+            return: [ヘッダの終わり(データ開始位置), データ長]，ヘッダを受信途中の場合はNone
+        """
+        idx = start
+        for i in range(8):      # ERXUDP～DATALENの8列
+            idx = buf.find(b' ', idx) + 1
+            if idx == 0:
+                return None
+        return [idx, int(buf[idx - 5:idx - 1], base=16)]    # DATALEN: 4桁の16進数
+
+    def feed(self, data, ts, binary = False):
+        """受信データを追加し，行に分割する
+            data: 受信データ
+            ts: 受信時刻
+            binary: ERXUDPがバイナリ形式
+            return: 分割済みの行数
+        """
+        buf = self.buf
+        buf += data
+        pos = 0
+        while True:
+            if binary and buf.startswith(b'ERXUDP ', pos):
+                header = self.split_erxudp_header(buf, pos)
+                if header is None:
+                    break   # ヘッダ受信途中
+                idx, datalen = header
+                end = idx + datalen
+                if len(buf) < end + 2:
+                    break   # データ受信途中
+                self.lines.append([ts, bytes(buf[pos:idx - 1]), bytes(buf[idx:end])])
+                pos = end + 2
+                continue
+
+            idx = buf.find(b'\r\n', pos)
+            if idx < 0:
+                break
+            if idx > pos:
+                self.lines.append([ts, bytes(buf[pos:idx]), None])
+            pos = idx + 2
+
+        if pos:
+            del buf[:pos]   # 分割済みのデータをまとめて削除
+        return len(self.lines)
+
+    def pop(self):
+        """分割済みの行を1つ取り出す
+            return: [受信時刻, 行(bytes), バイナリ形式ERXUDPのデータ(bytes) / None]，無い場合はNone
+        """
+        return self.lines.popleft() if self.lines else None
+
+    @staticmethod
+    def to_message(line, payload):
+        """行をパースしてメッセージにする
+            return: メッセージ, 空行の場合はFalse
+        """
+        if payload is not None:     # バイナリ形式のERXUDP
+            return Y3ErxudpMessage(line.decode().split(), payload)
+        msg = line.decode().strip()
+        return Y3Module.parse_message(msg) if msg else False
+
+
+class Y3Message:
+    """受信メッセージ（スロット付きレコード）
+        属性(COMMAND, MESSAGE, ...)でアクセスする。互換性のため msg.COMMAND, 'KEY' in msg も使える。
+        値の無い項目は属性を設定しない。
+        TIME: 受信時刻(time.monotonic())，UARTから読み込んだメッセージのみ
+    """
+    __slots__ = ('COMMAND', 'MESSAGE', 'TIME')
+
+    def __init__(self, command, message = None):
+        self.COMMAND = command
+        if message:
+            self.MESSAGE = message
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return isinstance(key, str) and hasattr(self, key)
+
+    def get(self, key, default = None):
+        return getattr(self, key, default) if isinstance(key, str) else default
+
+    def __repr__(self):
+        items = []
+        for cls in type(self).__mro__:
+            for key in getattr(cls, '__slots__', ()):
+                if hasattr(self, key):
+                    items.append('{}={!r}'.format(key, getattr(self, key)))
+        return '{}({})'.format(type(self).__name__, ', '.join(items))
+
+
+class Y3EventMessage(Y3Message):
+    """EVENT"""
+    __slots__ = ('SENDER', 'PARAM')
+
+    def __init__(self, cols):
+        self.COMMAND = cols[0] + ' ' + cols[1]
+        self.SENDER = cols[2]
+        if len(cols) == 4:
+            self.PARAM = cols[3]
+
+
+class Y3ErxudpMessage(Y3Message):
+    """ERXUDP
+        DATA: ASCII形式: 16進文字列, バイナリ形式: bytes
+    """
+    __slots__ = ('SENDER', 'DEST', 'RPORT', 'LPORT', 'SENDERLLA', 'SECURED', 'DATALEN', 'DATA')
+
+    def __init__(self, cols, data):
+        self.COMMAND = 'ERXUDP'
+        self.SENDER = cols[1]
+        self.DEST = cols[2]
+        self.RPORT = int(cols[3], base=16)
+        self.LPORT = int(cols[4], base=16)
+        self.SENDERLLA = cols[5]
+        self.SECURED = int(cols[6], base=16)
+        self.DATALEN = int(cols[7], base=16)
+        self.DATA = data
+
+
+class Y3ErxtcpMessage(Y3Message):
+    """ERXTCP"""
+    __slots__ = ('SENDER', 'RPORT', 'LPORT', 'DATALEN', 'DATA')
+
+    def __init__(self, cols):
+        self.COMMAND = 'ERXTCP'
+        self.SENDER = cols[1]
+        self.RPORT = int(cols[2], base=16)
+        self.LPORT = int(cols[3], base=16)
+        self.DATALEN = int(cols[4], base=16)
+        self.DATA = cols[5]
+
+
+class Y3EtcpMessage(Y3Message):
+    """ETCP"""
+    __slots__ = ('STATUS', 'HANDLE', 'IPADDR', 'RPORT', 'LPORT')
+
+    def __init__(self, cols):
+        self.COMMAND = 'ETCP'
+        self.STATUS = int(cols[1], base=16)
+        self.HANDLE = int(cols[2], base=16)
+        if self.STATUS == 1:
+            self.IPADDR = cols[3]
+            self.RPORT = int(cols[4], base=16)
+            self.LPORT = int(cols[5], base=16)
+
+
+class Y3RegMessage(Y3Message):
+    """ESREG, SKSREG(ローカルエコー)"""
+    __slots__ = ('REG', 'VAL')
+
+    def __init__(self, cols):
+        self.COMMAND = cols[0]
+        if cols[0] == 'ESREG':
+            self.VAL = cols[1]
+        else:
+            self.REG = cols[1]
+            self.VAL = cols[2]
+
+
+class Y3ActiveScanMessage(Y3Message):
+    """アクティブスキャン結果 (EPANDESCに続く 'Channel:21' などの行)
+        KEY: 'Channel', 'Channel Page', 'Pan ID', 'Addr', 'LQI', 'PairID'
+        互換性のため msg['Channel'], 'Channel' in msg でもアクセスできる。
+    """
+    __slots__ = ('KEY', 'VALUE')
+
+    HEX_KEYS = {'Channel', 'Channel Page', 'Pan ID', 'LQI'}    # 値が16進数の項目
+
+    def __init__(self, key, value):
+        self.COMMAND = 'ACTIVESCAN'
+        self.KEY = key
+        self.VALUE = int(value, base=16) if key in self.HEX_KEYS else value
+
+    def __getitem__(self, key):
+        if key == self.KEY:
+            return self.VALUE
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        return key == self.KEY or super().__contains__(key)
+
+
 class Y3Module(threading.Thread):
     """Wi-SUN Module BP35A1(ROHM) 通信クラス"""
-    def __init__(self):
-        """コンストラクタ"""
+
+    # 受信メッセージの先頭の語によるパーサー振り分け表 (ERXUDPはparse_message()で先に処理)
+    MESSAGE_PARSERS = {
+        'OK':       lambda cols: Y3Message('OK', cols[1:]),
+        'EVENT':    Y3EventMessage,
+        'ERXTCP':   Y3ErxtcpMessage,
+        'ETCP':     Y3EtcpMessage,
+        'ESREG':    Y3RegMessage,
+        'SKSREG':   Y3RegMessage,       # ローカルエコー停止前のローカルエコー対策: 'SKSREG SFE 0'
+        'EPANDESC': lambda cols: Y3Message('EPANDESC'),
+        'EEDSCAN':  lambda cols: Y3Message('EEDSCAN')}
+
+    # アクティブスキャン結果の項目
+    ACTIVESCAN_KEYS = frozenset(('Channel', 'Channel Page', 'Pan ID', 'Addr', 'LQI', 'PairID'))
+
+    UART_POLL_INTERVAL = 0.02   # UART受信待ちの周期[s] (run()の終了判定の周期)
+
+    def __init__(self, queue_size = 256, queue_overflow = Y3MessageQueue.DROP_OLDEST):
+        """コンストラクタ
+            queue_size: 受信メッセージキューの最大メッセージ数
+            queue_overflow: キュー満杯時の動作 Y3MessageQueue.DROP_OLDEST / DROP_NEWEST
+        """
         super().__init__()
         self.Y3_UDP_ECHONET_PORT = 3610 # ECHONET UDPポート
         self.Y3_UDP_PANA_PORT = 716     # PANAポート
         self.Y3_TCP_ECHONET_PORT = 3610 # TCPポート
         
-        self.msg_list_queue = []        # 受信データ用リスト
+        self.msg_list_queue = Y3MessageQueue(queue_size, queue_overflow)    # 受信データ用キュー
         self.term_flag = False          # run()の終了フラグ
 
         self.uart_hdl = None            # UART
         self.uart_dev = None
         self.uart_baud = 9600
+        self.rx_binary = False          # ERXUDPのデータ形式 True: バイナリ, False: ASCII
+        self.framer = Y3LineFramer()    # 受信データの行分割
 
         self.search = {                 # write()用, UART送信後の受信待ちデータ
             'search_words': [],             # UART送信後の受信待ちデータリスト
             'ignore_intermidiate': False,   # 途中の受信データを無視する
             'found_word_list': [],          # 受け取った受信待ちデータリスト
-            'start_time': None,             # UART送信時のtime
-            'timeout': 0}                   # 設定タイムアウト時間[s]
+            'start_time': None,             # UART送信時のtime.monotonic()
+            'timeout': 0,                   # 設定タイムアウト時間[s]
+            'command': None}                # 送信コマンド名（統計用）
 
-        self.msg_list_lock = threading.Lock()   # msg_listの排他制御用
+        self.search_cond = threading.Condition()    # write()の受信待ち用, searchの排他制御を兼ねる
+        self.y3_stats = Y3Stats()       # 統計
+        self.capture = None             # UART送受信データの記録 (Y3Capture)
 
 
     def set_opt(self, flag):
@@ -46,10 +484,11 @@ class Y3Module(threading.Thread):
                   False: Binary
         """
         current = self.get_opt()
+        self.rx_binary = not flag       # 応答'OK'はASCIIなので，変更前に設定しておく
         if flag and not current:        # 変更無しの場合はモジュールに書き込まない（FLASHへの書き込み制限）
-            self.write(b'WOPT 01\r\n', ['OK 01'])
+            self.write(b'WOPT 01\r\n', ['OK'])
         elif not flag and current:
-            self.write(b'WOPT 00\r\n', ['OK 00'])
+            self.write(b'WOPT 00\r\n', ['OK'])
         return True
 
 
@@ -59,7 +498,9 @@ class Y3Module(threading.Thread):
                    False: Binary
         """
         res = self.write(b'ROPT\r\n', ['OK'])
-        return True if res[0]['MESSAGE'][0] == '01' else False
+        result = True if res[0].MESSAGE[0] == '01' else False
+        self.rx_binary = not result
+        return result
 
 
     def set_echoback_off(self):
@@ -95,7 +536,7 @@ class Y3Module(threading.Thread):
     def get_tx_limit(self):
         """送信制限フラグ取得"""
         res = self.write(b'SKSREG SFB\r\n' , ['ESREG', 'OK'])
-        result = True if res[0]['VAL'][0] == '1' else False
+        result = True if res[0].VAL[0] == '1' else False
         return result
 
 
@@ -131,7 +572,7 @@ class Y3Module(threading.Thread):
         res = self.write(b'SKJOIN ' + ip6.encode() + b'\r\n', [['EVENT 24', 'EVENT 25', 'FAIL ER10']], 
                          ignore = True, timeout = 10)
         try:
-            result = True if res[0]['COMMAND'] == 'EVENT 25' else False
+            result = True if res[0].COMMAND == 'EVENT 25' else False
             return result
         except:     # IndexErrorが発生するときのための暫定処理。要検討
             result = False
@@ -142,7 +583,7 @@ class Y3Module(threading.Thread):
         """PaCをリスタート"""
         res = self.write(b'SKREJOIN\r\n', [['EVENT 24', 'EVENT 25', 'FAIL ER10']], ignore = True, timeout = 10)
         try:
-            result = True if res[0]['COMMAND'] == 'EVENT 25' else False
+            result = True if res[0].COMMAND == 'EVENT 25' else False
             return result
         except:     # IndexErrorが発生するときのための暫定処理。要検討
             result = False
@@ -151,7 +592,7 @@ class Y3Module(threading.Thread):
     def pac_terminate(self):
         """PANAセッションを終了する"""
         res = self.write(b'SKTERM\r\n', [['OK', 'FAIL ER10']], ignore = True, timeout = 10)
-        if res[0]['COMMAND'] == 'OK':
+        if res[0].COMMAND == 'OK':
             return True
         else:
             return False
@@ -160,7 +601,7 @@ class Y3Module(threading.Thread):
     def get_ip6(self, add):
         """IP6アドレス習得"""
         res = self.write(b'SKLL64 ' + add.encode() + b'\r\n', ['UNKNOWN'])
-        return res[0]['MESSAGE'][0]
+        return res[0].MESSAGE[0]
 
 
     def tcp_connect(self, ip6, rport, lport):
@@ -174,14 +615,14 @@ class Y3Module(threading.Thread):
     def tcp_disconnect(self, handle):
         """TCPコネクション停止"""
         res = self.write(b'SKCLOSE ' + str(handle).encode() + b'\r\n', ['ETCP'])
-        return res[0]['STATUS'] == 3
+        return res[0].STATUS == 3
 
 
     def tcp_send(self, handle, message):
         """TCPで送信"""
         len_bt =' {:04X} '.format(len(message)).encode()         
         res = self.write(b'SKSEND ' + str(handle).encode() + len_bt + message, ['ETCP'])
-        return res[0]['STATUS'] == 5
+        return res[0].STATUS == 5
 
 
     def udp_send(self, handle, ip6, security, port, message):
@@ -192,7 +633,7 @@ class Y3Module(threading.Thread):
         res = self.write(b'SKSENDTO ' + str(handle).encode() + b' ' + ip6.encode() + port_bt + 
                          sec_bt + len_bt + message, ['EVENT 21', 'OK'])
 
-        if res[0]['PARAM'] == '01':
+        if res[0].PARAM == '01':
             sys.stdout.write('[Error]: UDP transmission.\n')
             if self.get_tx_limit():
                 sys.stdout.write('[Error]: TX limit.\n')
@@ -205,14 +646,8 @@ class Y3Module(threading.Thread):
         """EDスキャン"""
         bd = '{:X}'.format(duration).encode()
         self.write(b'SKSCAN 0 FFFFFFFF ' + bd + b'\r\n', [['EEDSCAN'], ['OK']])
-        res = []
-        while True:
-            if self.get_queue_size():
-                msg = self.dequeue_message()
-                res = msg['MESSAGE']
-                break
-            else:
-                time.sleep(0.01)
+        msg = self.dequeue_message(timeout = None)
+        res = msg.MESSAGE
 
         lqi_list = []
         for i in range(0, len(res), 2):
@@ -231,30 +666,18 @@ class Y3Module(threading.Thread):
 
         try:
             while not scan_end:
-                if self.get_queue_size():
-                    msg_list = self.dequeue_message()
-                    if msg_list['COMMAND'] == 'EVENT 20':
+                msg_list = self.dequeue_message(timeout = 0.5)  # Ctrl+cを受け付けるため0.5s毎に戻る
+                if msg_list:
+                    if msg_list.COMMAND == 'EVENT 20':
                         pass    # beacon 受信
-                    elif msg_list['COMMAND'] == 'EPANDESC':
+                    elif msg_list.COMMAND == 'EPANDESC':
                         channel = {}
-                    elif msg_list['COMMAND'] == 'ACTIVESCAN':
-                        if 'Channel' in msg_list:
-                            channel['Channel'] = msg_list['Channel']
-                        elif 'Channel Page' in msg_list:
-                            channel['Channel Page'] = msg_list['Channel Page']
-                        elif 'Pan ID' in msg_list:
-                            channel['Pan ID'] = msg_list['Pan ID']
-                        elif 'Addr' in msg_list:
-                            channel['Addr'] = msg_list['Addr']
-                        elif 'LQI' in msg_list:
-                            channel['LQI'] = msg_list['LQI']
-                        elif 'PairID' in msg_list:
-                            channel['PairID'] = msg_list['PairID']
+                    elif msg_list.COMMAND == 'ACTIVESCAN':
+                        channel[msg_list.KEY] = msg_list.VALUE
+                        if msg_list.KEY == 'PairID':
                             channel_list.append(channel)
-                    elif msg_list['COMMAND'] == 'EVENT 22':
+                    elif msg_list.COMMAND == 'EVENT 22':
                         scan_end = True
-                else:
-                    time.sleep(0.01)
         except KeyboardInterrupt:
             channel_list = False   # スキャンキャンセル
 
@@ -263,147 +686,53 @@ class Y3Module(threading.Thread):
 
     @staticmethod
     def parse_message(msg):
-        """受信メッセージのパーサー"""
-        msg_list = {}
-
-        if msg.startswith('Channel Page'):
-            msg_list['COMMAND'] = 'ACTIVESCAN'
-            cols = msg.split(':')
-            msg_list['Channel Page'] = int(cols[1], base=16)
-            return msg_list
-
-        if msg.startswith('Channel'):
-            msg_list['COMMAND'] = 'ACTIVESCAN'
-            cols = msg.split(':')
-            msg_list['Channel'] = int(cols[1], base=16)
-            return msg_list
-
-        if msg.startswith('Pan ID'):
-            msg_list['COMMAND'] = 'ACTIVESCAN'
-            cols = msg.split(':')
-            msg_list['Pan ID'] = int(cols[1], base=16)
-            return msg_list
-
-        if msg.startswith('Addr'):
-            msg_list['COMMAND'] = 'ACTIVESCAN'
-            cols = msg.split(':')
-            msg_list['Addr'] = cols[1]
-            return msg_list
-
-        if msg.startswith('LQI'):
-            msg_list['COMMAND'] = 'ACTIVESCAN'
-            cols = msg.split(':')
-            msg_list['LQI'] = int(cols[1], base=16)
-            return msg_list
-
-        if msg.startswith('PairID'):
-            msg_list['COMMAND'] = 'ACTIVESCAN'
-            cols = msg.split(':')
-            msg_list['PairID'] = cols[1]
-            return msg_list
+        """受信メッセージのパーサー
+            return: Y3Message（またはそのサブクラス）
+        """
+        if msg.startswith('ERXUDP'):     # 最も頻度が高いので先に処理する
+            cols = msg.split()
+            return Y3ErxudpMessage(cols, cols[8])
 
         cols = msg.split()
+        parser = Y3Module.MESSAGE_PARSERS.get(cols[0])
+        if parser:
+            return parser(cols)
 
-        if cols[0] == 'OK':
-            msg_list['COMMAND'] = cols[0]
-            if len(cols) > 1:
-                msg_list['MESSAGE'] = cols[1:len(cols)]
-            return msg_list
-
-        if cols[0] == 'EVENT':
-            msg_list['COMMAND'] = cols[0] + ' ' + cols[1]
-            msg_list['SENDER'] = cols[2]
-            if len(cols) == 4:
-                msg_list['PARAM'] = cols[3]
-            
-            return msg_list
-
-        if cols[0] == 'ERXUDP':  # UDP
-            msg_list['COMMAND'] = cols[0]
-            msg_list['SENDER'] = cols[1]
-            msg_list['DEST'] = cols[2]
-            msg_list['RPORT'] = int(cols[3], base=16)
-            msg_list['LPORT'] = int(cols[4], base=16)
-            msg_list['SENDERLLA'] = cols[5]
-            msg_list['SECURED'] = int(cols[6], base=16)
-            msg_list['DATALEN'] = int(cols[7], base=16)
-            msg_list['DATA'] = cols[8]
-            return msg_list
-
-        if cols[0] == 'ERXTCP':
-            msg_list['COMMAND'] = cols[0]
-            msg_list['SENDER'] = cols[1]
-            msg_list['RPORT'] = int(cols[2], base=16)
-            msg_list['LPORT'] = int(cols[3], base=16)
-            msg_list['DATALEN'] = int(cols[4], base=16)
-            msg_list['DATA'] = cols[5]
-            return msg_list
-
-        if cols[0] == 'ETCP':
-            msg_list['COMMAND'] = cols[0]
-            msg_list['STATUS'] = int(cols[1], base=16)
-            msg_list['HANDLE'] = int(cols[2], base=16)
-            if msg_list['STATUS'] == 1:
-                msg_list['IPADDR'] = cols[3]
-                msg_list['RPORT'] = int(cols[4], base=16)
-                msg_list['LPORT'] = int(cols[5], base=16)
-            return msg_list
-
-        if cols[0] == 'ESREG':
-            msg_list['COMMAND'] = cols[0]
-            msg_list['VAL'] = cols[1]
-            return msg_list
-
-        if cols[0] == 'EPANDESC':
-            msg_list['COMMAND'] = 'EPANDESC'
-            return msg_list
-
-        if cols[0] == 'EEDSCAN':
-            msg_list['COMMAND'] = 'EEDSCAN'
-            return msg_list
-
-        # ローカルエコー停止前のローカルエコー対策: 'SKSREG SFE 0'
-        if cols[0] == 'SKSREG':
-            msg_list['COMMAND'] = 'SKSREG'
-            msg_list['REG'] = cols[1]
-            msg_list['VAL'] = cols[2]
-            return msg_list
+        key, sep, value = msg.partition(':')    # アクティブスキャン結果 'Channel:21' など
+        if sep and key in Y3Module.ACTIVESCAN_KEYS:
+            return Y3ActiveScanMessage(key, value)
 
         # その他
-        msg_list['COMMAND'] = 'UNKNOWN'  # unknown message
-        msg_list['MESSAGE'] = cols
-        #pprint(msg_list)    # debug
-        return msg_list
+        return Y3Message('UNKNOWN', cols)  # unknown message
 
 
     def enqueue_message(self, msg_list):
-        """メッセージをリストに追加"""
-        self.msg_list_lock.acquire()
-        self.msg_list_queue.append(msg_list)
-        self.msg_list_lock.release()
+        """メッセージをキューに追加"""
+        self.msg_list_queue.put(msg_list)
 
 
-    def dequeue_message(self):
-        """メッセージをリストから取り出す"""
-        self.msg_list_lock.acquire()
-        
-        if self.msg_list_queue:
-            result = self.msg_list_queue.pop(0)
-        else:
-            result = False
-            
-        self.msg_list_lock.release()
-        
-        return result
+    def dequeue_message(self, timeout = 0):
+        """メッセージをキューから取り出す
+            timeout: 受信待ち時間[s], 0: 待たない, None: 受信するまで待つ
+            return: メッセージ, タイムアウト時はFalse
+        """
+        return self.msg_list_queue.get(timeout)
             
 
     def get_queue_size(self):
-        """リスト内のメッセージ数"""
+        """キュー内のメッセージ数"""
         return len(self.msg_list_queue)
 
 
-    def uart_open(self, dev, baud, timeout):
-        """UARTオープン"""
+    def get_queue_stats(self):
+        """キューの状態 (滞留数, 最大滞留数, 破棄数など)"""
+        return self.msg_list_queue.stats()
+
+
+    def uart_open(self, dev, baud, timeout = UART_POLL_INTERVAL):
+        """UARTオープン
+            timeout: 読み込みタイムアウト[s]，UART受信待ちの周期になる
+        """
         try:
             self.uart_hdl = serial.Serial(dev, baud, timeout=timeout)
             self.uart_dev = dev
@@ -420,6 +749,25 @@ class Y3Module(threading.Thread):
             self.uart_hdl.close()
         except OSError as msg:
             sys.stdout.write('[Error]: {}\n'.format(msg))
+        self.capture_close()
+
+
+    def capture_open(self, filename):
+        """UART送受信データの記録開始"""
+        self.capture_close()
+        try:
+            self.capture = Y3Capture(filename)
+            return True
+        except OSError as msg:
+            sys.stdout.write('[Error]: {}\n'.format(msg))
+            return False
+
+
+    def capture_close(self):
+        """UART送受信データの記録終了"""
+        if self.capture:
+            self.capture.close()
+            self.capture = None
 
 
     def write(self, send_msg, search_words = [], ignore = False, timeout = 0):
@@ -428,79 +776,528 @@ class Y3Module(threading.Thread):
             search_word: 受信待ちコマンド
                 (例) ['word1', 'word2', ['word31', 'word32']]: 'word1 -> 'word2' -> 'word31' or 'word32'
             ignore: 途中の受信データを無視する
-            timeout: タイムアウト時間[s]
+            timeout: タイムアウト時間[s], 0: タイムアウト無し
         """
+        command = self.command_name(send_msg)
         try:
-            self.uart_hdl.write(send_msg)
-            if search_words:
+            if not search_words:
+                self.uart_hdl.write(send_msg)
+                self.y3_stats.add_tx(len(send_msg))
+                if self.capture:
+                    self.capture.record(Y3Capture.TX, send_msg)
+                return
+
+            with self.search_cond:
                 self.search['found_word_list'] = []
                 self.search['ignore_intermidiate'] = ignore
-                self.search['start_time'] = time.time()
+                self.search['start_time'] = time.monotonic()
                 self.search['timeout'] = timeout
-                self.search['search_words'] = search_words    # run()で監視しているので、一番最後に設定する
-
-                while self.search['search_words'] != []:
-                    time.sleep(0.01)
+                self.search['command'] = command
+                self.search['search_words'] = list(search_words)
+                
+                # run()はsearch_condを取得できないので，受信待ち設定前の応答を取りこぼさない
+                self.uart_hdl.write(send_msg)
+                self.y3_stats.add_tx(len(send_msg))
+                if self.capture:
+                    self.capture.record(Y3Capture.TX, send_msg, self.search['start_time'])
+                
+                # run()が最後の受信待ちデータを見つけるとnotifyされる
+                found = self.search_cond.wait_for(lambda: not self.search['search_words'], timeout or None)
+                if found:   # 応答時間: 送信から最後の受信待ちデータの受信時刻まで
+                    last = self.search['found_word_list'][-1]
+                    self.y3_stats.add_latency(command, last.get('TIME', time.monotonic()) - self.search['start_time'])
+                else:       # タイムアウト
+                    self.y3_stats.add_error(command, 'timeout')
+                    self.search['found_word_list'] = []
+                    self.search['search_words'] = []
+                self.search['timeout'] = 0
                 return self.search['found_word_list']
 
         except OSError as msg:
+            self.y3_stats.add_error(command, 'error')
             sys.stdout.write('[Error]: {}\n'.format(msg))
             return False
 
 
-    def read(self):
-        """1行読み込み（文字列)"""
+    @staticmethod
+    def command_name(send_msg):
+        """送信データのコマンド名 (例) b'SKSENDTO 1 ...' -> 'SKSENDTO'"""
+        return send_msg.split(b' ', 1)[0].strip().decode(errors='replace')
+
+
+    def stats(self):
+        """統計のスナップショット
+            elapsed: 統計開始からの時間[s]
+            bytes_in, bytes_out: UART受信・送信バイト数
+            commands: {コマンド: {count: 応答数, mean, min, max: 応答時間[s], hist: [(区間上限[s], 回数), ...],
+                                 timeout: タイムアウト数, fail: FAIL応答数, error: 書き込みエラー数}}
+            unsolicited: {COMMAND: write()の受信待ちデータ，要求への応答(add_solicited())以外の受信行数}
+            queue: 受信データ用キューの状態
+        """
+        res = self.y3_stats.snapshot()
+        res['queue'] = self.msg_list_queue.stats()
+        return res
+
+
+    def receive(self):
+        """UARTから受信済みのデータをまとめて読み込み，行に分割する
+            受信データが無い場合はUART_POLL_INTERVAL（読み込みタイムアウト）まで待つ
+            return: 分割済みの行数
+        """
         try:
-            res = self.uart_hdl.readline().decode().strip()
-            #print('read:'+res)   # debug
-            return res
+            data = self.uart_hdl.read(1)    # 受信待ち
+            if data:
+                waiting = self.uart_hdl.in_waiting
+                if waiting:
+                    data += self.uart_hdl.read(waiting)
+                ts = time.monotonic()
+                self.y3_stats.add_rx(len(data))
+                if self.capture:
+                    self.capture.record(Y3Capture.RX, data, ts)
+                self.framer.feed(data, ts, self.rx_binary)
         except OSError as msg:
             sys.stdout.write('[Error]: {}\n'.format(msg))
+        return len(self.framer)
+
+
+    def read(self):
+        """1行読み込み（文字列)
+            バイナリ形式のERXUDPのデータは16進文字列にする（ASCII形式と同じ行になる）
+        """
+        if not self.framer and not self.receive():
+            return False
+        ts, line, payload = self.framer.pop()
+        res = line.decode().strip()
+        if payload is not None:
+            res += ' ' + payload.hex().upper()
+        return res
+
+
+    def read_message(self):
+        """1メッセージ読み込み・パース
+            return: メッセージ（TIMEに受信時刻を設定）, 受信データ無しの場合はFalse
+        """
+        if not self.framer and not self.receive():
             return False
+        ts, line, payload = self.framer.pop()
+        msg_list = self.framer.to_message(line, payload)
+        if msg_list:
+            msg_list.TIME = ts
+        return msg_list
+
+
+    @staticmethod
+    def match_search_words(search, msg_list):
+        """受信待ちデータ(search)と照合し，受信待ちデータであればsearchを更新する
+            return: True: 受信待ちデータとして受け取った，または破棄した
+                    False: 受信待ちデータではない
+        """
+        if not search['search_words']:     # サーチ中ではない
+            return False
+        
+        search_words = search['search_words'][0]
+        if isinstance(search_words, list):
+            for word in search_words:
+                if msg_list.COMMAND.startswith(word):
+                    break
+            else:
+                return True     # 候補の何れでもない受信データは破棄
+        elif not msg_list.COMMAND.startswith(search_words):
+            return search['ignore_intermidiate']   # 途中の受信データを破棄するかどうか
+        
+        # サーチワードを受信した。
+        search['found_word_list'].append(msg_list)
+        search['search_words'].pop(0)
+        return True
+
+
+    def search_message(self, msg_list):
+        """write()の受信待ちデータと照合する
+            return: True: 受信待ちデータとして受け取った，または破棄した
+                    False: 受信待ちデータではない
+        """
+        with self.search_cond:
+            if self.search['search_words'] and msg_list.COMMAND == 'FAIL':
+                self.y3_stats.add_error(self.search['command'], 'fail')
+            result = self.match_search_words(self.search, msg_list)
+            if result:
+                self.y3_stats.add_solicited(msg_list)
+                if not self.search['search_words']:
+                    self.search_cond.notify_all()   # write()の受信待ち完了
+            return result
+
+
+    def process_message(self, msg_list):
+        """受信メッセージの振り分け（サブクラスで拡張可）"""
+        # debug: UDP(PANA)の受信
+        if msg_list.COMMAND == 'ERXUDP' and msg_list.LPORT == self.Y3_UDP_PANA_PORT:
+            #sys.stdout.write('[Note]: PANA message received.\n')
+            pass
+       
+        elif not self.search_message(msg_list):
+            self.enqueue_message(msg_list)
 
 
     def run(self):
         """UART受信用スレッド"""
         while not self.term_flag:
-            msg = self.read()
-            if msg:
-                msg_list = self.parse_message(msg)
-
-                # debug: UDP(PANA)の受信
-                if msg_list['COMMAND'] == 'ERXUDP' and msg_list['LPORT'] == self.Y3_UDP_PANA_PORT:
-                    #sys.stdout.write('[Note]: PANA message received.\n')
-                    pass
-               
-                elif self.search['search_words']:     # サーチ中である
-                    # サーチワードを受信した。
-                    search_words = self.search['search_words'][0]                    
-                    if isinstance(search_words, list):
-                        for word in search_words:
-                            if msg_list['COMMAND'].startswith(word):
-                                self.search['found_word_list'].append(msg_list)
-                                self.search['search_words'].pop(0)
-                                break
-                    elif msg_list['COMMAND'].startswith(search_words):
-                        self.search['found_word_list'].append(msg_list)
-                        self.search['search_words'].pop(0)
-                    
-                    elif self.search['ignore_intermidiate']:
-                        pass    # 途中の受信データを破棄 
-                
-                    else:    # サーチワードではなかった
-                        self.enqueue_message(msg_list)
-                
-                else:   # サーチ中ではない
-                    self.enqueue_message(msg_list)
-                
-            elif self.search['timeout']:  # read()がタイムアウト，write()でタイムアウトが設定されている
-                if time.time() - self.search['start_time'] > self.search['timeout']:
-                    self.search['found_word_list'] = []
-                    self.search['search_words'] = []
-                    self.search['timeout'] = 0
+            msg_list = self.read_message()
+            if msg_list:
+                self.y3_stats.add_line(msg_list)
+                self.process_message(msg_list)
 
 
     def terminate(self):
         """run()の停止"""
         self.term_flag = True
         self.join()
+
+
+class AsyncY3Module:
+    """Wi-SUN Module BP35A1(ROHM) 通信クラス (asyncio版)
+        UARTをイベントループのリーダーで受信するので，スレッドを使用しない。
+        SKコマンドは全てコルーチン。
+    """
+
+    SCAN_CHANNELS = 32      # SKSCANのチャンネルマスク(FFFFFFFF)のチャンネル数
+    SCAN_MARGIN = 10.0      # スキャン終了(EVENT 22)の待ち時間の余裕[s]
+
+    def __init__(self, queue_size = 256):
+        """コンストラクタ
+            queue_size: 受信メッセージキューの最大メッセージ数（満杯時は最も古いメッセージを捨てる）
+        """
+        self.Y3_UDP_ECHONET_PORT = 3610 # ECHONET UDPポート
+        self.Y3_UDP_PANA_PORT = 716     # PANAポート
+        self.Y3_TCP_ECHONET_PORT = 3610 # TCPポート
+        
+        self.msg_list_queue = asyncio.Queue(queue_size)    # 受信データ用キュー
+        self.dropped = 0                # キュー満杯により破棄したメッセージ数
+
+        self.uart_hdl = None            # UART
+        self.uart_dev = None
+        self.uart_baud = 9600
+        self.rx_binary = False          # ERXUDPのデータ形式 True: バイナリ, False: ASCII
+        self.framer = Y3LineFramer()    # 受信データの行分割
+
+        self.loop = None
+        self.write_lock = asyncio.Lock()    # 受信待ちを伴うコマンドは同時に1つだけ
+        self.search = {                 # write()用, UART送信後の受信待ちデータ
+            'search_words': [],             # UART送信後の受信待ちデータリスト
+            'ignore_intermidiate': False,   # 途中の受信データを無視する
+            'found_word_list': [],          # 受け取った受信待ちデータリスト
+            'future': None}                 # 受信待ち完了通知用
+
+
+    async def set_opt(self, flag):
+        """ERXUDP, ERXTCPのフォーマット設定
+            flag: True: ASCII
+                  False: Binary
+        """
+        current = await self.get_opt()
+        self.rx_binary = not flag       # 応答'OK'はASCIIなので，変更前に設定しておく
+        if flag and not current:        # 変更無しの場合はモジュールに書き込まない（FLASHへの書き込み制限）
+            await self.write(b'WOPT 01\r\n', ['OK'])
+        elif not flag and current:
+            await self.write(b'WOPT 00\r\n', ['OK'])
+        return True
+
+
+    async def get_opt(self):
+        """ERXUDP, ERXTCPのフォーマット取得
+            retern True: ASCII
+                   False: Binary
+        """
+        res = await self.write(b'ROPT\r\n', ['OK'])
+        result = True if res[0].MESSAGE[0] == '01' else False
+        self.rx_binary = not result
+        return result
+
+
+    async def set_echoback_off(self):
+        """エコーバックを停止"""
+        await self.write(b'SKSREG SFE 0\r\n', ['OK'], ignore = True)
+
+
+    async def set_channel(self, ch):
+        """Wi-SUNチャンネル設定"""
+        bc = '{:02X}'.format(ch).encode()
+        await self.write(b'SKSREG S02 ' + bc + b'\r\n', ['OK'])
+
+
+    async def set_pairing_id(self, pairid):
+        """ペアリングID設定"""
+        await self.write(b'SKSREG S0A ' + pairid.encode() + b'\r\n', ['OK'])
+
+
+    async def set_pan_id(self, pan):
+        """PAN ID設定"""
+        bp = '{:04X}'.format(pan).encode()
+        await self.write(b'SKSREG S03 ' + bp + b'\r\n', ['OK'])
+
+
+    async def set_accept_beacon(self, flag):
+        """ビーコンリクエストへの反応
+            flag True:  応答する
+                 False: 応答しない
+        """
+        bf = b'1' if flag else b'0'
+        await self.write(b'SKSREG S15 ' + bf + b'\r\n', ['OK'])
+
+
+    async def get_tx_limit(self):
+        """送信制限フラグ取得"""
+        res = await self.write(b'SKSREG SFB\r\n' , ['ESREG', 'OK'])
+        return True if res[0].VAL[0] == '1' else False
+
+
+    async def set_password(self, password):
+        """パスワード設定"""
+        length = len(password)
+        if length < 1 or length > 32:
+            return False
+        bp = '{:X} {}'.format(length, password).encode()
+        await self.write(b'SKSETPWD ' + bp + b'\r\n', ['OK'])
+        return True
+
+
+    async def set_routeb_id(self, rbid):
+        """ルートB ID設定"""
+        if len(rbid) != 32:
+            return False
+        await self.write(b'SKSETRBID ' + rbid.encode() + b'\r\n', ['OK'])
+        return True
+
+
+    async def start_paa(self):
+        """PAA開始"""
+        await self.write(b'SKSTART\r\n', ['OK'])
+
+
+    async def start_pac(self, ip6):
+        """PaC開始"""
+        res = await self.write(b'SKJOIN ' + ip6.encode() + b'\r\n', [['EVENT 24', 'EVENT 25', 'FAIL ER10']],
+                               ignore = True, timeout = 10)
+        return bool(res) and res[0].COMMAND == 'EVENT 25'
+
+
+    async def restart_pac(self):
+        """PaCをリスタート"""
+        res = await self.write(b'SKREJOIN\r\n', [['EVENT 24', 'EVENT 25', 'FAIL ER10']], ignore = True, timeout = 10)
+        return bool(res) and res[0].COMMAND == 'EVENT 25'
+
+
+    async def pac_terminate(self):
+        """PANAセッションを終了する"""
+        res = await self.write(b'SKTERM\r\n', [['OK', 'FAIL ER10']], ignore = True, timeout = 10)
+        return bool(res) and res[0].COMMAND == 'OK'
+
+
+    async def get_ip6(self, add):
+        """IP6アドレス習得"""
+        res = await self.write(b'SKLL64 ' + add.encode() + b'\r\n', ['UNKNOWN'])
+        return res[0].MESSAGE[0]
+
+
+    async def tcp_connect(self, ip6, rport, lport):
+        """TCPコネクション開始"""
+        br = ' {:04X}'.format(rport).encode()
+        bl = ' {:04X}'.format(lport).encode()
+        res = await self.write(b'SKCONNECT ' + ip6.encode() + br + bl + b'\r\n', ['ETCP'])
+        return res[0]
+
+
+    async def tcp_disconnect(self, handle):
+        """TCPコネクション停止"""
+        res = await self.write(b'SKCLOSE ' + str(handle).encode() + b'\r\n', ['ETCP'])
+        return res[0].STATUS == 3
+
+
+    async def tcp_send(self, handle, message):
+        """TCPで送信"""
+        len_bt =' {:04X} '.format(len(message)).encode()
+        res = await self.write(b'SKSEND ' + str(handle).encode() + len_bt + message, ['ETCP'])
+        return res[0].STATUS == 5
+
+
+    async def udp_send(self, handle, ip6, security, port, message):
+        """UDPで送信"""
+        sec_bt = b' 1' if security else b' 0'
+        len_bt = ' {:04X} '.format(len(message)).encode()
+        port_bt = ' {:04X}'.format(port).encode()
+        res = await self.write(b'SKSENDTO ' + str(handle).encode() + b' ' + ip6.encode() + port_bt +
+                               sec_bt + len_bt + message, ['EVENT 21', 'OK'])
+
+        if res[0].PARAM == '01':
+            sys.stdout.write('[Error]: UDP transmission.\n')
+            if await self.get_tx_limit():
+                sys.stdout.write('[Error]: TX limit.\n')
+            return False
+        else:
+            return True     # 送信成功
+
+
+    async def ed_scan(self, duration = 4):
+        """EDスキャン"""
+        bd = '{:X}'.format(duration).encode()
+        await self.write(b'SKSCAN 0 FFFFFFFF ' + bd + b'\r\n', [['EEDSCAN'], ['OK']])
+        msg = await self.dequeue_message(timeout = None)
+        res = msg.MESSAGE
+
+        lqi_list = []
+        for i in range(0, len(res), 2):
+            lqi_list.append([int(res[i + 1], base=16), int(res[i], base=16)])  # [[LQI, channel], [LQI, channel],....]
+        lqi_list.sort()  # LQIでソート
+        return [lqi_list[0][1], lqi_list[0][0]]  # LQI最小チャンネル [channel, LQImin]
+
+
+    async def active_scan(self, duration = 6):
+        """アクティブスキャン
+            return: チャンネルリスト, スキャン時間内にEVENT 22を受信しない場合はNone
+        """
+        bd = '{:X}'.format(duration).encode()
+        await self.write(b'SKSCAN 2 FFFFFFFF ' + bd + b'\r\n')
+        channel_list = []
+        channel = {}
+        # 1チャンネルあたりのスキャン時間: 0.01s * (2 ** duration + 1)
+        deadline = time.monotonic() + self.SCAN_CHANNELS * 0.01 * (2 ** duration + 1) + self.SCAN_MARGIN
+
+        while True:
+            msg_list = await self.dequeue_message(timeout = max(deadline - time.monotonic(), 0.001))
+            if not msg_list:    # EVENT 22が来ない（UARTの受信エラー等）
+                return None
+            if msg_list.COMMAND == 'EPANDESC':
+                channel = {}
+            elif msg_list.COMMAND == 'ACTIVESCAN':
+                channel[msg_list.KEY] = msg_list.VALUE
+                if msg_list.KEY == 'PairID':
+                    channel_list.append(channel)
+            elif msg_list.COMMAND == 'EVENT 22':
+                break
+
+        return channel_list
+
+
+    def enqueue_message(self, msg_list):
+        """メッセージをキューに追加（満杯時は最も古いメッセージを捨てる）"""
+        if self.msg_list_queue.full():
+            self.msg_list_queue.get_nowait()
+            self.dropped += 1
+        self.msg_list_queue.put_nowait(msg_list)
+
+
+    async def dequeue_message(self, timeout = 0):
+        """メッセージをキューから取り出す
+            timeout: 受信待ち時間[s], 0: 待たない, None: 受信するまで待つ
+            return: メッセージ, タイムアウト時はFalse
+        """
+        if timeout == 0:
+            try:
+                return self.msg_list_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return False
+        try:
+            return await asyncio.wait_for(self.msg_list_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+
+    def get_queue_size(self):
+        """キュー内のメッセージ数"""
+        return self.msg_list_queue.qsize()
+
+
+    def uart_open(self, dev, baud):
+        """UARTオープン（ノンブロッキング）"""
+        try:
+            self.uart_hdl = serial.Serial(dev, baud, timeout=0)
+            self.uart_dev = dev
+            self.uart_baud = baud
+            return True
+        except OSError as msg:
+            sys.stdout.write('[Error]: {}\n'.format(msg))
+            return False
+
+
+    def uart_close(self):
+        """UARTクローズ"""
+        try:
+            self.uart_hdl.close()
+        except OSError as msg:
+            sys.stdout.write('[Error]: {}\n'.format(msg))
+
+
+    def start(self):
+        """UART受信開始（イベントループ内から呼ぶこと）"""
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.uart_hdl.fileno(), self.on_readable)
+
+
+    def terminate(self):
+        """UART受信停止"""
+        if self.loop:
+            self.loop.remove_reader(self.uart_hdl.fileno())
+            self.loop = None
+
+
+    async def write(self, send_msg, search_words = [], ignore = False, timeout = 0):
+        """UART書き込み & 受信待ち
+            send_msg: 送信データ: bytes
+            search_word: 受信待ちコマンド（Y3Module.write()と同じ）
+            ignore: 途中の受信データを無視する
+            timeout: タイムアウト時間[s], 0: タイムアウト無し
+        """
+        try:
+            if not search_words:
+                self.uart_hdl.write(send_msg)
+                return
+
+            async with self.write_lock:
+                future = self.loop.create_future()
+                self.search['found_word_list'] = []
+                self.search['ignore_intermidiate'] = ignore
+                self.search['search_words'] = list(search_words)
+                self.search['future'] = future
+                
+                self.uart_hdl.write(send_msg)
+                try:
+                    return await asyncio.wait_for(future, timeout or None)
+                except asyncio.TimeoutError:
+                    return []
+                finally:
+                    self.search['search_words'] = []
+                    self.search['future'] = None
+
+        except OSError as msg:
+            sys.stdout.write('[Error]: {}\n'.format(msg))
+            return False
+
+
+    def on_readable(self):
+        """UART受信コールバック（イベントループから呼ばれる）"""
+        try:
+            data = self.uart_hdl.read(self.uart_hdl.in_waiting or 1)
+        except OSError as msg:
+            sys.stdout.write('[Error]: {}\n'.format(msg))
+            return
+        self.framer.feed(data, time.monotonic(), self.rx_binary)
+
+        while self.framer:
+            ts, line, payload = self.framer.pop()
+            msg_list = self.framer.to_message(line, payload)
+            if msg_list:
+                msg_list.TIME = ts
+                self.process_message(msg_list)
+
+
+    def process_message(self, msg_list):
+        """受信メッセージの振り分け"""
+        # UDP(PANA)の受信
+        if msg_list.COMMAND == 'ERXUDP' and msg_list.LPORT == self.Y3_UDP_PANA_PORT:
+            return
+        
+        if Y3Module.match_search_words(self.search, msg_list):
+            future = self.search['future']
+            if not self.search['search_words'] and future and not future.done():
+                future.set_result(self.search['found_word_list'])     # write()の受信待ち完了
+        else:
+            self.enqueue_message(msg_list)
@@ -0,0 +1,666 @@
+#!/usr/bin/python3
+# coding: UTF-8
+#
+# y3sim.py
+#
+# Wi-SUNモジュールBP35A1(ROHM) + 低圧スマート電力量メーター シミュレータ
+#   Y3Sim:          BP35A1のSKコマンドを解釈し，スマートメーターとして応答する
+#   Y3SimSerial:    プロセス内で使うserial.Serialの代用品
+#   Y3SimPty:       疑似端末(pty)で動くシミュレータ
+#   Y3ReplaySerial: UART送受信データの記録(Y3Capture)を再生するserial.Serialの代用品
+#
+# Usage: ./y3sim.py [--latency s] [--loss p] [--inf s]
+#        表示された疑似端末(/dev/pts/N)をUARTデバイスとして使う
+#
+# Copyright(C) 2016 pi@blue-black.ink
+#
+
+import argparse
+import collections
+import datetime
+import heapq
+import math
+import os
+import random
+import sys
+import threading
+import time
+import tty
+
+from echonet_lite import EchonetLite, EchonetLiteFrameError, EchonetLiteSmartEnergyMeter
+from y3module import Y3Capture
+
+
+class SmartMeterSim:
+    """低圧スマート電力量メーター（ECHONET Lite）のシミュレータ"""
+
+    SEOJ = b'\x02\x88\x01'      # 低圧スマート電力量メータ
+    NODE_PROFILE = b'\x0e\xf0\x01'  # ノードプロファイル
+
+    ENERGY_RATE = 0.45          # 平均消費電力量[kWh/h]
+    ENERGY_SWING = 0.1          # 日変動[kWh]
+    ENERGY_ORIGIN = 1451574000  # 積算開始時刻 (2016/1/1 0:00 JST)
+    UNIT = 0.1                  # 積算電力量単位[kWh] (E1 = 0x01)
+
+    def __init__(self, seed = None):
+        self.random = random.Random(seed)
+        self.el = EchonetLite()     # 要求電文のパース用
+        self.day_hist1 = 0          # E5: 積算履歴収集日1
+        self.day_hist2 = None       # ED: 積算履歴収集日2 [datetime, コマ数]
+        self.infc_res = 0           # 受信したINFC応答数
+
+        el = EchonetLiteSmartEnergyMeter
+        self.epc = dict(el.EPC_DICT)
+        self.epc.update(el.LVSM_EPC_DICT)
+        self.getters = {
+            self.epc['operation_status']:     lambda now: b'\x30',
+            self.epc['location']:             lambda now: b'\x00',
+            self.epc['version']:              lambda now: b'\x00\x00F\x00',
+            self.epc['fault_status']:         lambda now: b'\x42',
+            self.epc['manufacturer_code']:    lambda now: b'\x00\x00\x16',
+            self.epc['production_no']:        lambda now: b'SIM000000001',
+            self.epc['current_time']:         lambda now: bytes([now.hour, now.minute]),
+            self.epc['current_date']:         lambda now: now.year.to_bytes(2, 'big') + bytes([now.month, now.day]),
+            self.epc['epc_coefficient']:      lambda now: (1).to_bytes(4, 'big'),
+            self.epc['digits']:               lambda now: b'\x06',
+            self.epc['amount_energy_normal']: lambda now: self.energy_edt(now),
+            self.epc['unit_amount_energy']:   lambda now: b'\x01',
+            self.epc['hist_amount_energy1_norm']: lambda now: self.hist1_edt(now, False),
+            self.epc['amount_energy_rev']:    lambda now: (0).to_bytes(4, 'big'),
+            self.epc['hist_amount_energy1_rev']: lambda now: self.hist1_edt(now, True),
+            self.epc['day_hist_amount_energy1']: lambda now: bytes([self.day_hist1]),
+            self.epc['instant_power']:        lambda now: self.power(now).to_bytes(4, 'big', signed=True),
+            self.epc['instant_current']:      lambda now: self.current_edt(now),
+            self.epc['recent_amount_energy_norm']: lambda now: self.recent_edt(now),
+            self.epc['recent_amount_energy_rev']: lambda now: self.recent_edt(now, True),
+            self.epc['hist_amount_energy2']:  lambda now: self.hist2_edt(now),
+            self.epc['day_hist_amount_energy2']: lambda now: self.day_hist2_edt()}
+        self.setters = {
+            self.epc['day_hist_amount_energy1']: self.set_day_hist1,
+            self.epc['day_hist_amount_energy2']: self.set_day_hist2}
+
+        epcs = sorted(self.getters.keys()) + [self.epc['get_pty_map'], self.epc['set_pty_map'],
+                                              self.epc['chg_pty_map']]
+        get_map = self.make_property_map(epcs)
+        set_map = self.make_property_map(sorted(self.setters.keys()))
+        chg_map = self.make_property_map([self.epc['operation_status']])
+        self.getters[self.epc['get_pty_map']] = lambda now: get_map
+        self.getters[self.epc['set_pty_map']] = lambda now: set_map
+        self.getters[self.epc['chg_pty_map']] = lambda now: chg_map
+
+    @staticmethod
+    def make_property_map(epcs):
+        """プロパティマップ作成 (16個未満: 一覧形式, 16個以上: ビットマップ形式)"""
+        codes = [epc[0] for epc in epcs]
+        if len(codes) < 16:
+            return bytes([len(codes)] + codes)
+        bitmap = bytearray(16)
+        for code in codes:
+            bitmap[code & 0x0f] |= 1 << ((code >> 4) - 8)
+        return bytes([len(codes)]) + bytes(bitmap)
+
+    def energy(self, dt):
+        """積算電力量[kWh]"""
+        hours = (dt.timestamp() - self.ENERGY_ORIGIN) / 3600
+        return self.ENERGY_RATE * hours + self.ENERGY_SWING * math.sin(2 * math.pi * hours / 24)
+
+    def energy_units(self, dt):
+        """積算電力量（単位換算後の整数値）"""
+        return int(self.energy(dt) / self.UNIT) % 1000000     # 有効桁数6桁 (D7 = 0x06)
+
+    def energy_edt(self, now):
+        return self.energy_units(now).to_bytes(4, 'big')
+
+    def power(self, now):
+        """瞬時電力[W]"""
+        hours = now.timestamp() / 3600
+        rate = self.ENERGY_RATE + self.ENERGY_SWING * 2 * math.pi / 24 * math.cos(2 * math.pi * hours / 24)
+        return int(rate * 1000 + self.random.randint(-50, 50))
+
+    def current_edt(self, now):
+        """瞬時電流 R相, T相 [0.1A]"""
+        deci_amp = self.power(now) // 20    # 200V単相3線, 各相100V
+        return deci_amp.to_bytes(2, 'big', signed=True) * 2
+
+    @staticmethod
+    def slot_time(dt):
+        """直前の30分の区切り"""
+        return dt.replace(minute = dt.minute // 30 * 30, second = 0, microsecond = 0)
+
+    @staticmethod
+    def datetime_bytes(dt):
+        return dt.year.to_bytes(2, 'big') + bytes([dt.month, dt.day, dt.hour, dt.minute, dt.second])
+
+    def recent_edt(self, now, rev = False):
+        """定時積算電力量計測値"""
+        dt = self.slot_time(now)
+        value = 0 if rev else self.energy_units(dt)
+        return self.datetime_bytes(dt) + value.to_bytes(4, 'big')
+
+    def hist1_edt(self, now, rev = False):
+        """積算電力量計測値履歴1 (E5で指定した日の48コマ)"""
+        day = datetime.datetime.combine(now.date(), datetime.time()) - datetime.timedelta(days = self.day_hist1)
+        edt = self.day_hist1.to_bytes(2, 'big')
+        for i in range(48):
+            dt = day + datetime.timedelta(minutes = 30 * i)
+            if dt > now:
+                value = 0xfffffffe      # 未計測
+            else:
+                value = 0 if rev else self.energy_units(dt)
+            edt += value.to_bytes(4, 'big')
+        return edt
+
+    def hist2_edt(self, now):
+        """積算電力量計測値履歴2 (EDで指定した日時から遡ったコマ)"""
+        if self.day_hist2 is None:
+            start, count = self.slot_time(now), 12
+        else:
+            start, count = self.day_hist2
+        edt = self.datetime_bytes(start)[0:6] + bytes([count])
+        for i in range(count):
+            dt = start - datetime.timedelta(minutes = 30 * i)
+            if dt > now:
+                edt += b'\xff\xff\xff\xfe' * 2
+            else:
+                edt += self.energy_units(dt).to_bytes(4, 'big') + (0).to_bytes(4, 'big')
+        return edt
+
+    def day_hist2_edt(self):
+        if self.day_hist2 is None:
+            return b'\xff\xff\xff\xff\xff\xff\xff'
+        start, count = self.day_hist2
+        return self.datetime_bytes(start)[0:6] + bytes([count])
+
+    def set_day_hist1(self, edt):
+        if len(edt) != 1 or edt[0] > 99:
+            return False
+        self.day_hist1 = edt[0]
+        return True
+
+    def set_day_hist2(self, edt):
+        if len(edt) != 7 or not 1 <= edt[6] <= 12:
+            return False
+        try:
+            start = datetime.datetime(int.from_bytes(edt[0:2], 'big'), edt[2], edt[3], edt[4], edt[5])
+        except ValueError:
+            return False
+        self.day_hist2 = [start, edt[6]]
+        return True
+
+    @staticmethod
+    def make_frame(tid, seoj, deoj, esv, ptys, get_ptys = None):
+        frame = b'\x10\x81' + tid + seoj + deoj + esv + bytes([len(ptys)])
+        for epc, edt in ptys:
+            frame += epc + bytes([len(edt)]) + edt
+        if get_ptys is not None:    # SetGet系: OPCGet, Get側のプロパティ
+            frame += bytes([len(get_ptys)])
+            for epc, edt in get_ptys:
+                frame += epc + bytes([len(edt)]) + edt
+        return frame
+
+    def get_ptys(self, ptys, now):
+        """Get処理 return: [[epc, edt], ...], True: 全て応答できた"""
+        result = []
+        accepted = True
+        for pty in ptys:
+            epc = bytes([pty.epc])
+            getter = self.getters.get(epc)
+            accepted &= getter is not None
+            result.append([epc, getter(now) if getter else b''])
+        return result, accepted
+
+    def set_ptys(self, ptys):
+        """Set処理 return: [[epc, edt], ...]（受理: PDC=0, 不可: 要求されたEDT）, True: 全て受理した"""
+        result = []
+        accepted = True
+        for pty in ptys:
+            epc = bytes([pty.epc])
+            setter = self.setters.get(epc)
+            ok = setter is not None and setter(bytes(pty.edt))
+            accepted &= ok
+            result.append([epc, b'' if ok else bytes(pty.edt)])
+        return result, accepted
+
+    def handle(self, data, now = None):
+        """ECHONET Lite要求電文を処理する
+            return: 応答電文(bytes), 応答不要の場合はNone
+        """
+        now = now or datetime.datetime.now()
+        try:
+            frame = self.el.decode_frame(bytes(data))
+        except EchonetLiteFrameError:
+            return None
+
+        esv = bytes([frame.esv])
+        code = EchonetLite.ESV_CODE
+        get_ptys = None
+        if esv == code['infc_reg']:   # INFCの応答
+            self.infc_res += 1
+            return None
+        if esv == code['get']:
+            ptys, accepted = self.get_ptys(frame.ptys, now)
+            res_esv = code['get_res'] if accepted else code['get_sna']
+        elif esv in (code['setc'], code['seti']):
+            ptys, accepted = self.set_ptys(frame.ptys)
+            if esv == code['seti'] and accepted:
+                return None
+            res_esv = code['set_res'] if accepted else (code['setc_sna'] if esv == code['setc'] else code['seti_sna'])
+        elif esv == code['setget']:     # Set処理の後にGet処理
+            ptys, set_accepted = self.set_ptys(frame.ptys)
+            get_ptys, get_accepted = self.get_ptys(frame.get_ptys, now)
+            res_esv = code['setget_res'] if set_accepted and get_accepted else code['setget_sna']
+        else:
+            return None
+
+        return self.make_frame(frame.tid.to_bytes(2, 'big'), self.SEOJ, bytes(frame.seoj), res_esv, ptys, get_ptys)
+
+    def make_inf(self, tid, now = None, esv = EchonetLite.ESV_CODE['inf']):
+        """定時積算電力量計測値(EA, EB)の通知電文
+            esv: INF / INFC(応答要)"""
+        now = now or datetime.datetime.now()
+        return self.make_frame(tid.to_bytes(2, 'big'), self.SEOJ, b'\x05\xff\x01', esv,
+                               [[self.epc['recent_amount_energy_norm'], self.recent_edt(now)],
+                                [self.epc['recent_amount_energy_rev'], self.recent_edt(now, True)]])
+
+    def make_instance_list(self, tid):
+        """インスタンスリスト通知（PANA認証後）"""
+        return self.make_frame(tid.to_bytes(2, 'big'), self.NODE_PROFILE, self.NODE_PROFILE,
+                               EchonetLite.ESV_CODE['inf'], [[b'\xd5', b'\x01' + self.SEOJ]])
+
+
+class Y3Sim:
+    """BP35A1のシミュレータ
+        host_write()でホストからの送信データを受け取り，応答をoutput(bytes)で返す。
+    """
+
+    CHANNEL = 0x21
+    PAN_ID = 0x8888
+    METER_MAC = '001C640003ABCDEF'
+    METER_IP6 = 'FE80:0000:0000:0000:021C:6400:03AB:CDEF'
+    HOST_IP6 = 'FE80:0000:0000:0000:021D:1290:1234:5678'
+    PAIR_ID = '00ABCDEF'
+
+    def __init__(self, output, latency = 0.05, loss = 0.0, inf_interval = 1800, scan_time = 0.1, seed = None,
+                 infc = False):
+        """コンストラクタ
+            output: 出力関数 output(bytes)
+            latency: スマートメーターの応答遅延[s]
+            loss: 応答の損失率 0.0～1.0
+            inf_interval: 定時積算電力量(EA, EB)の通知間隔[s], 0: 通知しない
+            scan_time: アクティブスキャンの所要時間[s]
+            infc: 定時積算電力量をINFC(応答要)で通知する
+        """
+        self.output = output
+        self.latency = latency
+        self.loss = loss
+        self.inf_interval = inf_interval
+        self.inf_esv = EchonetLite.ESV_CODE['infc' if infc else 'inf']
+        self.scan_time = scan_time
+        self.random = random.Random(seed)
+        self.meter = SmartMeterSim(seed)
+
+        self.echoback = True        # SFE
+        self.ascii = True           # WOPT
+        self.reg = {'S02': '{:02X}'.format(self.CHANNEL), 'S03': '0000', 'S0A': '00000000', 'S15': '1',
+                    'SFB': '0'}
+        self.password = None
+        self.rbid = None
+        self.joined = False
+        self.inf_tid = 0
+
+        self.rx = bytearray()       # ホストからの受信データ
+        self.timers = []            # [時刻, 連番, データ] のヒープ
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.term_flag = False
+        self.thread = threading.Thread(target = self.timer_loop, daemon = True)
+        self.thread.start()
+
+    def terminate(self):
+        with self.cond:
+            self.term_flag = True
+            self.cond.notify()
+        self.thread.join()
+
+    def emit(self, data, delay = 0.0):
+        """応答を出力する（delay[s]後）"""
+        if delay <= 0:
+            self.output(data)
+            return
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.timers, [time.time() + delay, self.seq, data])
+            self.cond.notify()
+
+    def emit_lines(self, *lines):
+        self.emit(b''.join(line.encode() + b'\r\n' for line in lines))
+
+    def timer_loop(self):
+        """遅延出力, 定時通知用スレッド"""
+        next_inf = None
+        while True:
+            with self.cond:
+                if self.term_flag:
+                    return
+                if self.joined and self.inf_interval and next_inf is None:
+                    next_inf = time.time() + self.inf_interval
+                due = [t for t in (self.timers[0][0] if self.timers else None, next_inf) if t is not None]
+                wait = min(due) - time.time() if due else None
+                if wait is None or wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                ready = []
+                while self.timers and self.timers[0][0] <= time.time():
+                    ready.append(heapq.heappop(self.timers)[2])
+            for data in ready:
+                self.output(data)
+            if next_inf is not None and next_inf <= time.time():
+                next_inf = None
+                self.inf_tid = (self.inf_tid + 1) & 0xffff
+                self.emit(self.erxudp(self.meter.make_inf(self.inf_tid, esv = self.inf_esv)))
+
+    def erxudp(self, data, port = 0x0e1a):
+        """ERXUDP行を作成"""
+        header = 'ERXUDP {} {} {:04X} {:04X} {} 1 {:04X} '.format(self.METER_IP6, self.HOST_IP6, port, port,
+                                                                   self.METER_MAC, len(data)).encode()
+        body = data.hex().upper().encode() if self.ascii else data
+        return header + body + b'\r\n'
+
+    def host_write(self, data):
+        """ホストからの送信データ"""
+        self.rx += data
+        while self.rx:
+            if self.rx.startswith(b'SKSENDTO '):   # データ部はバイナリで改行が無い
+                cols = bytes(self.rx).split(b' ', 6)
+                if len(cols) < 7:
+                    return
+                datalen = int(cols[5], 16)
+                start = len(b' '.join(cols[:6])) + 1
+                if len(self.rx) < start + datalen:
+                    return
+                payload = bytes(self.rx[start:start + datalen])
+                del self.rx[:start + datalen]
+                self.sksendto([c.decode() for c in cols[:6]], payload)
+                continue
+
+            idx = self.rx.find(b'\r\n')
+            if idx < 0:
+                return
+            line = bytes(self.rx[:idx]).decode()
+            del self.rx[:idx + 2]
+            if self.echoback:
+                self.emit_lines(line)
+            self.command(line.split())
+
+    def command(self, cols):
+        """SKコマンドの処理"""
+        if not cols:
+            return
+        cmd = cols[0]
+        if cmd == 'SKSREG':
+            if len(cols) == 2:
+                self.emit_lines('ESREG ' + self.reg.get(cols[1], '0'), 'OK')
+            else:
+                if cols[1] == 'SFE':
+                    self.echoback = cols[2] != '0'
+                self.reg[cols[1]] = cols[2]
+                self.emit_lines('OK')
+        elif cmd == 'WOPT':
+            self.ascii = cols[1] == '01'
+            self.emit_lines('OK ' + cols[1])
+        elif cmd == 'ROPT':
+            self.emit_lines('OK ' + ('01' if self.ascii else '00'))
+        elif cmd == 'SKSETPWD':
+            self.password = cols[2]
+            self.emit_lines('OK')
+        elif cmd == 'SKSETRBID':
+            self.rbid = cols[1]
+            self.emit_lines('OK')
+        elif cmd == 'SKSCAN':
+            self.skscan(int(cols[1]))
+        elif cmd == 'SKLL64':
+            self.emit_lines(self.METER_IP6 if cols[1] == self.METER_MAC else 'FE80:0000:0000:0000:0000:0000:0000:0000')
+        elif cmd in ('SKJOIN', 'SKREJOIN'):
+            self.emit_lines('OK')
+            self.join()
+        elif cmd == 'SKTERM':
+            self.emit_lines('OK')
+            self.joined = False
+            self.emit(b'EVENT 27 ' + self.METER_IP6.encode() + b'\r\n', self.latency)
+        elif cmd == 'SKSTART':
+            self.emit_lines('OK')
+        else:
+            self.emit_lines('FAIL ER04')
+
+    def skscan(self, mode):
+        """EDスキャン(mode 0), アクティブスキャン(mode 2)"""
+        self.emit_lines('OK')
+        if mode == 0:
+            lqi = ' '.join('{:02X} {:02X}'.format(ch, 0x40 + self.random.randint(0, 0x40)) for ch in range(0x21, 0x3d))
+            self.emit(('EEDSCAN\r\n' + lqi + '\r\n').encode(), self.scan_time)
+        elif mode == 2:
+            lines = ['EVENT 20 ' + self.METER_IP6, 'EPANDESC',
+                     '  Channel:{:02X}'.format(self.CHANNEL), '  Channel Page:09',
+                     '  Pan ID:{:04X}'.format(self.PAN_ID), '  Addr:' + self.METER_MAC,
+                     '  LQI:E1', '  PairID:' + self.PAIR_ID, 'EVENT 22 ' + self.HOST_IP6]
+            self.emit(''.join(line + '\r\n' for line in lines).encode(), self.scan_time)
+
+    def join(self):
+        """PANA認証"""
+        ok = self.password is not None and self.rbid is not None and \
+             int(self.reg['S02'], 16) == self.CHANNEL and int(self.reg['S03'], 16) == self.PAN_ID
+        pana = bytes(8)     # PANAメッセージ（内容は模擬しない）
+        out = self.erxudp(pana, 0x02cc) + b'EVENT 21 ' + self.METER_IP6.encode() + b' 02\r\n'
+        if ok:
+            self.joined = True
+            out += b'EVENT 25 ' + self.METER_IP6.encode() + b'\r\n'
+            self.inf_tid = (self.inf_tid + 1) & 0xffff
+            out += self.erxudp(self.meter.make_instance_list(self.inf_tid))
+        else:
+            out += b'EVENT 24 ' + self.METER_IP6.encode() + b'\r\n'
+        self.emit(out, self.latency)
+        with self.cond:
+            self.cond.notify()
+
+    def sksendto(self, cols, payload):
+        """UDP送信"""
+        port = int(cols[3], 16)
+        ok = self.joined and cols[2] == self.METER_IP6
+        self.emit_lines('EVENT 21 {} {}'.format(self.METER_IP6, '00' if ok else '01'), 'OK')
+        if not ok or port != 0x0e1a:
+            return
+        if self.random.random() < self.loss:
+            return      # 応答の損失
+        res = self.meter.handle(payload)
+        if res:
+            self.emit(self.erxudp(res), self.latency)
+
+
+class Y3SimSerial:
+    """serial.Serialの代用品（プロセス内でY3Simと接続する）"""
+
+    def __init__(self, timeout = 1, **kwargs):
+        """コンストラクタ
+            timeout: 読み込みタイムアウト[s]
+            kwargs: Y3Simのパラメータ (latency, loss, inf_interval, scan_time, seed, infc)
+        """
+        self.timeout = timeout
+        self.buf = bytearray()
+        self.cond = threading.Condition()
+        self.sim = Y3Sim(self.feed, **kwargs)
+        self.closed = False
+
+    def feed(self, data):
+        """シミュレータからの出力"""
+        with self.cond:
+            self.buf += data
+            self.cond.notify_all()
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            return len(self.buf)
+
+    def write(self, data):
+        self.sim.host_write(bytes(data))
+        return len(data)
+
+    def read(self, size = 1):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.buf) >= size or self.closed, self.timeout)
+            data = bytes(self.buf[:size])
+            del self.buf[:size]
+            return data
+
+    def readline(self):
+        with self.cond:
+            self.cond.wait_for(lambda: b'\n' in self.buf or self.closed, self.timeout)
+            idx = self.buf.find(b'\n')
+            size = idx + 1 if idx >= 0 else len(self.buf)
+            data = bytes(self.buf[:size])
+            del self.buf[:size]
+            return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.sim.terminate()
+
+
+class Y3ReplaySerial:
+    """serial.Serialの代用品（UART送受信データの記録を再生する）
+        ホストの送信を記録の送信レコードに対応させ，次の送信レコードまでの受信レコードを出力する。
+        受信レコードは対応する送信からの記録時の経過時間後に出力する（fast: 直ちに出力する）。
+        記録より早く次の送信があった場合，未出力の受信レコードは直ちに出力する（順序は記録どおり）。
+    """
+
+    def __init__(self, filename, timeout = 1, fast = False):
+        """コンストラクタ
+            filename: 記録ファイル(Y3Capture)
+            timeout: 読み込みタイムアウト[s]
+            fast: 記録時の時間間隔を無視して直ちに出力する
+        """
+        self.timeout = timeout
+        self.fast = fast
+        self.records = Y3Capture.load(filename)
+        self.pos = 0                    # 次のレコード
+        self.buf = bytearray()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.pending = collections.deque()  # 出力待ちの受信レコード [出力時刻(time.monotonic()), データ]
+
+        self.tx_count = 0               # ホストの送信数
+        self.tx_mismatch = 0            # 記録と異なる送信の数
+        self.done = threading.Event()   # 全レコードを出力した
+
+        with self.cond:
+            self.schedule(self.records[0][0] if self.records else 0.0)    # 最初の送信までの受信レコード
+        threading.Thread(target=self.output, daemon=True).start()
+
+    def schedule(self, base):
+        """次の送信レコードまでの受信レコードを出力待ちにする（condを取得して呼ぶこと）
+            base: 対応する送信の記録時刻
+        """
+        now = time.monotonic()
+        for rec in self.pending:    # 前の送信に対する未出力の受信レコード
+            rec[0] = now
+        while self.pos < len(self.records) and self.records[self.pos][1] == Y3Capture.RX:
+            ts, direction, data = self.records[self.pos]
+            self.pending.append([now if self.fast else now + ts - base, data])
+            self.pos += 1
+        self.cond.notify_all()
+
+    def output(self):
+        """出力待ちの受信レコードを出力時刻に出力する"""
+        with self.cond:
+            while not self.closed:
+                if not self.pending:
+                    if self.pos >= len(self.records):
+                        self.done.set()
+                    self.cond.wait()
+                    continue
+                delay = self.pending[0][0] - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                self.buf += self.pending.popleft()[1]
+                self.cond.notify_all()
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            return len(self.buf)
+
+    def write(self, data):
+        with self.cond:
+            self.tx_count += 1
+            if self.pos >= len(self.records):   # 記録の終わり
+                return len(data)
+            ts, direction, rec = self.records[self.pos]
+            self.pos += 1
+            if bytes(data) != rec:
+                self.tx_mismatch += 1
+            self.schedule(ts)
+        return len(data)
+
+    def read(self, size = 1):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.buf) >= size or self.closed, self.timeout)
+            data = bytes(self.buf[:size])
+            del self.buf[:size]
+            return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Y3SimPty:
+    """疑似端末(pty)で動くシミュレータ（AsyncY3Moduleや別プロセスのsem_com.pyから使う）"""
+
+    def __init__(self, **kwargs):
+        """kwargs: Y3Simのパラメータ (latency, loss, inf_interval, scan_time, seed, infc)"""
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.lock = threading.Lock()
+        self.sim = Y3Sim(self.feed, **kwargs)
+
+    def feed(self, data):
+        with self.lock:
+            os.write(self.master, data)
+
+    def serve_forever(self):
+        """ptyからの入力をシミュレータに渡す"""
+        while True:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            self.sim.host_write(data)
+
+
+def arg_parse():
+    p = argparse.ArgumentParser()
+    p.add_argument('--latency', help='response latency of the smart meter [s]', default=0.05, type=float)
+    p.add_argument('--loss', help='response loss rate (0.0-1.0)', default=0.0, type=float)
+    p.add_argument('--inf', help='INF notification interval [s], 0: disable', default=1800, type=float)
+    p.add_argument('--infc', help='notify with INFC (response required) instead of INF', action='store_true')
+    p.add_argument('--seed', help='random seed', default=None, type=int)
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    sim = Y3SimPty(latency = args.latency, loss = args.loss, inf_interval = args.inf, seed = args.seed,
+                    infc = args.infc)
+    sys.stdout.write('BP35A1 simulator: {}\n'.format(sim.device))
+    sys.stdout.flush()
+    try:
+        sim.serve_forever()
+    except KeyboardInterrupt:
+        pass